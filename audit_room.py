@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Checks everyone in a room against the blocklist and writes the matches to <room>_audit.csv, removing them with
+# --kick. Runs the same audit as the bot's /audit command, but without its time limit, from an admin's own account.
+#
+#   ./audit_room.py @room --table Roles --bucket output-bucket --kick
+#   ./audit_room.py @room --bot /whitelist --chat-roles '{"/whitelist": {"-1001234567890": ["whitelist", "blacklist"]}}'
+import argparse
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autoblock_function'))
+
+from autoblock import audit, blacklist, routes, snapshot, user_roles, whitelist  # noqa: E402
+from autoblock.index_reader import CapacityLimiter  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from telethon.sync import TelegramClient  # noqa: E402
+from telethon.utils import get_peer_id  # noqa: E402
+import boto3  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('room')
+    parser.add_argument('--table', default=os.environ.get('ROLE_TABLE_NAME', 'Roles'))
+    parser.add_argument('--bucket', default=os.environ.get('OUTPUT_BUCKET_NAME'),
+                        help='bucket with the ID snapshot, every member is looked up in the table without it')
+    parser.add_argument('--api-id', default=os.environ.get('TELEGRAM_API_ID'))
+    parser.add_argument('--api-hash', default=os.environ.get('TELEGRAM_API_HASH'))
+    parser.add_argument('--offset', type=int, default=0, help='participant offset to start from')
+    parser.add_argument('--rate', type=float, default=3, help='participant requests per second')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--kick', action='store_true', help='remove the members that are on the list')
+    parser.add_argument('--bot', choices=['/blacklist', '/whitelist'], default='/blacklist',
+                        help='bot whose roles the room is checked against')
+    parser.add_argument('--chat-roles', default=os.environ.get('CHAT_ROLES', '{}'),
+                        help="the bot's CHAT_ROLES setting, for rooms that apply several roles")
+    args = parser.parse_args()
+
+    api_id = args.api_id or input("Enter api id: ")
+    api_hash = args.api_hash or input("Enter api hash: ")
+
+    s3 = boto3.client('s3')
+    dynamodb = boto3.client('dynamodb')
+    banned_snapshot = snapshot.BannedIdSnapshot(s3, args.bucket) if args.bucket else None
+    roles = user_roles.UserRoles(args.table, dynamodb)
+    handlers = {
+        '/blacklist': blacklist.Handler(args.table, args.bucket, 'blacklist', dynamodb, s3, snapshot=banned_snapshot,
+                                        user_roles=roles),
+        '/whitelist': whitelist.Handler(args.table, 'whitelist', dynamodb, user_roles=roles)
+    }
+    chat_routes = routes.parse_routes(routes.load_chat_roles(args.chat_roles), handlers, roles)
+
+    with TelegramClient('audit_room', api_id, api_hash) as client, ThreadPoolExecutor(max_workers=2) as executor:
+        room = client.get_entity(args.room)
+        # The same roles the bot applies when someone joins the room
+        checker = chat_routes.get((args.bot, get_peer_id(room)), handlers[args.bot])
+
+        start = time.perf_counter()
+        pages = audit.participant_pages(client, room, args.offset, CapacityLimiter(args.rate))
+        result = audit.audit(pages, checker.are_users_banned, executor, offset=args.offset)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        print('Checked {} members of {} in {:.0f}s ({:.0f}/s), {} on the list'.format(
+            result.checked, args.room, elapsed, result.checked / elapsed, len(result.banned)
+        ))
+
+        output_path = os.path.join(args.output_dir, '{}_audit.csv'.format(args.room.strip('@')))
+        with open(output_path, 'w', encoding='utf-8', newline='') as output:
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(['id', 'username', 'reason'])
+            writer.writerows((user_id, username or '', reason) for user_id, username, reason in result.banned)
+
+        print('Wrote {}'.format(output_path))
+
+        if args.kick:
+            for user_id, username, _ in result.banned:
+                print('Removing {} (@{})'.format(user_id, username))
+                client.kick_participant(room, user_id)
+
+
+if __name__ == '__main__':
+    main()
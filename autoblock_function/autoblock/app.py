@@ -1,9 +1,12 @@
-from . import blacklist, whitelist
-from telethon import TelegramClient, sync
-import boto3
+from . import aws, blacklist, cache, configuration, documents, importer, metrics, raid, sessions, snapshot
+from . import routes, spans, telegram, updates, user_roles, usernames, whitelist
+from .index_reader import CapacityLimiter
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
 import json
 import os
-import requests
+import time
 
 # Constants we use in configuration below
 EXPECTED_CONFIG = ['api_id', 'api_hash', 'root_users']
@@ -13,121 +16,426 @@ USERNAME_COMMANDS = ['/isbanned', '/add', '/remove']
 APP_CONFIG_PATH = os.environ.get('APP_CONFIG_PATH', '/autoblock_bot')
 ROLE_TABLE_NAME = os.environ.get('ROLE_TABLE_NAME', 'Roles')
 OUTPUT_BUCKET_NAME = os.environ.get('OUTPUT_BUCKET_NAME', 'output-bucket')
-
-# Initialize parameters for use across invocations
-cloudwatch = boto3.client('cloudwatch')
-dynamodb = boto3.client('dynamodb')
-s3 = boto3.client('s3')
-ssm = boto3.client('ssm')
-config = None
+SESSION_BUCKET_NAME = os.environ.get('SESSION_BUCKET_NAME', 'session-bucket')
+ROLE_CACHE_SIZE = int(os.environ.get('ROLE_CACHE_SIZE', '4096'))
+ROLE_CACHE_TTL = int(os.environ.get('ROLE_CACHE_TTL', '60'))
+CONFIG_TTL = int(os.environ.get('CONFIG_TTL', '300'))
+BANNED_SNAPSHOT_MAX_AGE = int(os.environ.get('BANNED_SNAPSHOT_MAX_AGE', '1800'))
+KICK_CONCURRENCY = int(os.environ.get('KICK_CONCURRENCY', '8'))
+METRICS_MODE = os.environ.get('METRICS_MODE', 'emf')
+USERNAME_CACHE_TTL = int(os.environ.get('USERNAME_CACHE_TTL', '86400'))
+INLINE_WEBHOOK_RESPONSES = os.environ.get('INLINE_WEBHOOK_RESPONSES', 'false').lower() == 'true'
+RAID_JOIN_THRESHOLD = int(os.environ.get('RAID_JOIN_THRESHOLD', '20'))
+RAID_WINDOW = int(os.environ.get('RAID_WINDOW', '60'))
+RAID_NOTICE_INTERVAL = int(os.environ.get('RAID_NOTICE_INTERVAL', '60'))
+RAID_SHARED_WINDOW = os.environ.get('RAID_SHARED_WINDOW', 'false').lower() == 'true'
+# Telegram gives up on a webhook after about 30 seconds, so a large room is audited over several /audit commands
+AUDIT_TIME_BUDGET = float(os.environ.get('AUDIT_TIME_BUDGET', '20'))
+AUDIT_REQUEST_RATE = float(os.environ.get('AUDIT_REQUEST_RATE', '10'))
+# Per-stage timings logged with every invocation, and an optional profile of the whole invocation: cprofile or sample
+STAGE_TIMING = os.environ.get('STAGE_TIMING', 'true').lower() == 'true'
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+# Webhook redeliveries are recognized by update_id, in this container and, with persist on, across containers
+UPDATE_DEDUP_WINDOW = int(os.environ.get('UPDATE_DEDUP_WINDOW', '2048'))
+UPDATE_DEDUP_PERSIST = os.environ.get('UPDATE_DEDUP_PERSIST', 'false').lower() == 'true'
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '86400'))
+# Longer than the function timeout, so that a lease only runs out once the invocation holding it has ended
+UPDATE_DEDUP_LEASE = int(os.environ.get('UPDATE_DEDUP_LEASE', '90'))
+# Chats that apply several roles at once, per bot, {"/whitelist": {"-1001234567890": ["whitelist", "blacklist"]}}
+CHAT_ROLES = routes.load_chat_roles(os.environ.get('CHAT_ROLES', '{}'))
+MAX_NOTICE_USERNAMES = 20
+# Any answer other than a 2xx makes Telegram deliver the update again later
+RETRY_LATER_RESPONSE = {'statusCode': 503, 'body': '{}'}
+
+# Initialize parameters for use across invocations. Clients and Telethon are only built when first used, so a
+# cold start for a join does not pay for the admin command dependencies.
+cloudwatch = aws.LazyClient('cloudwatch')
+dynamodb = aws.LazyClient('dynamodb')
+s3 = aws.LazyClient('s3')
+ssm = aws.LazyClient('ssm')
 clients = {}
+TelegramClient = None
+
+# Collected for the whole invocation and written once, as EMF log lines or a single put_metric_data call
+invocation_metrics = metrics.Metrics('AutoblockBot', METRICS_MODE, cloudwatch)
+invocation_spans = spans.Spans(STAGE_TIMING)
+telegram.spans = invocation_spans
+
+# Role lookups are shared by both handlers and survive across invocations on a warm container
+role_cache = cache.RoleCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
+
+# Loaded from the scraper output on first use, answers most join checks without touching DynamoDB
+banned_snapshot = snapshot.BannedIdSnapshot(s3, OUTPUT_BUCKET_NAME, max_age=BANNED_SNAPSHOT_MAX_AGE)
+
+# Join rates per chat for raid detection, counted across containers in the table with RAID_SHARED_WINDOW on
+raid_detector = raid.RaidDetector(
+    RAID_JOIN_THRESHOLD, RAID_WINDOW, RAID_NOTICE_INTERVAL,
+    shared=raid.SharedJoinWindow(
+        ROLE_TABLE_NAME, dynamodb, RAID_WINDOW, spans=invocation_spans
+    ) if RAID_SHARED_WINDOW else None
+)
+
+# Blocking I/O from the asyncio handler runs on io_executor, whose size also bounds concurrent kicks. Commands use a
+# single thread with its own event loop, because Telethon's sync shim drives the client with run_until_complete.
+io_executor = ThreadPoolExecutor(max_workers=KICK_CONCURRENCY)
+command_executor = ThreadPoolExecutor(
+    max_workers=1, initializer=lambda: asyncio.set_event_loop(asyncio.new_event_loop())
+)
+
+# Parameters from SSM, refreshed in the background once they are CONFIG_TTL seconds old
+config_store = configuration.ConfigStore(
+    ssm, APP_CONFIG_PATH, EXPECTED_CONFIG, CONFIG_TTL, io_executor, spans=invocation_spans
+)
+
+# Telethon sessions are kept in S3 so a new container can skip bot login and data center negotiation
+session_store = sessions.SessionStore(s3, SESSION_BUCKET_NAME)
+
+# Maps @username to user id for admin commands, so Telethon is only needed for names not seen recently
+username_resolver = usernames.UsernameResolver(ROLE_TABLE_NAME, dynamodb, USERNAME_CACHE_TTL)
+
+# file_ids of lists already uploaded to Telegram, so /getlist does not make Telegram fetch the same zip again
+document_cache = documents.DocumentCache(ROLE_TABLE_NAME, dynamodb)
+
+# update_ids already handled, so a webhook delivery Telegram repeats does not kick or reply twice
+update_deduplicator = updates.UpdateDeduplicator(
+    ROLE_TABLE_NAME, dynamodb, UPDATE_DEDUP_PERSIST, UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_TTL, UPDATE_DEDUP_LEASE,
+    spans=invocation_spans
+)
+
+# Role items read in this invocation, so no role of a user is read twice while handling one update
+invocation_roles = user_roles.UserRoles(ROLE_TABLE_NAME, dynamodb, invocation_spans)
 
 handlers = {
-    '/blacklist': blacklist.Handler(ROLE_TABLE_NAME, OUTPUT_BUCKET_NAME, 'blacklist', dynamodb, s3),
-    '/whitelist': whitelist.Handler(ROLE_TABLE_NAME, 'whitelist', dynamodb)
+    '/blacklist': blacklist.Handler(
+        ROLE_TABLE_NAME, OUTPUT_BUCKET_NAME, 'blacklist', dynamodb, s3, role_cache, banned_snapshot, invocation_spans,
+        invocation_roles
+    ),
+    '/whitelist': whitelist.Handler(
+        ROLE_TABLE_NAME, 'whitelist', dynamodb, role_cache, invocation_spans, invocation_roles
+    )
 }
+chat_routes = routes.parse_routes(CHAT_ROLES, handlers, invocation_roles)
+handler_paths = {handler: path for path, handler in handlers.items()}
 
 
-def load_config():
-    params = ssm.get_parameters_by_path(Path=APP_CONFIG_PATH)
+def chat_route(handler, chat_id):
+    # The roles set up in CHAT_ROLES for this bot in the chat, otherwise the bot's own role
+    return chat_routes.get((handler_paths[handler], int(chat_id)), handler)
 
-    # /autoblock_bot/bot_key = SECRET_KEY => { 'bot_key': 'SECRET_KEY' }
-    parsed_config = {
-        item['Name'].split('/')[-1]: item['Value'].split(',') if item['Type'] == 'StringList'
-        else item['Value'] for item in params['Parameters']
-    }
 
-    print("Loaded config", parsed_config)
+def ensure_config():
+    # The config load can overlap with command handling, so whoever needs it first waits for a single load
+    return config_store.get()
 
-    for key in EXPECTED_CONFIG:
-        if key not in parsed_config:
-            raise Exception("Expected key {} not found in config".format(key))
 
-    global config
-    config = parsed_config
+def load_client(bot_key):
+    config = ensure_config()
 
+    with invocation_spans.span('telethon.start'):
+        start_client(bot_key, config)
 
-def load_client(bot_key):
-    if config is None:
-        print("Loading config and creating new app config")
-        load_config()
 
+def start_client(bot_key, config):
     bot_id = bot_key.split(':')[0]
+    session_path = '/tmp/autoblock_bot_{}'.format(bot_id)
 
     print('Starting client for bot', bot_id)
 
-    global clients
-    client = TelegramClient('/tmp/autoblock_bot_{}'.format(bot_id), config['api_id'], config['api_hash'])
+    global clients, TelegramClient
+    if TelegramClient is None:
+        from telethon import TelegramClient, sync
+
+    start = time.perf_counter()
+    restored = not os.path.exists(session_path + '.session') and session_store.restore(bot_id, session_path)
+
+    client = TelegramClient(session_path, config['api_id'], config['api_hash'])
     client.start(bot_token=bot_key)
     clients[bot_key] = client
 
+    elapsed = (time.perf_counter() - start) * 1000
+    print('Started client for bot {} in {:.0f}ms ({} session)'.format(
+        bot_id, elapsed, 'restored' if restored else 'new'
+    ))
+    invocation_metrics.timing('TelethonStartRestored' if restored else 'TelethonStartFresh', elapsed)
+
+    # Telethon commits the auth key and data center to the session file itself once connected
+    session_store.save(bot_id, session_path)
+
+
+def resolve_user_id(bot_key, username, fresh=False):
+    # Usernames can be released and taken by another account, so commands that change a role pass fresh to resolve
+    # the name through Telegram, and only lookups such as /isbanned trust a name seen earlier
+    user_id = None if fresh else username_resolver.lookup(username)
+
+    if user_id is None:
+        # Only start Telethon when the username has not been seen recently
+        if clients.get(bot_key) is None:
+            load_client(bot_key)
+
+        with invocation_spans.span('telethon.get_entity'):
+            user_id = clients[bot_key].get_entity(username).id
+
+        username_resolver.remember(username, user_id)
+
+    return user_id
+
 
 def lambda_handler(event, context):
-    if config is None:
-        print("Loading config and creating new app config")
-        load_config()
+    start = time.perf_counter()
+    invocation_metrics.begin(Path=event.get('rawPath'))
+    invocation_spans.begin()
+    invocation_roles.begin()
+    telegram.webhook_reply = telegram.WebhookReply(INLINE_WEBHOOK_RESPONSES)
+    counts_before = cache_counts()
+
+    profiler = None
+    if PROFILE_MODE != 'off':
+        from . import profiling
+        profiler = profiling.start(PROFILE_MODE, PROFILE_DIR, getattr(context, 'aws_request_id', None))
 
-    handler = handlers[event['rawPath']]
-    bot_key = event['queryStringParameters']['bot_key']
-    body = json.loads(event['body'])
+    try:
+        return asyncio.run(handle_event(event)) or telegram.webhook_reply.response()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+        duration = (time.perf_counter() - start) * 1000
+        invocation_metrics.timing('HandlerDuration', duration)
+
+        # The caches count over the life of the container, the metrics get what this invocation added
+        for name, count in cache_counts().items():
+            if count > counts_before[name]:
+                invocation_metrics.count(name, count - counts_before[name])
 
-    if 'message' in body:
-        chat_id = body['message']['chat']['id']
-        chat_title = body['message']['chat'].get('title', 'Private chat')
-        chat_type = body['message']['chat']['type']
-        from_id = body['message']['from']['id']
-        message_id = body['message']['message_id']
+        with invocation_spans.span('metrics.flush'):
+            invocation_metrics.flush()
 
-        if "new_chat_participant" in body['message']:
-            user_id = body['message']['new_chat_participant']['id']
-            username = body['message']['new_chat_participant'].get('username', 'no_username')
+        invocation_spans.flush(path=event.get('rawPath'), duration_ms=round(duration, 1))
 
-            handle_new_user(handler, bot_key, chat_id, chat_type, chat_title, user_id, username, message_id)
-        elif chat_type == 'private' and 'text' in body['message'] and 'entities' in body['message']:
-            text = body['message']['text']
-            entities = body['message']['entities']
 
-            handle_command(handler, bot_key, chat_id, from_id, message_id, text, entities)
+def cache_counts():
+    roles = role_cache.stats()
+    names = username_resolver.stats()
 
     return {
-        'statusCode': 200,
-        'body': '{}'
+        'RoleCacheHit': roles['hits'],
+        'RoleCacheMiss': roles['misses'],
+        'RoleCacheEviction': roles['evictions'],
+        'UsernameCacheHit': names['hits'],
+        'UsernameCacheMiss': names['misses']
     }
 
 
-def handle_new_user(handler, bot_key, chat_id, chat_type, chat_title, user_id, username, message_id):
+def run_blocking(function, *args):
+    # boto3 and requests calls run on the shared pool so independent ones can overlap
+    return asyncio.get_running_loop().run_in_executor(io_executor, function, *args)
+
+
+async def handle_event(event):
+    handler = handlers[event['rawPath']]
+    bot_key = event['queryStringParameters']['bot_key']
+    body = json.loads(event['body'])
     bot_id = bot_key.split(':')[0]
+    update_id = body.get('update_id')
 
-    if str(user_id) == bot_id and chat_type == 'supergroup':
-        print('Added to new chat: {} ({})'.format(chat_title, chat_id))
-        payload = {
-            'chat_id': chat_id,
-            'text': 'In order for this bot to be operational in this chat, it must be made an admin.'
-        }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+    invocation_metrics.set_dimensions(BotId=bot_id)
 
-        publish_count_metric('AddedToChat')
-    elif not is_user_admin(user_id) and handler.is_user_banned(user_id):
-        # Ban user
-        print('User {} (@{}) is banned, banning'.format(user_id, username))
-        payload = {
-            'chat_id': chat_id,
-            'user_id': user_id
-        }
+    # Redeliveries are dropped before anything else is done for them, including the config load
+    claim = await claim_update(bot_id, update_id) if update_id is not None else updates.CLAIMED
+
+    if claim == updates.HANDLED:
+        print('Dropped redelivered update {} for bot {}'.format(update_id, bot_id))
+        publish_count_metric('DuplicateUpdateDropped')
+        return
+
+    if claim == updates.IN_PROGRESS:
+        # Telegram delivers the update again after an error, by which time the other container has finished or failed
+        print('Update {} for bot {} is still being handled elsewhere'.format(update_id, bot_id))
+        publish_count_metric('DuplicateUpdateDeferred')
+        return RETRY_LATER_RESPONSE
 
-        response = requests.post('https://api.telegram.org/bot{}/kickChatMember'.format(bot_key), data=payload)
+    # Loaded alongside the rest of the update; anything that needs it first waits in ensure_config
+    config_loaded = run_blocking(ensure_config) if config_store.current is None else None
 
-        if response.status_code == 200:
-            publish_count_metric('UserRemoved')
-        elif response.status_code == 400:
+    try:
+        if 'message' in body:
+            chat_id = body['message']['chat']['id']
+            chat_title = body['message']['chat'].get('title', 'Private chat')
+            chat_type = body['message']['chat']['type']
+            from_id = body['message']['from']['id']
+            message_id = body['message']['message_id']
+
+            invocation_metrics.set_dimensions(ChatType=chat_type)
+
+            if 'new_chat_members' in body['message'] or 'new_chat_participant' in body['message']:
+                # new_chat_participant only carries the first of the users who joined together
+                members = body['message'].get('new_chat_members') or [body['message']['new_chat_participant']]
+
+                await handle_new_users(
+                    handler, bot_key, chat_id, chat_type, chat_title, members, message_id, config_loaded
+                )
+            elif chat_type == 'private' and 'text' in body['message'] and 'entities' in body['message']:
+                text = body['message']['text']
+                entities = body['message']['entities']
+
+                # Commands run on the thread that owns the Telethon clients and their event loop
+                await asyncio.get_running_loop().run_in_executor(
+                    command_executor, handle_command, handler, bot_key, chat_id, from_id, message_id, text, entities
+                )
+            elif chat_type == 'private' and 'document' in body['message']:
+                document = body['message']['document']
+                caption = body['message'].get('caption', '')
+
+                await asyncio.get_running_loop().run_in_executor(
+                    command_executor, handle_import_document, handler, bot_key, chat_id, from_id, message_id,
+                    document, caption
+                )
+            elif chat_type != 'private':
+                await report_held_failures(bot_key, chat_id)
+
+        # Inside the try, so that an update whose config load failed is released too
+        if config_loaded is not None:
+            await config_loaded
+    except Exception:
+        if config_loaded is not None:
+            # The update may have failed first, the config load still finishes before the container is frozen
+            await asyncio.gather(config_loaded, return_exceptions=True)
+
+        # Telegram retries updates that fail, and the retry should be handled rather than dropped
+        if update_id is not None:
+            await run_blocking(update_deduplicator.release, bot_id, update_id)
+        raise
+
+    if update_id is not None and update_deduplicator.persist:
+        await run_blocking(update_deduplicator.complete, bot_id, update_id)
+
+
+async def claim_update(bot_id, update_id):
+    # Only the conditional put needs the I/O pool, the recent window is checked in place
+    if update_deduplicator.persist:
+        return await run_blocking(update_deduplicator.claim, bot_id, update_id)
+
+    return update_deduplicator.claim(bot_id, update_id)
+
+
+async def handle_new_users(handler, bot_key, chat_id, chat_type, chat_title, members, message_id, config_loaded=None):
+    bot_id = bot_key.split(':')[0]
+    notices = []
+    users = []
+
+    for member in members:
+        if 'username' in member:
+            username_resolver.remember(member['username'], member['id'], persist=False)
+
+        if str(member['id']) == bot_id and chat_type == 'supergroup':
+            print('Added to new chat: {} ({})'.format(chat_title, chat_id))
             payload = {
                 'chat_id': chat_id,
-                'reply_to_message_id': message_id,
-                'text': 'Unable to remove @{} because this bot is not an admin'.format(username)
+                'text': 'In order for this bot to be operational in this chat, it must be made an admin.'
             }
-            requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+            notices.append(run_blocking(telegram.reply, bot_key, 'sendMessage', payload))
+
+            publish_count_metric('AddedToChat')
         else:
-            response.raise_for_status()
+            users.append(member)
+
+    # The shared join count is a table write, so it overlaps the ban check
+    joins_recorded = run_blocking(raid_detector.record_joins, chat_id, len(members))
+
+    if users:
+        # One storage round trip for everyone who joined with this update, overlapping the config load that the
+        # admin check needs
+        banned, _, (raiding, raid_started) = await asyncio.gather(
+            run_blocking(chat_route(handler, chat_id).are_users_banned, [member['id'] for member in users]),
+            config_loaded if config_loaded is not None else asyncio.sleep(0),
+            joins_recorded
+        )
+        banned_members = [member for member in users if banned[member['id']] and not is_user_admin(member['id'])]
+
+        removed = await asyncio.gather(*[
+            run_blocking(kick_user, bot_key, chat_id, member) for member in banned_members
+        ])
+        failed = [member for member, kicked in zip(banned_members, removed) if not kicked]
+
+        usernames = [member.get('username', 'no_username') for member in failed]
+    else:
+        raiding, raid_started = await joins_recorded
+        failed = usernames = []
+
+    if raid_started:
+        print('Join burst detected in {} ({}), switching to raid mode'.format(chat_title, chat_id))
+        publish_count_metric('RaidDetected')
+
+    # During a raid, failures are merged into at most one notice per chat per interval. Failures held back earlier go
+    # out with this update once the interval has passed, even if the raid is over.
+    reported, more = raid_detector.add_failures(chat_id, usernames, hold=raiding)
+
+    if failed and not reported and not more:
+        publish_count_metric('RaidNoticeSuppressed')
+
+    if reported or more:
+        # A notice that carries failures held back from earlier joins is not a reply to this message
+        reply_to = message_id if reported == usernames and not more else None
+        notices.append(run_blocking(notify_failed_kicks, bot_key, chat_id, reported, reply_to, more))
+
+    await asyncio.gather(*notices)
+
+
+async def report_held_failures(bot_key, chat_id):
+    # Failures held back during a raid go out with the next update from the chat once the interval has passed, as a
+    # message of their own rather than a reply to that update
+    usernames, more = raid_detector.add_failures(chat_id, [])
+
+    if usernames or more:
+        await run_blocking(notify_failed_kicks, bot_key, chat_id, usernames, None, more)
+
+
+def kick_user(bot_key, chat_id, member, inline=True):
+    # Returns False when the bot is not allowed to remove the user
+    user_id = member['id']
+    username = member.get('username', 'no_username')
+
+    print('User {} (@{}) is banned, banning'.format(user_id, username))
+    payload = {
+        'chat_id': chat_id,
+        'user_id': user_id
+    }
+
+    # An inline kick cannot report failure, so there is no "not an admin" notice in that mode
+    if inline and telegram.webhook_reply.offer('kickChatMember', payload):
+        publish_count_metric('UserRemoved')
+        return True
+
+    response = telegram.call(bot_key, 'kickChatMember', payload)
+
+    if response.status_code == 200:
+        publish_count_metric('UserRemoved')
+    elif response.status_code == 400:
+        return False
+    else:
+        response.raise_for_status()
+
+    return True
+
+
+def notify_failed_kicks(bot_key, chat_id, usernames, message_id, more=0):
+    # more counts failures beyond the usernames given
+    names = ', '.join('@{}'.format(username) for username in usernames[:MAX_NOTICE_USERNAMES])
+    more += max(0, len(usernames) - MAX_NOTICE_USERNAMES)
+
+    if more:
+        names += ' and {} more'.format(more) if names else '{} users'.format(more)
+
+    payload = {
+        'chat_id': chat_id,
+        'text': 'Unable to remove {} because this bot is not an admin'.format(names)
+    }
+
+    if message_id is not None:
+        payload['reply_to_message_id'] = message_id
+
+    telegram.reply(bot_key, 'sendMessage', payload)
 
 
 def handle_command(handler, bot_key, chat_id, from_id, message_id, text, entities):
@@ -150,28 +458,21 @@ def handle_command(handler, bot_key, chat_id, from_id, message_id, text, entitie
             'chat_id': chat_id,
             'text': handler.welcome_message
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         publish_count_metric('StartCommand')
         return
     elif command == '/getlist':
-        list_url = handler.get_blocklist_url()
-        if list_url is None:
-            payload = {
-                'chat_id': chat_id,
-                'reply_to_message_id': message_id,
-                'text': 'No list is available.'
-            }
-            requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        handle_get_list_command(handler, bot_key, chat_id, message_id)
+        return
+    elif command == '/audit':
+        # Check that the user who issued the command is an admin
+        if not is_user_admin(from_id):
+            print('Ignoring command from non-admin: {}'.format(from_id))
+            publish_count_metric('NonAdminCommandIgnored')
             return
 
-        print("Sending list: {}".format(list_url))
-        payload = {
-            'chat_id': chat_id,
-            'reply_to_message_id': message_id,
-            'document': list_url
-        }
-        requests.post('https://api.telegram.org/bot{}/sendDocument'.format(bot_key), data=payload).raise_for_status()
-        publish_count_metric('GetListCommand')
+        arguments = text[command_entity['offset'] + command_entity['length']:].split()
+        handle_audit_command(handler, bot_key, chat_id, message_id, arguments)
         return
 
     if command in USERNAME_COMMANDS:
@@ -185,7 +486,7 @@ def handle_command(handler, bot_key, chat_id, from_id, message_id, text, entitie
                 'reply_to_message_id': message_id,
                 'text': 'This command requires a username.'
             }
-            requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+            telegram.reply(bot_key, 'sendMessage', payload)
             return
 
         username = text[mention_entity['offset']:mention_entity['offset'] + mention_entity['length']]
@@ -216,144 +517,308 @@ def handle_command(handler, bot_key, chat_id, from_id, message_id, text, entitie
             'reply_to_message_id': message_id,
             'text': 'Unknown command'
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         publish_count_metric('UnknownCommand')
 
 
-def handle_is_user_banned_command(handler, bot_key, chat_id, message_id, username):
+def handle_get_list_command(handler, bot_key, chat_id, message_id):
+    bot_id = bot_key.split(':')[0]
+    version = handler.get_blocklist_version()
+    file_id = document_cache.lookup(bot_id, 'blocklist', version) if version is not None else None
+
+    if file_id is not None:
+        payload = {
+            'chat_id': chat_id,
+            'reply_to_message_id': message_id,
+            'document': file_id
+        }
+        response = telegram.call(bot_key, 'sendDocument', payload)
+
+        if response.ok:
+            publish_count_metric('GetListCommand')
+            publish_count_metric('GetListCached')
+            return
+
+        # Fall back to sending the list from S3 again, which replaces the cached file_id
+        print('Cached list document was rejected: {}'.format(response.text))
+        document_cache.invalidate(bot_id, 'blocklist')
+
+    list_url = handler.get_blocklist_url()
+    if list_url is None:
+        payload = {
+            'chat_id': chat_id,
+            'reply_to_message_id': message_id,
+            'text': 'No list is available.'
+        }
+        telegram.reply(bot_key, 'sendMessage', payload)
+        return
+
+    print("Sending list: {}".format(list_url))
+    payload = {
+        'chat_id': chat_id,
+        'reply_to_message_id': message_id,
+        'document': list_url
+    }
+
+    # Sent directly rather than as the webhook response, because the file_id is only in the response
+    response = telegram.send(bot_key, 'sendDocument', payload)
+
+    if version is not None:
+        document_cache.remember(bot_id, 'blocklist', version, response.json()['result']['document']['file_id'])
+
+    publish_count_metric('GetListCommand')
+
+
+def handle_audit_command(handler, bot_key, chat_id, message_id, arguments):
+    # /audit <chat> [kick] [offset]: checks everyone already in a chat against the list, and removes them with "kick"
+    options = arguments[1:]
+
+    if not arguments or any(option != 'kick' and not option.isdigit() for option in options):
+        payload = {
+            'chat_id': chat_id,
+            'reply_to_message_id': message_id,
+            'text': 'Usage: /audit <chat> [kick] [offset]'
+        }
+        telegram.reply(bot_key, 'sendMessage', payload)
+        return
+
+    target = arguments[0]
+    kick = 'kick' in options
+    offset = next((int(option) for option in options if option.isdigit()), 0)
+
     if clients.get(bot_key) is None:
         load_client(bot_key)
 
+    client = clients[bot_key]
+
     try:
-        info = clients[bot_key].get_entity(username)
+        entity = client.get_entity(int(target) if target.lstrip('-').isdigit() else target)
     except ValueError as e:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
             'text': str(e)
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
-    reason = handler.is_user_banned(info.id)
+    # Only admins run audits, so join events do not pay for importing the participant readers
+    from . import audit
+    from telethon.utils import get_peer_id
+
+    # The Bot API addresses supergroups and channels by their marked id, which is also how CHAT_ROLES names them
+    peer_id = get_peer_id(entity)
+    are_users_banned = chat_route(handler, peer_id).are_users_banned
+
+    start = time.perf_counter()
+    pages = audit.participant_pages(client, entity, offset, CapacityLimiter(AUDIT_REQUEST_RATE))
+    result = audit.audit(pages, are_users_banned, io_executor, time.monotonic() + AUDIT_TIME_BUDGET, offset)
+
+    # Admins of the bot are never removed, even from a whitelist chat they are not on
+    bot_id = bot_key.split(':')[0]
+    banned = [match for match in result.banned if not is_user_admin(match[0]) and str(match[0]) != bot_id]
+
+    elapsed = time.perf_counter() - start
+    print('Audited {} members of {} in {:.1f}s, {} banned'.format(result.checked, target, elapsed, len(banned)))
+    invocation_metrics.count('AuditMembersChecked', result.checked)
+
+    lines = ['Checked {} of {} members of {}: {} on the list.'.format(
+        result.next_offset, result.total or result.next_offset, target, len(banned)
+    )]
+
+    for user_id, username, reason in banned[:MAX_NOTICE_USERNAMES]:
+        lines.append('@{} ({}){}'.format(
+            username or 'no_username', user_id, ': {}'.format(reason) if isinstance(reason, str) else ''
+        ))
+
+    if len(banned) > MAX_NOTICE_USERNAMES:
+        lines.append('and {} others'.format(len(banned) - MAX_NOTICE_USERNAMES))
+
+    next_offset = result.next_offset
+
+    if kick and banned:
+        removed = list(io_executor.map(
+            lambda match: kick_user(bot_key, peer_id, {'id': match[0], 'username': match[1]}, inline=False), banned
+        ))
+        lines.append('Removed {}.'.format(sum(removed)))
+
+        if not all(removed):
+            lines.append('Unable to remove {} because this bot is not an admin.'.format(len(removed) - sum(removed)))
+
+        # Removed members no longer take up a place in the participant list
+        next_offset -= sum(removed)
+
+    if not result.complete:
+        lines.append('Stopped at the time limit, continue with /audit {}{} {}'.format(
+            target, ' kick' if kick else '', next_offset
+        ))
+
+    payload = {
+        'chat_id': chat_id,
+        'reply_to_message_id': message_id,
+        'text': '\n'.join(lines)
+    }
+    telegram.reply(bot_key, 'sendMessage', payload)
+
+    publish_count_metric('AuditCommand')
+
+
+def handle_import_document(handler, bot_key, chat_id, from_id, message_id, document, caption):
+    # A CSV of users sent to the bot is added to its list, the caption is the reason for rows that do not give one
+    if not is_user_admin(from_id):
+        print('Ignoring document from non-admin: {}'.format(from_id))
+        publish_count_metric('NonAdminCommandIgnored')
+        return
+
+    if not document.get('file_name', '').lower().endswith('.csv'):
+        payload = {
+            'chat_id': chat_id,
+            'reply_to_message_id': message_id,
+            'text': 'Send a .csv file with id, username and reason columns to import users.'
+        }
+        telegram.reply(bot_key, 'sendMessage', payload)
+        return
+
+    start = time.perf_counter()
+    result = importer.ImportResult()
+
+    with telegram.download(bot_key, document['file_id']) as response:
+        lines = io.TextIOWrapper(response.raw, encoding='utf-8-sig', newline='')
+        entries = importer.read_entries(lines, result, caption.strip() or None, handler.requires_reason)
+        importer.import_entries(handler, entries, result)
+
+    print('Imported {} in {:.1f}s: {}'.format(
+        document.get('file_name'), time.perf_counter() - start, result.summary()
+    ))
+    invocation_metrics.count('ImportUsersAdded', result.added)
+
+    payload = {
+        'chat_id': chat_id,
+        'reply_to_message_id': message_id,
+        'text': result.summary()
+    }
+    telegram.reply(bot_key, 'sendMessage', payload)
+
+    publish_count_metric('ImportCommand')
+
+
+def handle_is_user_banned_command(handler, bot_key, chat_id, message_id, username):
+    try:
+        user_id = resolve_user_id(bot_key, username)
+    except ValueError as e:
+        payload = {
+            'chat_id': chat_id,
+            'reply_to_message_id': message_id,
+            'text': str(e)
+        }
+        telegram.reply(bot_key, 'sendMessage', payload)
+        return
+
+    reason = handler.is_user_banned(user_id, confirmed=True)
 
     if reason:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
-            'text': f'{username} ({info.id}) is banned: {reason}'
+            'text': f'{username} ({user_id}) is banned: {reason}'
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
     else:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
-            'text': '{} ({}) is not banned'.format(username, info.id)
+            'text': '{} ({}) is not banned'.format(username, user_id)
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
 
     publish_count_metric('IsBannedCommand')
 
 
 def handle_add_user_command(handler, bot_key, chat_id, message_id, username, reason):
-    if clients.get(bot_key) is None:
-        load_client(bot_key)
-
     if not reason:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
             'text': 'A reason is required.'
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
     try:
-        info = clients[bot_key].get_entity(username)
+        user_id = resolve_user_id(bot_key, username, fresh=True)
     except ValueError as e:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
             'text': str(e)
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
     # Check to see if user is already banned
-    current_reason = handler.has_role(info.id)
+    current_reason = handler.has_role(user_id)
     if current_reason:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
-            'text': f'{username} ({info.id}) is already added: {current_reason}'
+            'text': f'{username} ({user_id}) is already added: {current_reason}'
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
-    handler.add_role_to(info.id, username, reason)
+    handler.add_role_to(user_id, username, reason)
+    username_resolver.remember(username, user_id)
 
     # Send a confirmation back
     payload = {
         'chat_id': chat_id,
         'reply_to_message_id': message_id,
-        'text': f'{username} ({info.id}) has been added: {reason}'
+        'text': f'{username} ({user_id}) has been added: {reason}'
     }
-    requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+    telegram.reply(bot_key, 'sendMessage', payload)
 
     publish_count_metric('AddUserCommand')
 
 
 def handle_remove_user_command(handler, bot_key, chat_id, message_id, username):
-    if clients.get(bot_key) is None:
-        load_client(bot_key)
-
     try:
-        info = clients[bot_key].get_entity(username)
+        user_id = resolve_user_id(bot_key, username, fresh=True)
     except ValueError as e:
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
             'text': str(e)
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
     # Check to see if user is not banned
-    if not handler.has_role(info.id):
+    if not handler.has_role(user_id):
         payload = {
             'chat_id': chat_id,
             'reply_to_message_id': message_id,
-            'text': '{} ({}) is not added'.format(username, info.id)
+            'text': '{} ({}) is not added'.format(username, user_id)
         }
-        requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+        telegram.reply(bot_key, 'sendMessage', payload)
         return
 
-    handler.remove_role_from(info.id)
+    handler.remove_role_from(user_id)
 
     # Send a confirmation back
     payload = {
         'chat_id': chat_id,
         'reply_to_message_id': message_id,
-        'text': '{} ({}) has been removed'.format(username, info.id)
+        'text': '{} ({}) has been removed'.format(username, user_id)
     }
-    requests.post('https://api.telegram.org/bot{}/sendMessage'.format(bot_key), data=payload).raise_for_status()
+    telegram.reply(bot_key, 'sendMessage', payload)
 
     publish_count_metric('RemoveUserCommand')
 
 
 def is_user_admin(user_id):
-    if config is None:
-        load_config()
-
-    return str(user_id) in config['root_users']
+    return int(user_id) in ensure_config().admins
 
 
 def publish_count_metric(metric_name):
-    cloudwatch.put_metric_data(
-        Namespace='AutoblockBot',
-        MetricData=[{
-            'MetricName': metric_name,
-            'Values': [1.0],
-            'Unit': 'Count'
-        }]
-    )
+    # Buffered until the end of the invocation, see lambda_handler
+    invocation_metrics.count(metric_name)
@@ -0,0 +1,72 @@
+from .participants import PAGE_SIZE
+from collections import deque
+import time
+
+
+class AuditResult:
+    def __init__(self, offset=0):
+        self.checked = 0
+        self.total = None
+        # (user_id, username, reason) for every member that should not be in the room
+        self.banned = []
+        # Where a later audit continues when this one stopped at its deadline
+        self.next_offset = offset
+        self.complete = False
+
+
+def participant_pages(client, entity, offset=0, limiter=None, page_size=PAGE_SIZE):
+    # Pages of (user_id, username) through a sync Telethon client, starting at a participant offset. Telethon is
+    # imported here so that loading the bot does not pull it in.
+    from telethon.tl.functions.channels import GetParticipantsRequest
+    from telethon.tl.types import ChannelParticipantsSearch
+
+    while True:
+        if limiter is not None:
+            limiter.wait()
+
+        result = client(GetParticipantsRequest(entity, ChannelParticipantsSearch(''), offset, page_size, 0))
+
+        if limiter is not None:
+            limiter.consume(1)
+
+        if not result.users:
+            return
+
+        yield [(user.id, user.username) for user in result.users], result.count
+        offset += len(result.users)
+
+
+def audit(pages, are_users_banned, executor, deadline=None, offset=0, clock=time.monotonic):
+    # Each page is checked in one batch on the executor while the next page is fetched. Past the deadline no more
+    # pages are requested, and the result says where to pick up.
+    result = AuditResult(offset)
+    checks = deque()
+
+    def check(members):
+        banned = are_users_banned([user_id for user_id, _ in members])
+        return [(user_id, username, banned[user_id]) for user_id, username in members if banned[user_id]]
+
+    def collect():
+        members, future = checks.popleft()
+        result.banned.extend(future.result())
+        result.checked += len(members)
+        result.next_offset += len(members)
+
+    for members, total in pages:
+        result.total = total
+        checks.append((members, executor.submit(check, members)))
+
+        while len(checks) > 1 or checks[0][1].done():
+            collect()
+            if not checks:
+                break
+
+        if deadline is not None and clock() >= deadline:
+            break
+    else:
+        result.complete = True
+
+    while checks:
+        collect()
+
+    return result
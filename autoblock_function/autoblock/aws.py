@@ -0,0 +1,24 @@
+import threading
+
+# boto3 client creation on the shared default session is not thread safe, and kicks run on a thread pool
+_lock = threading.Lock()
+
+
+class LazyClient:
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.client = None
+
+    def __getattr__(self, name):
+        # Only reached for attributes the proxy does not have itself, i.e. client operations
+        if self.client is None:
+            with _lock:
+                if self.client is None:
+                    import boto3
+                    self.client = boto3.client(self.service_name)
+
+        return getattr(self.client, name)
+
+    @property
+    def loaded(self):
+        return self.client is not None
@@ -1,15 +1,27 @@
 from botocore.exceptions import ClientError
+from .roles import RoleHandler
+from .spans import NO_SPANS
+import json
 import logging
+import time
 
 BLOCKLIST_KEY = 'autoblock_blacklist.zip'
+MANIFEST_KEY = 'autoblock_blacklist.manifest.json'
+# How long a checked list version is trusted before asking S3 again
+LIST_VERSION_CHECK_INTERVAL = 60
 
-class Handler:
-    def __init__(self, table_name, output_bucket_name, role_name, dynamodb, s3):
-        self.table_name = table_name
+class Handler(RoleHandler):
+    # Bulk imports skip rows that do not say why the user is listed
+    requires_reason = True
+
+    def __init__(self, table_name, output_bucket_name, role_name, dynamodb, s3, cache=None, snapshot=None,
+                 spans=NO_SPANS, user_roles=None):
+        super().__init__(table_name, role_name, dynamodb, cache, spans, user_roles)
         self.output_bucket_name = output_bucket_name
-        self.role_name = role_name
-        self.dynamodb = dynamodb
         self.s3 = s3
+        self.snapshot = snapshot
+        self.list_version = None
+        self.list_version_checked_at = None
 
     @property
     def welcome_message(self):
@@ -30,42 +42,50 @@ class Handler:
 
         return response
 
-    def is_user_banned(self, user_id):
-        return self.has_role(user_id)
-
-    def has_role(self, user_id):
-        response = self.dynamodb.get_item(
-            TableName=self.table_name,
-            Key={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)}
-            }
-        )
-
-        if 'Item' in response:
-            reason = response['Item'].get('reason', {}).get('S')
-            return reason if reason else 'Ban predates listed reasons'
-
-        return False
-
-    def add_role_to(self, user_id, username, reason):
-        self.dynamodb.put_item(
-            TableName=self.table_name,
-            Item={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)},
-                'role_users_pk': {'S': 'role_{}'.format(self.role_name)},
-                'role_users_sk': {'S': 'user_{}'.format(user_id)},
-                'username': {'S': username},
-                'reason': {'S': reason}
-            }
-        )
-
-    def remove_role_from(self, user_id):
-        self.dynamodb.delete_item(
-            TableName=self.table_name,
-            Key={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)}
-            }
-        )
+    def get_blocklist_version(self):
+        # sha256 of the published list from the manifest, which unlike the ETag only changes with the content
+        now = time.monotonic()
+
+        if self.list_version_checked_at is None or now - self.list_version_checked_at >= LIST_VERSION_CHECK_INTERVAL:
+            try:
+                manifest = json.loads(
+                    self.s3.get_object(Bucket=self.output_bucket_name, Key=MANIFEST_KEY)['Body'].read()
+                )
+            except ClientError as e:
+                logging.error(e)
+                manifest = {}
+
+            versions = {artifact['key']: artifact['sha256'] for artifact in manifest.get('artifacts', [])}
+            self.list_version = versions.get(BLOCKLIST_KEY)
+
+            self.list_version_checked_at = now
+
+        return self.list_version
+
+    def bans(self, role):
+        return role
+
+    def candidates(self, user_ids):
+        # The snapshot only answers "not banned", bans are confirmed so that removals and reasons stay current
+        if self.snapshot is None:
+            return list(user_ids)
+
+        with self.spans.span('snapshot.lookup'):
+            return [user_id for user_id in user_ids if self.snapshot.lookup(user_id) is not False]
+
+    def role_from_item(self, item):
+        if item is None:
+            return False
+
+        reason = item.get('reason', {}).get('S')
+        return reason if reason else 'Ban predates listed reasons'
+
+    def role_item(self, user_id, username, reason):
+        return dict(super().role_item(user_id, username, reason), reason={'S': reason})
+
+    def changed(self, user_ids, added):
+        super().changed(user_ids, added)
+
+        if added and self.snapshot is not None:
+            for user_id in user_ids:
+                self.snapshot.add(user_id)
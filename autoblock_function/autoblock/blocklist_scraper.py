@@ -1,46 +1,168 @@
+from . import incremental
+from .export import EXPORTERS, MANIFEST_KEY, MultipartUploadWriter, build_manifest, export_all, load_manifest
+from .index_reader import IndexReader
+from .metrics import Metrics
+from .snapshot import SNAPSHOT_KEY
+from botocore.config import Config
+from contextlib import ExitStack
 import boto3
+import json
 import os
-import zipfile
 
 ROLE_TABLE_NAME = os.environ.get('ROLE_TABLE_NAME', 'Roles')
 ROLE_USERS_INDEX = os.environ.get('ROLE_USERS_INDEX', 'role_users')
 OUTPUT_BUCKET_NAME = os.environ.get('OUTPUT_BUCKET_NAME', 'output_bucket')
 BLACKLIST_KEY = 'autoblock_blacklist.zip'
-OUTPUT_ZIP = '/tmp/autoblock_blacklist.zip'
+# Published next to the base snapshot the incremental export needs. zip is what /getlist links to, and ids is the
+# snapshot the bot answers joins from.
+EXPORT_FORMATS = [name.strip() for name in os.environ.get('EXPORT_FORMATS', 'zip,ids,csv.gz,ndjson.gz').split(',')
+                  if name.strip()]
+# Key ranges of the index read at once, and the read capacity units per second the export may use, so that a large
+# export does not throttle the lookups the bot makes against the same table
+READ_CONCURRENCY = int(os.environ.get('EXPORT_READ_CONCURRENCY', '8'))
+READ_CAPACITY = float(os.environ.get('EXPORT_READ_CAPACITY', '400'))
+# Number of leading id digits the index is split on, 2 gives 90 ranges
+READ_KEY_DIGITS = int(os.environ.get('EXPORT_READ_KEY_DIGITS', '2'))
 
-dynamodb = boto3.client('dynamodb')
+dynamodb = boto3.client('dynamodb', config=Config(max_pool_connections=max(10, READ_CONCURRENCY)))
 s3 = boto3.client('s3')
+export_metrics = Metrics('AutoblockBot')
 
 
 def lambda_handler(event, context):
-    usernames = []
-
-    # Get all the users on the blacklist
-    paginator = dynamodb.get_paginator('query')
-    page_iterator = paginator.paginate(
-        TableName=ROLE_TABLE_NAME,
-        IndexName=ROLE_USERS_INDEX,
-        KeyConditionExpression='role_users_pk = :blacklist',
-        ExpressionAttributeValues={':blacklist': {'S': 'role_blacklist'}}
-    )
+    # The frequent schedule passes {"mode": "compact"}, the daily one rescans the index and checks the delta log
+    if event.get('mode') == 'compact':
+        compact()
+    else:
+        rescan()
+
+
+def stream_handler(event, context):
+    changes = incremental.changes_from_records(event.get('Records', []), 'blacklist')
+
+    if not changes:
+        return
+
+    key = incremental.write_delta(s3, OUTPUT_BUCKET_NAME, changes)
+    print("Wrote {} blocklist changes to {}".format(len(changes), key))
+
+
+def compact():
+    deltas = incremental.list_deltas(s3, OUTPUT_BUCKET_NAME)
+    base = incremental.open_base(s3, OUTPUT_BUCKET_NAME)
+
+    if base is None:
+        print("No base snapshot, falling back to a full rescan")
+        return rescan()
+
+    if not deltas:
+        base.close()
+        touch_snapshot(load_manifest(s3, OUTPUT_BUCKET_NAME))
+        print("No blocklist changes to compact")
+        return
+
+    changes = incremental.load_changes(s3, OUTPUT_BUCKET_NAME, deltas)
+    publish(incremental.merge(incremental.read_base(base), changes))
+    incremental.delete_deltas(s3, OUTPUT_BUCKET_NAME, deltas)
+
+    print("Compacted {} deltas with {} changed users".format(len(deltas), len(changes)))
+
+
+def rescan():
+    # Deltas listed before the scan are covered by it; later ones stay for the next compaction
+    deltas = incremental.list_deltas(s3, OUTPUT_BUCKET_NAME)
+    base = incremental.open_base(s3, OUTPUT_BUCKET_NAME)
+    entries = iter_role_entries('blacklist')
+    drift = None
+
+    if base is not None:
+        changes = incremental.load_changes(s3, OUTPUT_BUCKET_NAME, deltas)
+        drift = incremental.Drift(incremental.merge(incremental.read_base(base), changes))
+        entries = drift.check(entries)
+
+    publish(entries)
+    incremental.delete_deltas(s3, OUTPUT_BUCKET_NAME, deltas)
 
-    for page in page_iterator:
-        # No separate user ID field, might be worth it to create one instead of doing this.
-        usernames.extend(map(
-            lambda item: f"{item['username']['S']} ({item['pk']['S'].split('_')[-1]}) "
-                         f"{item.get('reason', {}).get('S')}",
-            page['Items']
+    if drift is not None:
+        print("Rescan differs from the incremental export by {} missing, {} unexpected and {} changed users".format(
+            drift.missing, drift.unexpected, drift.changed
         ))
+        export_metrics.count('BlocklistExportDrift', drift.count)
+        export_metrics.flush()
 
-    print("Found {} users in blocklist".format(len(usernames)))
 
-    usernames_txt = bytes('\n'.join(usernames) + '\n', 'utf-8')
+def publish(entries):
+    manifest = load_manifest(s3, OUTPUT_BUCKET_NAME)
+    previous = {artifact['key']: artifact['sha256'] for artifact in manifest.get('artifacts', [])}
+    writers = {}
 
-    # Compress it
-    with zipfile.ZipFile(OUTPUT_ZIP, 'w') as usernames_zip:
-        usernames_zip.writestr('usernames.txt', usernames_txt)
+    # Entries -> every format -> S3 parts in one pass, so memory use does not grow with the list. Artifacts that hash
+    # the same as the last published ones are not replaced.
+    with ExitStack() as stack:
+        for format_name in export_formats():
+            exporter = EXPORTERS[format_name]
+            writers[format_name] = stack.enter_context(MultipartUploadWriter(
+                s3, OUTPUT_BUCKET_NAME, exporter.key(),
+                content_type=exporter.content_type,
+                previous_sha256=previous.get(exporter.key())
+            ))
 
-    # Upload it to S3
-    s3.put_object(Bucket=OUTPUT_BUCKET_NAME, Key=BLACKLIST_KEY, Body=open(OUTPUT_ZIP, 'rb'))
+        count = export_all(entries, [EXPORTERS[format_name](writer) for format_name, writer in writers.items()])
+
+    print("Found {} users in blocklist".format(count))
+
+    skipped = [format_name for format_name, writer in writers.items() if writer.skipped]
+    if skipped:
+        print("Unchanged since the last export: {}".format(', '.join(skipped)))
+
+    # Partners poll the manifest, so it only changes when one of the artifacts did
+    current = build_manifest(count, writers)
+    if current != manifest:
+        s3.put_object(
+            Bucket=OUTPUT_BUCKET_NAME,
+            Key=MANIFEST_KEY,
+            Body=json.dumps(current, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    # Also for a snapshot just uploaded, which does not have its hash in the metadata yet
+    touch_snapshot(current)
 
     print("Successfully wrote to S3")
+
+
+def export_formats():
+    formats = ['base.jsonl.gz']
+
+    for format_name in EXPORT_FORMATS:
+        if format_name in EXPORTERS:
+            formats.append(format_name)
+        else:
+            print("Export format {} is not available".format(format_name))
+
+    return formats
+
+
+def touch_snapshot(manifest):
+    # The bot stops trusting a snapshot that looks old, so an unchanged list still gets a new modification time. The
+    # copy can change the ETag, so the bot tells snapshots apart by the sha256 in the metadata instead.
+    versions = {artifact['key']: artifact['sha256'] for artifact in manifest.get('artifacts', [])}
+    if SNAPSHOT_KEY not in versions:
+        return
+
+    s3.copy_object(
+        Bucket=OUTPUT_BUCKET_NAME,
+        Key=SNAPSHOT_KEY,
+        CopySource={'Bucket': OUTPUT_BUCKET_NAME, 'Key': SNAPSHOT_KEY},
+        MetadataDirective='REPLACE',
+        Metadata={'sha256': versions[SNAPSHOT_KEY]},
+        ContentType='application/octet-stream'
+    )
+
+
+def iter_role_entries(role_name):
+    # Items are reduced to entries on the reader threads, so pages waiting their turn stay small
+    reader = IndexReader(dynamodb, ROLE_TABLE_NAME, ROLE_USERS_INDEX, READ_CONCURRENCY, READ_CAPACITY, READ_KEY_DIGITS)
+    yield from reader.read('role_{}'.format(role_name), incremental.entry_from_item)
+
+    print("Read the {} index using {} read capacity units".format(role_name, reader.consumed))
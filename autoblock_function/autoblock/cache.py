@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Sentinel for lookups that are not in the cache, since False is a valid (negative) cached answer
+MISSING = object()
+
+
+class RoleCache:
+    def __init__(self, max_size=4096, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, role_name, user_id):
+        key = (role_name, int(user_id))
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, role_name, user_id):
+        # Like get, without counting towards the stats or the eviction order
+        with self._lock:
+            entry = self._entries.get((role_name, int(user_id)))
+            return entry[1] if entry is not None and entry[0] > self.clock() else MISSING
+
+    def put(self, role_name, user_id, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+
+        key = (role_name, int(user_id))
+
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, role_name, user_id):
+        with self._lock:
+            self._entries.pop((role_name, int(user_id)), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
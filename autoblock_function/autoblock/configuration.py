@@ -0,0 +1,105 @@
+from .spans import NO_SPANS
+import threading
+import time
+
+
+class Config:
+    # One loaded set of parameters, /autoblock_bot/bot_key = SECRET_KEY => config['bot_key'] == 'SECRET_KEY'
+    def __init__(self, values, version):
+        self.values = values
+        self.version = version
+        self.admins = frozenset(int(user_id) for user_id in values.get('root_users', []))
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+
+class ConfigStore:
+    # The first load blocks whoever needs the config. After that, a config older than the ttl is refreshed on the
+    # executor while the current one keeps being served, and a failed refresh leaves the current one in place.
+    def __init__(self, ssm, path, expected, ttl=300, executor=None, clock=time.monotonic, spans=NO_SPANS):
+        self.ssm = ssm
+        self.spans = spans
+        self.path = path
+        self.expected = expected
+        self.ttl = ttl
+        self.executor = executor
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.current = None
+        self.loaded_at = None
+        self.refreshing = False
+
+    def get(self):
+        if self.current is None:
+            with self._lock:
+                if self.current is None:
+                    print('Loading config from {}'.format(self.path))
+                    self.load(self.spans)
+
+            return self.current
+
+        if self.clock() - self.loaded_at >= self.ttl and not self.refreshing:
+            self.refreshing = True
+
+            # A background refresh outlives the invocation that started it, so it stays out of the invocation's spans
+            if self.executor is not None:
+                self.executor.submit(self.refresh)
+            else:
+                self.refresh(self.spans)
+
+        return self.current
+
+    def refresh(self, spans=NO_SPANS):
+        try:
+            with self._lock:
+                self.load(spans)
+        except Exception as e:
+            print('Unable to refresh config, keeping the current one: {}'.format(e))
+            self.loaded_at = self.clock()
+        finally:
+            self.refreshing = False
+
+    def load(self, spans):
+        parameters = []
+        params = {'Path': self.path}
+
+        while True:
+            with spans.span('ssm.get_parameters_by_path'):
+                response = self.ssm.get_parameters_by_path(**params)
+
+            parameters.extend(response['Parameters'])
+
+            if not response.get('NextToken'):
+                break
+
+            params['NextToken'] = response['NextToken']
+
+        # A parameter's version moves forward whenever its value changes, so the names and versions identify the config
+        version = tuple(sorted((item['Name'], item.get('Version')) for item in parameters))
+        loaded_at = self.clock()
+
+        if self.current is not None and self.current.version == version:
+            self.loaded_at = loaded_at
+            return
+
+        values = {
+            item['Name'].split('/')[-1]: item['Value'].split(',') if item['Type'] == 'StringList'
+            else item['Value'] for item in parameters
+        }
+
+        for key in self.expected:
+            if key not in values:
+                raise Exception("Expected key {} not found in config".format(key))
+
+        self.current = Config(values, version)
+        self.loaded_at = loaded_at
+
+        # Names only, the values include the bot key and api_hash
+        print('Loaded config: {}, {} admins'.format(', '.join(sorted(values)), len(self.current.admins)))
@@ -0,0 +1,72 @@
+import threading
+
+
+class DocumentCache:
+    # Telegram file_ids of documents a bot has already uploaded, stored against the version of the file they were
+    # sent from. file_ids are only valid for the bot that received them, so entries are kept per bot.
+    def __init__(self, table_name, dynamodb):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self.hits = 0
+            self.misses = 0
+
+    def lookup(self, bot_id, name, version):
+        with self._lock:
+            entry = self.entries.get((bot_id, name))
+
+        if entry is None or entry[0] != version:
+            entry = self.load(bot_id, name)
+
+            if entry is not None:
+                with self._lock:
+                    self.entries[(bot_id, name)] = entry
+
+        with self._lock:
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            return None
+
+    def remember(self, bot_id, name, version, file_id):
+        with self._lock:
+            self.entries[(bot_id, name)] = (version, file_id)
+
+        self.store(bot_id, name, version, file_id)
+
+    def invalidate(self, bot_id, name):
+        with self._lock:
+            self.entries.pop((bot_id, name), None)
+
+        self.dynamodb.delete_item(TableName=self.table_name, Key=self.key(bot_id, name))
+
+    def key(self, bot_id, name):
+        return {
+            'pk': {'S': 'document_{}'.format(name)},
+            'sk': {'S': 'bot_{}'.format(bot_id)}
+        }
+
+    def load(self, bot_id, name):
+        item = self.dynamodb.get_item(TableName=self.table_name, Key=self.key(bot_id, name)).get('Item')
+
+        if item is None:
+            return None
+
+        return item['version']['S'], item['file_id']['S']
+
+    def store(self, bot_id, name, version, file_id):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item=dict(self.key(bot_id, name), version={'S': version}, file_id={'S': file_id})
+        )
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
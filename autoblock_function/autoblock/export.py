@@ -0,0 +1,299 @@
+from .incremental import BASE_KEY
+from .snapshot import IdCollector
+from botocore.exceptions import ClientError
+import csv
+import gzip
+import hashlib
+import io
+import json
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, the csv.zst format is only offered when it is installed
+    zstandard = None
+
+# S3 requires every part but the last to be at least 5 MiB
+PART_SIZE = 8 * 1024 * 1024
+# Lines are handed to the compressor in chunks of about this size instead of one write per line
+CHUNK_SIZE = 64 * 1024
+KEY_PREFIX = 'autoblock_blacklist.'
+MANIFEST_KEY = KEY_PREFIX + 'manifest.json'
+# Fixed timestamps, so that an unchanged list produces byte for byte the same artifacts
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class MultipartUploadWriter:
+    # Write-only file object that streams to S3, holding at most one part in memory. Objects smaller than a part are
+    # sent with a single put_object on close instead.
+    # When the content hashes to previous_sha256 the object is left as it is, and `skipped` is set. Whether it changed is
+    # only known once all of it is written, so parts of a large artifact are sent and then discarded, rather than the
+    # artifact being kept in memory or /tmp until then. Artifacts smaller than a part are not sent at all.
+    def __init__(self, s3, bucket_name, key, part_size=PART_SIZE, content_type='application/octet-stream',
+                 previous_sha256=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.content_type = content_type
+        self.previous_sha256 = previous_sha256
+        self.sha256 = hashlib.sha256()
+        self.skipped = False
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        self.sha256.update(data)
+
+        # Parts may run over the part size by one write, which avoids copying the buffer to split it
+        if len(self.buffer) >= self.part_size:
+            self.upload_part(self.buffer)
+            self.buffer = bytearray()
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, ContentType=self.content_type
+            )['UploadId']
+
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self.sha256.hexdigest() == self.previous_sha256:
+            # Parts already sent are discarded, the current object keeps its ETag and modification time
+            self.abort()
+            self.skipped = True
+        elif self.upload_id is None:
+            self.s3.put_object(
+                Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type
+            )
+        else:
+            if self.buffer:
+                self.upload_part(self.buffer)
+
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts}
+            )
+
+        self.buffer = bytearray()
+
+    def abort(self):
+        self.closed = True
+        self.buffer = bytearray()
+
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Exporter:
+    # Receives every entry of the list in index order and writes one artifact to `output`
+    format_name = None
+    content_type = 'application/octet-stream'
+
+    def __init__(self, output):
+        self.output = output
+
+    @classmethod
+    def key(cls):
+        return KEY_PREFIX + cls.format_name
+
+    def add(self, entry):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class TextExporter(Exporter):
+    # Encodes text into chunks for a compressed stream opened by the subclass
+    def __init__(self, output):
+        super().__init__(output)
+        self.chunk = io.StringIO()
+
+    def write(self, text):
+        self.chunk.write(text)
+
+        if self.chunk.tell() >= CHUNK_SIZE:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        self.stream.write(self.chunk.getvalue().encode('utf-8'))
+        self.chunk = io.StringIO()
+
+    def close(self):
+        self.flush_chunk()
+        self.stream.close()
+
+
+class ZipExporter(TextExporter):
+    # The original free text list
+    format_name = 'zip'
+    content_type = 'application/zip'
+
+    def __init__(self, output):
+        super().__init__(output)
+        info = zipfile.ZipInfo('usernames.txt', date_time=ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+
+        # The archive is written front to back, so the output does not need to be seekable
+        self.archive = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.stream = self.archive.open(info, 'w', force_zip64=True)
+
+    def add(self, entry):
+        user_id, username, reason = entry
+        self.write(f"{username} ({user_id}) {reason}\n")
+
+    def close(self):
+        super().close()
+        self.archive.close()
+
+
+class IdsExporter(Exporter):
+    # Sorted little endian uint64 ids, also the snapshot the bot checks joins against
+    format_name = 'ids'
+
+    def __init__(self, output):
+        super().__init__(output)
+        self.user_ids = IdCollector()
+
+    def add(self, entry):
+        self.user_ids.add(entry[0])
+
+    def close(self):
+        self.user_ids.write_to(self.output)
+
+
+class CsvExporter(TextExporter):
+    format_name = 'csv.gz'
+    content_type = 'application/gzip'
+
+    def __init__(self, output):
+        super().__init__(output)
+        self.stream = self.open_stream(output)
+        self.writer = csv.writer(self, lineterminator='\n')
+        self.writer.writerow(['user_id', 'username', 'reason'])
+
+    def open_stream(self, output):
+        return gzip.GzipFile(fileobj=output, mode='wb', mtime=0)
+
+    def add(self, entry):
+        self.writer.writerow(entry)
+
+
+class ZstdCsvExporter(CsvExporter):
+    format_name = 'csv.zst'
+    content_type = 'application/zstd'
+
+    def open_stream(self, output):
+        return zstandard.ZstdCompressor().stream_writer(output, closefd=False)
+
+
+class NdjsonExporter(TextExporter):
+    format_name = 'ndjson.gz'
+    content_type = 'application/gzip'
+
+    def __init__(self, output):
+        super().__init__(output)
+        self.stream = gzip.GzipFile(fileobj=output, mode='wb', mtime=0)
+
+    def add(self, entry):
+        user_id, username, reason = entry
+        self.write(json.dumps({'user_id': user_id, 'username': username, 'reason': reason}) + '\n')
+
+
+class BaseExporter(TextExporter):
+    # Input for the next incremental compaction, see incremental.py
+    format_name = 'base.jsonl.gz'
+    content_type = 'application/gzip'
+
+    @classmethod
+    def key(cls):
+        return BASE_KEY
+
+    def __init__(self, output):
+        super().__init__(output)
+        self.stream = gzip.GzipFile(fileobj=output, mode='wb', mtime=0)
+
+    def add(self, entry):
+        self.write(json.dumps(list(entry)) + '\n')
+
+
+EXPORTERS = {
+    exporter.format_name: exporter
+    for exporter in [BaseExporter, ZipExporter, IdsExporter, CsvExporter, ZstdCsvExporter, NdjsonExporter]
+    if exporter is not ZstdCsvExporter or zstandard is not None
+}
+
+
+def export_all(entries, exporters):
+    # A single pass over the entries feeds every exporter
+    count = 0
+
+    for entry in entries:
+        for exporter in exporters:
+            exporter.add(entry)
+        count += 1
+
+    for exporter in exporters:
+        exporter.close()
+
+    return count
+
+
+def load_manifest(s3, bucket_name):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket_name, Key=MANIFEST_KEY)['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+
+    return {}
+
+
+def build_manifest(count, writers):
+    return {
+        'count': count,
+        'artifacts': [{
+            'format': format_name,
+            'key': writer.key,
+            'content_type': writer.content_type,
+            'size': writer.position,
+            'sha256': writer.sha256.hexdigest()
+        } for format_name, writer in writers.items()]
+    }
@@ -0,0 +1,88 @@
+from .roles import BATCH_GET_LIMIT
+import csv
+
+COLUMNS = ['id', 'username', 'reason']
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.added = 0
+        self.existing = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def summary(self):
+        return 'Read {} rows: {} added, {} already listed, {} duplicates, {} invalid.'.format(
+            self.rows, self.added, self.existing, self.duplicates, self.invalid
+        )
+
+
+def read_entries(lines, result, default_reason=None, requires_reason=True):
+    # Yields (user_id, username, reason) from CSV lines as they are read. A header row is optional, with one the columns
+    # are found by name, so scrape_room.py output can be imported as is. Without one they are id, username, reason.
+    columns = {name: index for index, name in enumerate(COLUMNS)}
+    first = True
+
+    for row in csv.reader(lines):
+        if not any(field.strip() for field in row):
+            continue
+
+        if first:
+            first = False
+            names = [field.strip().lower() for field in row]
+
+            if 'id' in names:
+                columns = {name: names.index(name) for name in COLUMNS if name in names}
+                continue
+
+        result.rows += 1
+        fields = {name: row[index].strip() if index < len(row) else '' for name, index in columns.items()}
+
+        try:
+            user_id = int(fields['id'])
+        except ValueError:
+            result.invalid += 1
+            continue
+
+        reason = fields.get('reason') or default_reason
+        username = fields.get('username', '').lstrip('@')
+
+        if user_id <= 0 or (requires_reason and not reason):
+            result.invalid += 1
+            continue
+
+        # Stored the way /add stores mentions
+        yield user_id, '@' + username if username else '', reason
+
+
+def import_entries(handler, entries, result, batch_size=BATCH_GET_LIMIT):
+    # Each batch is checked with one BatchGetItem and only the new users are written, so an import can be run again
+    # after an interruption without duplicating or overwriting anything
+    seen = set()
+    batch = []
+
+    def flush():
+        existing = handler.has_roles([user_id for user_id, _, _ in batch])
+        added = [entry for entry in batch if not existing[entry[0]]]
+
+        handler.add_roles_to(added)
+        result.added += len(added)
+        result.existing += len(batch) - len(added)
+        batch.clear()
+
+    for entry in entries:
+        if entry[0] in seen:
+            result.duplicates += 1
+            continue
+
+        seen.add(entry[0])
+        batch.append(entry)
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return result
@@ -0,0 +1,160 @@
+from botocore.exceptions import ClientError
+import gzip
+import json
+
+# Every blocklist entry as of the last compaction or rescan, one JSON array per line in role index order
+BASE_KEY = 'autoblock_blacklist.base.jsonl.gz'
+# One object per batch of stream records, named after its sequence numbers so that listing returns them in order
+DELTA_PREFIX = 'autoblock_blacklist.delta/'
+
+
+def entry_from_item(item):
+    # Query results and stream images share the same attribute value format
+    return int(item['pk']['S'].split('_')[-1]), item['username']['S'], item.get('reason', {}).get('S')
+
+
+def sort_key(entry):
+    # The order role_users_sk puts users in
+    return 'user_{}'.format(entry[0])
+
+
+def changes_from_records(records, role_name):
+    changes = []
+
+    for record in records:
+        keys = record['dynamodb']['Keys']
+        if keys['sk']['S'] != 'role_{}'.format(role_name):
+            continue
+
+        change = {'seq': record['dynamodb']['SequenceNumber'], 'user_id': int(keys['pk']['S'].split('_')[-1])}
+
+        if record['eventName'] == 'REMOVE':
+            change['op'] = 'remove'
+        else:
+            _, change['username'], change['reason'] = entry_from_item(record['dynamodb']['NewImage'])
+            change['op'] = 'add'
+
+        changes.append(change)
+
+    return changes
+
+
+def delta_key(changes):
+    return '{}{:0>40}-{:0>40}.jsonl'.format(DELTA_PREFIX, changes[0]['seq'], changes[-1]['seq'])
+
+
+def write_delta(s3, bucket_name, changes):
+    # A retried batch has the same sequence numbers, so it overwrites its own delta instead of adding another
+    key = delta_key(changes)
+
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=''.join(json.dumps(change) + '\n' for change in changes).encode('utf-8'),
+        ContentType='application/x-ndjson'
+    )
+
+    return key
+
+
+def list_deltas(s3, bucket_name):
+    keys = []
+
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=DELTA_PREFIX):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+
+    return sorted(keys)
+
+
+def load_changes(s3, bucket_name, keys):
+    # Final state of every user touched by the deltas, None for users that were removed
+    changes = {}
+
+    for key in keys:
+        body = s3.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode('utf-8')
+
+        for line in body.splitlines():
+            change = json.loads(line)
+
+            if change['op'] == 'remove':
+                changes[change['user_id']] = None
+            else:
+                changes[change['user_id']] = (change['user_id'], change['username'], change['reason'])
+
+    return changes
+
+
+def delete_deltas(s3, bucket_name, keys):
+    # Oldest first: if this stops part way, only newer changes are left behind, and replaying those is harmless
+    for key in keys:
+        s3.delete_object(Bucket=bucket_name, Key=key)
+
+
+def open_base(s3, bucket_name):
+    try:
+        return s3.get_object(Bucket=bucket_name, Key=BASE_KEY)['Body']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+
+    return None
+
+
+def read_base(body):
+    with gzip.GzipFile(fileobj=body) as base:
+        for line in base:
+            user_id, username, reason = json.loads(line)
+            yield user_id, username, reason
+
+
+def merge(entries, changes):
+    # Applies the changes to entries in index order without loading them, changed users are emitted at their new place
+    added = sorted((entry for entry in changes.values() if entry is not None), key=sort_key)
+    position = 0
+
+    for entry in entries:
+        key = sort_key(entry)
+
+        while position < len(added) and sort_key(added[position]) <= key:
+            yield added[position]
+            position += 1
+
+        if entry[0] not in changes:
+            yield entry
+
+    yield from added[position:]
+
+
+class Drift:
+    # Compares a rescan with what the base snapshot and delta log say the list should be, as both stream past
+    def __init__(self, expected):
+        self.expected = iter(expected)
+        self.next_expected = next(self.expected, None)
+        self.missing = 0
+        self.unexpected = 0
+        self.changed = 0
+
+    @property
+    def count(self):
+        return self.missing + self.unexpected + self.changed
+
+    def check(self, entries):
+        for entry in entries:
+            key = sort_key(entry)
+
+            while self.next_expected is not None and sort_key(self.next_expected) < key:
+                self.missing += 1
+                self.next_expected = next(self.expected, None)
+
+            if self.next_expected is not None and self.next_expected[0] == entry[0]:
+                if tuple(self.next_expected) != tuple(entry):
+                    self.changed += 1
+                self.next_expected = next(self.expected, None)
+            else:
+                self.unexpected += 1
+
+            yield entry
+
+        while self.next_expected is not None:
+            self.missing += 1
+            self.next_expected = next(self.expected, None)
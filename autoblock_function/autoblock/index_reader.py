@@ -0,0 +1,138 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+
+
+def key_ranges(prefix='user_', digits=2):
+    # Consecutive BETWEEN ranges that split "user_<id>" keys by their leading digits. The bounds end in ':', which sorts
+    # after every digit, so no key ever equals a bound and each key falls in exactly one range.
+    bounds = [prefix] + ['{}{}:'.format(prefix, leading) for leading in range(10 ** (digits - 1), 10 ** digits)]
+    bounds[-1] = prefix + ':'
+
+    return list(zip(bounds, bounds[1:]))
+
+
+class CapacityLimiter:
+    # Token bucket over consumed read capacity units. A page's cost is only known once it has been read, so it is paid
+    # afterwards and the next request waits until the bucket is out of debt.
+    def __init__(self, units_per_second, clock=time.monotonic, sleep=time.sleep):
+        self.units_per_second = units_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.available = units_per_second
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.available = min(self.units_per_second, self.available + (now - self.updated_at) * self.units_per_second)
+        self.updated_at = now
+
+    def wait(self):
+        while True:
+            with self._lock:
+                self.refill()
+                if self.available >= 0:
+                    return
+                delay = -self.available / self.units_per_second
+
+            self.sleep(delay)
+
+    def consume(self, units):
+        with self._lock:
+            self.refill()
+            self.available -= units
+
+
+class IndexReader:
+    def __init__(self, dynamodb, table_name, index_name, concurrency=8, units_per_second=None, digits=2,
+                 buffered_pages=4):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.index_name = index_name
+        self.concurrency = concurrency
+        self.limiter = CapacityLimiter(units_per_second) if units_per_second else None
+        self.digits = digits
+        self.buffered_pages = buffered_pages
+        self.consumed = 0
+        self._lock = threading.Lock()
+
+    def query_range(self, partition_value, lower, upper, transform, pages, stopped):
+        # Feeds pages of results into the range's queue and ends with None, blocking while the queue is full
+        params = {
+            'TableName': self.table_name,
+            'IndexName': self.index_name,
+            'KeyConditionExpression': 'role_users_pk = :role AND role_users_sk BETWEEN :lower AND :upper',
+            'ExpressionAttributeValues': {
+                ':role': {'S': partition_value},
+                ':lower': {'S': lower},
+                ':upper': {'S': upper}
+            },
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+
+        try:
+            while not stopped.is_set():
+                if self.limiter is not None:
+                    self.limiter.wait()
+
+                response = self.dynamodb.query(**params)
+                units = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+
+                if self.limiter is not None:
+                    self.limiter.consume(units)
+                with self._lock:
+                    self.consumed += units
+
+                put(pages, [transform(item) for item in response['Items']], stopped)
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+
+                params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        finally:
+            put(pages, None, stopped)
+
+    def read(self, partition_value, transform=lambda item: item):
+        # Ranges are read concurrently but yielded strictly in key order, so the output is identical to a single
+        # sequential query. Ranges ahead of the one being yielded stop after a few pages, which keeps memory bounded
+        # however the keys are spread over the ranges.
+        ranges = deque(key_ranges(digits=self.digits))
+        pending = deque()
+        stopped = threading.Event()
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            def submit_next():
+                lower, upper = ranges.popleft()
+                pages = queue.Queue(self.buffered_pages)
+                future = executor.submit(self.query_range, partition_value, lower, upper, transform, pages, stopped)
+                pending.append((future, pages))
+
+            try:
+                while ranges and len(pending) < self.concurrency:
+                    submit_next()
+
+                while pending:
+                    future, pages = pending[0]
+
+                    for page in iter(pages.get, None):
+                        yield from page
+
+                    pending.popleft()
+                    future.result()
+
+                    if ranges:
+                        submit_next()
+            finally:
+                stopped.set()
+
+
+def put(pages, page, stopped):
+    while not stopped.is_set():
+        try:
+            pages.put(page, timeout=0.1)
+            return
+        except queue.Full:
+            pass
@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+
+# CloudWatch accepts at most this many metrics per EMF document or put_metric_data call
+MAX_METRICS_PER_FLUSH = 100
+
+
+class Metrics:
+    def __init__(self, namespace, mode='emf', cloudwatch=None):
+        self.namespace = namespace
+        self.mode = mode
+        self.cloudwatch = cloudwatch
+        self._lock = threading.Lock()
+        self.begin()
+
+    def begin(self, **dimensions):
+        with self._lock:
+            self.dimensions = {}
+            self.counts = {}
+            self.timings = {}
+
+        self.set_dimensions(**dimensions)
+
+    def set_dimensions(self, **dimensions):
+        with self._lock:
+            self.dimensions.update({name: str(value) for name, value in dimensions.items() if value is not None})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def timing(self, name, milliseconds):
+        with self._lock:
+            self.timings.setdefault(name, []).append(milliseconds)
+
+    def flush(self):
+        with self._lock:
+            counts, timings, dimensions = self.counts, self.timings, self.dimensions
+            self.counts, self.timings = {}, {}
+
+        metrics = [(name, 'Count', [float(value)]) for name, value in counts.items()] + \
+                  [(name, 'Milliseconds', values) for name, values in timings.items()]
+
+        for start in range(0, len(metrics), MAX_METRICS_PER_FLUSH):
+            if self.mode == 'api':
+                self.put_metric_data(metrics[start:start + MAX_METRICS_PER_FLUSH], dimensions)
+            else:
+                print(self.emf_document(metrics[start:start + MAX_METRICS_PER_FLUSH], dimensions))
+
+    def emf_document(self, metrics, dimensions):
+        # The empty dimension set keeps publishing the undimensioned series existing alarms are built on
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[], sorted(dimensions)] if dimensions else [[]],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in metrics]
+                }]
+            }
+        }
+        document.update(dimensions)
+        document.update({name: values if len(values) > 1 else values[0] for name, _, values in metrics})
+
+        return json.dumps(document)
+
+    def put_metric_data(self, metrics, dimensions):
+        metric_data = []
+
+        for name, unit, values in metrics:
+            datum = {'MetricName': name, 'Values': values, 'Unit': unit}
+            metric_data.append(datum)
+
+            if dimensions:
+                metric_data.append(dict(datum, Dimensions=[
+                    {'Name': key, 'Value': value} for key, value in sorted(dimensions.items())
+                ]))
+
+        # Each datum is sent once without and once with dimensions, so split to stay under the call limit
+        for start in range(0, len(metric_data), MAX_METRICS_PER_FLUSH):
+            self.cloudwatch.put_metric_data(
+                Namespace=self.namespace,
+                MetricData=metric_data[start:start + MAX_METRICS_PER_FLUSH]
+            )
@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import json
+import os
+import time
+
+COLUMNS = ['id', 'username', 'first_name', 'last_name']
+# Largest page channels.getParticipants returns
+PAGE_SIZE = 200
+
+
+def member_row(member):
+    return [member.id] + [getattr(member, column) or '' for column in COLUMNS[1:]]
+
+
+class CsvOutput:
+    extension = 'csv'
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.writer(stream, lineterminator='\n')
+
+    def header(self):
+        self.writer.writerow(COLUMNS)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    @staticmethod
+    def read_ids(stream):
+        reader = csv.reader(stream)
+        next(reader, None)
+        return {int(row[0]) for row in reader if row}
+
+
+class NdjsonOutput:
+    extension = 'ndjson'
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def header(self):
+        pass
+
+    def write(self, row):
+        self.stream.write(json.dumps(dict(zip(COLUMNS, row))) + '\n')
+
+    @staticmethod
+    def read_ids(stream):
+        return {json.loads(line)['id'] for line in stream if line.strip()}
+
+
+OUTPUTS = {output.extension: output for output in [CsvOutput, NdjsonOutput]}
+
+
+class Checkpoint:
+    # Where a scrape got to: the participant offset to ask for next, and how much of the output file belongs to the
+    # pages before it. Anything past that was written after the last checkpoint and is cut off on resume.
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.position = 0
+        self.rows = 0
+        self.done = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+
+        self.offset, self.position, self.rows, self.done = \
+            state['offset'], state['position'], state['rows'], state.get('done', False)
+        return True
+
+    def save(self):
+        # Written to the side and renamed, so an interruption never leaves a half written checkpoint
+        temporary_path = self.path + '.tmp'
+
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({'offset': self.offset, 'position': self.position, 'rows': self.rows, 'done': self.done},
+                      checkpoint_file)
+
+        os.replace(temporary_path, self.path)
+
+
+class RateLimiter:
+    # Spaces requests evenly at `rate` per second across every room sharing the limiter
+    def __init__(self, rate, clock=time.monotonic):
+        self.interval = 1 / rate
+        self.clock = clock
+        self.next_at = clock()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            delay = self.next_at - self.clock()
+            self.next_at = max(self.next_at, self.clock()) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        # Called on a flood wait, which Telegram applies to the whole account rather than the one request
+        self.next_at = max(self.next_at, self.clock() + seconds)
+
+
+class Progress:
+    def __init__(self, interval=5, clock=time.monotonic, output=print):
+        self.interval = interval
+        self.clock = clock
+        self.output = output
+        self.started_at = clock()
+        self.reported_at = self.started_at
+        self.rooms = {}
+
+    def update(self, room, rows, total=None):
+        self.rooms[room] = (rows, total)
+
+        if self.clock() - self.reported_at >= self.interval:
+            self.report()
+
+    def report(self):
+        self.reported_at = self.clock()
+        elapsed = max(self.reported_at - self.started_at, 1e-9)
+        rows = sum(rows for rows, _ in self.rooms.values())
+
+        rooms = ', '.join(
+            '{} {}{}'.format(room, room_rows, '/{}'.format(total) if total else '')
+            for room, (room_rows, total) in sorted(self.rooms.items())
+        )
+        self.output('{} members in {:.0f}s ({:.0f}/s): {}'.format(rows, elapsed, rows / elapsed, rooms))
+
+
+async def scrape(room, fetch_page, output_path, checkpoint, limiter, progress, output_format='csv',
+                 page_size=PAGE_SIZE):
+    # fetch_page(offset, limit) returns (members, total member count or None), with no members at the end of the
+    # list. Members already written are skipped, since joins and leaves shift offsets between pages.
+    output_class = OUTPUTS[output_format]
+    resumed = checkpoint.load()
+
+    if checkpoint.done:
+        progress.update(room, checkpoint.rows, checkpoint.rows)
+        return checkpoint.rows
+
+    seen = set()
+    if resumed and os.path.exists(output_path):
+        with open(output_path, 'r+', encoding='utf-8', newline='') as stream:
+            stream.truncate(checkpoint.position)
+            stream.seek(0)
+            seen = output_class.read_ids(stream)
+    else:
+        resumed = False
+        checkpoint.offset = checkpoint.position = checkpoint.rows = 0
+
+    with open(output_path, 'a' if resumed else 'w', encoding='utf-8', newline='') as stream:
+        output = output_class(stream)
+        if not resumed:
+            output.header()
+
+        while True:
+            await limiter.wait()
+            members, total = await fetch_page(checkpoint.offset, page_size)
+
+            if not members:
+                break
+
+            for member in members:
+                if member.id not in seen:
+                    seen.add(member.id)
+                    output.write(member_row(member))
+                    checkpoint.rows += 1
+
+            stream.flush()
+            checkpoint.offset += len(members)
+            checkpoint.position = stream.tell()
+            checkpoint.save()
+            progress.update(room, checkpoint.rows, total)
+
+    checkpoint.done = True
+    checkpoint.save()
+    progress.update(room, checkpoint.rows, checkpoint.rows)
+    return checkpoint.rows
@@ -0,0 +1,93 @@
+from collections import Counter
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+# Lines of each report printed to the log, the full profile is in the dumped file
+REPORT_LINES = 25
+
+
+class FunctionProfiler:
+    # cProfile sees only the thread that enabled it, which is where the event loop and its coroutines run. Work handed
+    # to the I/O pool shows up as time waiting on it, use the sampling profiler to see inside those calls.
+    def __init__(self, path):
+        self.path = path + '.pstats'
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+
+        report = io.StringIO()
+        pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(REPORT_LINES)
+        print('Profile written to {}\n{}'.format(self.path, report.getvalue()))
+
+
+class SamplingProfiler:
+    # Samples the stacks of every thread at a fixed interval, and writes them in the folded format flame graph tools
+    # read: "outer;inner;innermost count" per line
+    def __init__(self, path, interval=0.005):
+        self.path = path + '.folded'
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def sample(self):
+        own_id = threading.get_ident()
+
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append('{} ({}:{})'.format(
+                        frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno
+                    ))
+                    frame = frame.f_back
+
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+        with open(self.path, 'w') as output:
+            for stack, count in self.stacks.most_common():
+                output.write('{} {}\n'.format(stack, count))
+
+        # Innermost frames, where the samples were actually taken
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+
+        lines = ['{:>6} {}'.format(count, leaf) for leaf, count in leaves.most_common(REPORT_LINES)]
+        print('Profile written to {}, {} samples\n{}'.format(self.path, sum(self.stacks.values()), '\n'.join(lines)))
+
+
+PROFILERS = {
+    'cprofile': FunctionProfiler,
+    'sample': SamplingProfiler
+}
+
+
+def start(mode, output_dir, name=None):
+    # Returns the started profiler for the mode, or None when profiling is off
+    if mode not in PROFILERS:
+        return None
+
+    profiler = PROFILERS[mode](os.path.join(output_dir, 'profile_{}'.format(name or int(time.time() * 1000))))
+    profiler.start()
+    return profiler
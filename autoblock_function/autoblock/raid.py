@@ -0,0 +1,146 @@
+from botocore.exceptions import ClientError
+from collections import OrderedDict, deque
+from .spans import NO_SPANS
+import threading
+import time
+
+
+class ChatState:
+    def __init__(self):
+        self.joins = deque()
+        self.join_count = 0
+        self.raiding = False
+        self.last_notice = None
+        self.pending_failures = []
+        # Failures past max_pending, reported as a count
+        self.pending_overflow = 0
+
+
+class SharedJoinWindow:
+    # Lambda spreads a raid's joins over many containers, so each one alone may never see the threshold. The counts
+    # are added up in one item per chat, with an attribute per window-sized slot. The window is estimated from the
+    # current slot and the part of the previous one that still falls inside it. Each update removes the slot before
+    # that, and the item expires once the chat has been quiet for two windows.
+    def __init__(self, table_name, dynamodb, window=60, clock=time.time, spans=NO_SPANS):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+        self.window = window
+        self.clock = clock
+        self.spans = spans
+
+    def add(self, chat_id, count):
+        # Returns the estimated number of joins in the chat over the last window, including these
+        now = self.clock()
+        slot = int(now // self.window)
+
+        with self.spans.span('dynamodb.update_item'):
+            response = self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={
+                    'pk': {'S': 'raid_{}'.format(chat_id)},
+                    'sk': {'S': 'joins'}
+                },
+                UpdateExpression='ADD #current :count SET expires_at = :expires_at REMOVE #stale',
+                ExpressionAttributeNames={
+                    '#current': 'joins_{}'.format(slot),
+                    '#stale': 'joins_{}'.format(slot - 2)
+                },
+                ExpressionAttributeValues={
+                    ':count': {'N': str(count)},
+                    ':expires_at': {'N': str(int(now) + 2 * self.window)}
+                },
+                ReturnValues='ALL_NEW'
+            )
+
+        attributes = response['Attributes']
+        current = int(attributes['joins_{}'.format(slot)]['N'])
+        previous = int(attributes.get('joins_{}'.format(slot - 1), {'N': '0'})['N'])
+
+        return current + previous * (1 - (now - slot * self.window) / self.window)
+
+
+class RaidDetector:
+    def __init__(self, threshold=20, window=60, notice_interval=60, max_chats=1024, max_pending=100,
+                 clock=time.monotonic, shared=None):
+        self.threshold = threshold
+        self.window = window
+        self.notice_interval = notice_interval
+        self.max_chats = max_chats
+        self.max_pending = max_pending
+        self.clock = clock
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.chats = OrderedDict()
+
+    def chat(self, chat_id):
+        state = self.chats.get(chat_id)
+
+        if state is None:
+            state = self.chats[chat_id] = ChatState()
+
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+
+        return state
+
+    def record_joins(self, chat_id, count):
+        # Sliding window of join counts per chat; returns (raiding, started) for this chat after the joins. The shared
+        # window is used when there is one, and the container's own joins if it cannot be reached.
+        shared_count = None
+
+        if self.shared is not None:
+            try:
+                shared_count = self.shared.add(chat_id, count)
+            except ClientError as e:
+                print('Unable to count joins in chat {}: {}'.format(chat_id, e))
+
+        now = self.clock()
+
+        with self._lock:
+            state = self.chat(chat_id)
+            state.joins.append((now, count))
+            state.join_count += count
+
+            while state.joins and state.joins[0][0] <= now - self.window:
+                state.join_count -= state.joins.popleft()[1]
+
+            was_raiding = state.raiding
+            state.raiding = (state.join_count if shared_count is None else shared_count) >= self.threshold
+
+            return state.raiding, state.raiding and not was_raiding
+
+    def add_failures(self, chat_id, usernames, hold=True):
+        # Returns (usernames, more) to report now, where more counts failures past max_pending. With hold, as during a
+        # raid, failures are held back until notice_interval has passed since the last notice. Anything held back is
+        # reported by the first call after that, so a raid that ends, or a later update with no failures, flushes it.
+        now = self.clock()
+
+        with self._lock:
+            if not usernames and chat_id not in self.chats:
+                return [], 0
+
+            state = self.chat(chat_id)
+            kept = usernames[:max(0, self.max_pending - len(state.pending_failures))]
+            state.pending_failures.extend(kept)
+            state.pending_overflow += len(usernames) - len(kept)
+
+            if not state.pending_failures and not state.pending_overflow:
+                return [], 0
+
+            # Outside a raid new failures are reported right away, along with anything still held back
+            waiting = state.last_notice is not None and now - state.last_notice < self.notice_interval
+            if waiting and (hold or not usernames):
+                return [], 0
+
+            if hold:
+                state.last_notice = now
+
+            failures, more = state.pending_failures, state.pending_overflow
+            state.pending_failures, state.pending_overflow = [], 0
+            return failures, more
@@ -0,0 +1,229 @@
+from .cache import MISSING
+from .spans import NO_SPANS
+import time
+
+# DynamoDB limits BatchGetItem to 100 keys per request
+BATCH_GET_LIMIT = 100
+BATCH_GET_ATTEMPTS = 5
+# and BatchWriteItem to 25 writes
+BATCH_WRITE_LIMIT = 25
+BATCH_WRITE_ATTEMPTS = 8
+
+
+def role_key(user_id, role_name):
+    return {
+        'pk': {'S': 'user_{}'.format(user_id)},
+        'sk': {'S': 'role_{}'.format(role_name)}
+    }
+
+
+def batch_get_items(dynamodb, table_name, keys):
+    # Keys DynamoDB could not read for lack of capacity come back as unprocessed, and are read again with backoff
+    items = []
+
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {table_name: {'Keys': keys[start:start + BATCH_GET_LIMIT]}}
+
+        for attempt in range(BATCH_GET_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+
+            time.sleep(0.05 * 2 ** attempt)
+        else:
+            raise Exception('Unable to read {} keys from {}'.format(len(request[table_name]['Keys']), table_name))
+
+    return items
+
+
+def batch_get_role_items(dynamodb, table_name, role_name, user_ids):
+    # Returns {user_id: item} for every user that has the role, users without it are left out
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    keys = [role_key(user_id, role_name) for user_id in user_ids]
+
+    return {int(item['pk']['S'].split('_')[-1]): item for item in batch_get_items(dynamodb, table_name, keys)}
+
+
+def query_user_roles(dynamodb, table_name, user_id):
+    # Every role of one user, {role_name: item}, from a single Query on the user's partition
+    roles = {}
+    request = {
+        'TableName': table_name,
+        'KeyConditionExpression': 'pk = :pk AND begins_with(sk, :role)',
+        'ExpressionAttributeValues': {':pk': {'S': 'user_{}'.format(user_id)}, ':role': {'S': 'role_'}}
+    }
+
+    while True:
+        response = dynamodb.query(**request)
+
+        for item in response.get('Items', []):
+            roles[item['sk']['S'][len('role_'):]] = item
+
+        if 'LastEvaluatedKey' not in response:
+            return roles
+
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def batch_put_items(dynamodb, table_name, items):
+    # Items DynamoDB could not take for lack of capacity come back as unprocessed, and are written again with backoff
+    for start in range(0, len(items), BATCH_WRITE_LIMIT):
+        request = {
+            table_name: [{'PutRequest': {'Item': item}} for item in items[start:start + BATCH_WRITE_LIMIT]]
+        }
+
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            response = dynamodb.batch_write_item(RequestItems=request)
+
+            request = response.get('UnprocessedItems')
+            if not request:
+                break
+
+            time.sleep(0.05 * 2 ** attempt)
+        else:
+            raise Exception('Unable to write {} items to {}'.format(len(request[table_name]), table_name))
+
+
+class RoleHandler:
+    # Reading and writing one role. Subclasses decide what having the role means for a joining user in bans(), and can
+    # narrow the users worth looking up in candidates().
+    requires_reason = False
+
+    def __init__(self, table_name, role_name, dynamodb, cache=None, spans=NO_SPANS, user_roles=None):
+        self.table_name = table_name
+        self.role_name = role_name
+        self.dynamodb = dynamodb
+        self.cache = cache
+        self.spans = spans
+        self.user_roles = user_roles
+
+    def bans(self, role):
+        raise NotImplementedError
+
+    def candidates(self, user_ids):
+        # Users who might have the role, the rest are known not to without a lookup
+        return list(user_ids)
+
+    def is_user_banned(self, user_id, confirmed=False):
+        # confirmed reads the table rather than trusting the snapshot and cache, for answers an admin acts on
+        if confirmed:
+            return self.bans(self.load_role(user_id))
+
+        return self.are_users_banned([user_id])[user_id]
+
+    def are_users_banned(self, user_ids):
+        roles = {user_id: False for user_id in user_ids}
+        roles.update(self.has_roles(self.candidates(user_ids)))
+
+        return {user_id: self.bans(role) for user_id, role in roles.items()}
+
+    def uncached(self, user_ids):
+        # Users whose check would need the role read from the table
+        user_ids = self.candidates(user_ids)
+
+        if self.cache is None:
+            return user_ids
+
+        return [user_id for user_id in user_ids if self.cache.peek(self.role_name, user_id) is MISSING]
+
+    def has_role(self, user_id):
+        if self.cache is not None:
+            cached = self.cache.get(self.role_name, user_id)
+            if cached is not MISSING:
+                return cached
+
+        return self.load_role(user_id)
+
+    def load_role(self, user_id):
+        item = self.user_roles.known(user_id, self.role_name) if self.user_roles is not None else MISSING
+
+        if item is MISSING:
+            with self.spans.span('dynamodb.get_item'):
+                item = self.dynamodb.get_item(
+                    TableName=self.table_name, Key=role_key(user_id, self.role_name)
+                ).get('Item')
+
+            if self.user_roles is not None:
+                self.user_roles.remember(user_id, self.role_name, item)
+
+        role = self.role_from_item(item)
+
+        if self.cache is not None:
+            self.cache.put(self.role_name, user_id, role)
+
+        return role
+
+    def has_roles(self, user_ids):
+        roles = {}
+        missing = []
+
+        for user_id in user_ids:
+            cached = self.cache.get(self.role_name, user_id) if self.cache is not None else MISSING
+            if cached is MISSING:
+                missing.append(user_id)
+            else:
+                roles[user_id] = cached
+
+        if len(missing) == 1:
+            roles[missing[0]] = self.load_role(missing[0])
+        elif missing:
+            items = self.load_items(missing)
+
+            for user_id in missing:
+                roles[user_id] = self.role_from_item(items.get(int(user_id)))
+
+                if self.cache is not None:
+                    self.cache.put(self.role_name, user_id, roles[user_id])
+
+        return roles
+
+    def load_items(self, user_ids):
+        # {user_id: item} of the users that have the role
+        if self.user_roles is None:
+            with self.spans.span('dynamodb.batch_get_item'):
+                return batch_get_role_items(self.dynamodb, self.table_name, self.role_name, user_ids)
+
+        self.user_roles.load({self.role_name: user_ids})
+        return {int(user_id): self.user_roles.known(user_id, self.role_name) for user_id in user_ids}
+
+    def role_from_item(self, item):
+        raise NotImplementedError
+
+    def role_item(self, user_id, username, reason):
+        return dict(
+            role_key(user_id, self.role_name),
+            role_users_pk={'S': 'role_{}'.format(self.role_name)},
+            role_users_sk={'S': 'user_{}'.format(user_id)},
+            username={'S': username}
+        )
+
+    def add_role_to(self, user_id, username, reason):
+        with self.spans.span('dynamodb.put_item'):
+            self.dynamodb.put_item(TableName=self.table_name, Item=self.role_item(user_id, username, reason))
+
+        self.changed([user_id], added=True)
+
+    def add_roles_to(self, entries):
+        # entries are (user_id, username, reason) for users that do not have the role yet
+        with self.spans.span('dynamodb.batch_write_item'):
+            batch_put_items(self.dynamodb, self.table_name, [self.role_item(*entry) for entry in entries])
+
+        self.changed([user_id for user_id, _, _ in entries], added=True)
+
+    def remove_role_from(self, user_id):
+        with self.spans.span('dynamodb.delete_item'):
+            self.dynamodb.delete_item(TableName=self.table_name, Key=role_key(user_id, self.role_name))
+
+        self.changed([user_id], added=False)
+
+    def changed(self, user_ids, added):
+        # Drops what this container remembers about the users' role after a write
+        for user_id in user_ids:
+            if self.cache is not None:
+                self.cache.invalidate(self.role_name, user_id)
+
+            if self.user_roles is not None:
+                self.user_roles.forget(user_id)
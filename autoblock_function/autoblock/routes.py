@@ -0,0 +1,64 @@
+import json
+
+
+class Route:
+    # Several handlers applied to one chat, for example the whitelist of a private room along with the blacklist. A user
+    # is banned when any handler bans them. The roles none of the caches can answer are read together first, so the
+    # handlers find them already loaded.
+    def __init__(self, handlers, user_roles):
+        self.handlers = handlers
+        self.user_roles = user_roles
+
+    def is_user_banned(self, user_id):
+        return self.are_users_banned([user_id])[user_id]
+
+    def are_users_banned(self, user_ids):
+        self.user_roles.load({handler.role_name: handler.uncached(user_ids) for handler in self.handlers})
+
+        banned = {user_id: False for user_id in user_ids}
+        for handler in self.handlers:
+            for user_id, reason in handler.are_users_banned(user_ids).items():
+                banned[user_id] = banned[user_id] or reason
+
+        return banned
+
+
+def load_chat_roles(text):
+    # A malformed CHAT_ROLES leaves every chat with its bot's own role rather than failing every invocation
+    try:
+        chat_roles = json.loads(text)
+    except ValueError as e:
+        print('Ignoring CHAT_ROLES, it is not valid JSON: {}'.format(e))
+        return {}
+
+    if not isinstance(chat_roles, dict):
+        print('Ignoring CHAT_ROLES, it is not an object')
+        return {}
+
+    return chat_roles
+
+
+def parse_routes(chat_roles, handlers, user_roles):
+    # chat_roles is {path: {chat_id: [role_name]}}, as in the CHAT_ROLES setting, and handlers is {path: handler}.
+    # Routes are keyed by (path, chat_id), so the bots sharing a chat each keep their own. Invalid entries are skipped.
+    by_role = {handler.role_name: handler for handler in handlers.values()}
+    routes = {}
+
+    for path, chats in chat_roles.items():
+        if path not in handlers or not isinstance(chats, dict):
+            print('Ignoring CHAT_ROLES entry {}: expected a bot path with {{chat_id: [role]}}'.format(path))
+            continue
+
+        for chat_id, role_names in chats.items():
+            if not chat_id.lstrip('-').isdigit() or not isinstance(role_names, list) or not role_names:
+                print('Ignoring CHAT_ROLES entry {} {}: expected a chat id with a list of roles'.format(path, chat_id))
+                continue
+
+            unknown = [str(role_name) for role_name in role_names if role_name not in by_role]
+            if unknown:
+                print('Ignoring CHAT_ROLES entry {} {}: unknown roles {}'.format(path, chat_id, ', '.join(unknown)))
+                continue
+
+            routes[(path, int(chat_id))] = Route([by_role[role_name] for role_name in role_names], user_roles)
+
+    return routes
@@ -0,0 +1,66 @@
+from botocore.exceptions import ClientError
+import hashlib
+import os
+
+SESSION_PREFIX = 'telethon_sessions/'
+
+
+class SessionStore:
+    def __init__(self, s3, bucket_name, prefix=SESSION_PREFIX):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        # bot id => (etag, sha256) of the copy this container restored or last wrote
+        self.versions = {}
+
+    def key(self, bot_id):
+        return '{}{}.session'.format(self.prefix, bot_id)
+
+    def restore(self, bot_id, path):
+        # Telethon appends .session to the name it is given
+        session_file = path + '.session'
+
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key(bot_id))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                print('Unable to restore session for bot {}: {}'.format(bot_id, e))
+            return False
+
+        data = response['Body'].read()
+
+        with open(session_file, 'wb') as output:
+            output.write(data)
+
+        self.versions[bot_id] = (response['ETag'], hashlib.sha256(data).hexdigest())
+        return True
+
+    def save(self, bot_id, path):
+        session_file = path + '.session'
+
+        if not os.path.exists(session_file):
+            return False
+
+        with open(session_file, 'rb') as session:
+            data = session.read()
+
+        etag, digest = self.versions.get(bot_id, (None, None))
+
+        if digest == hashlib.sha256(data).hexdigest():
+            return False
+
+        # Only replace the copy we started from, so two cold starts racing each other cannot clobber a newer login
+        condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+
+        try:
+            response = self.s3.put_object(Bucket=self.bucket_name, Key=self.key(bot_id), Body=data, **condition)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                print('Session for bot {} was saved by another container, skipping'.format(bot_id))
+            else:
+                # The client is already connected, so the command goes on and the next cold start logs in again
+                print('Unable to save session for bot {}: {}'.format(bot_id, e))
+            return False
+
+        self.versions[bot_id] = (response['ETag'], hashlib.sha256(data).hexdigest())
+        return True
@@ -0,0 +1,185 @@
+from array import array
+from botocore.exceptions import ClientError
+from bisect import bisect_left
+from email.utils import parsedate_to_datetime
+import sys
+import tempfile
+import time
+
+SNAPSHOT_KEY = 'autoblock_blacklist.ids'
+# Ids held in memory per id length before they are appended to that length's spill file
+SPILL_CHUNK = 8192
+
+
+def encode_ids(ids):
+    # Sorted, de-duplicated little endian uint64 values, so any consumer can binary search the raw bytes
+    snapshot = array('Q', sorted(set(ids)))
+
+    if sys.byteorder != 'little':
+        snapshot.byteswap()
+
+    return snapshot.tobytes()
+
+
+def little_endian(ids):
+    if sys.byteorder != 'little':
+        ids = array('Q', ids)
+        ids.byteswap()
+
+    return ids.tobytes()
+
+
+def decode_ids(data):
+    snapshot = array('Q')
+    snapshot.frombytes(data)
+
+    if sys.byteorder != 'little':
+        snapshot.byteswap()
+
+    return snapshot
+
+
+class IdCollector:
+    # Role index pages are ordered by "user_<id>", which is numeric order among ids with the same number of digits.
+    # Each length therefore gets a spill file in /tmp that stays sorted as ids are appended, and the files concatenated
+    # in length order are the sorted snapshot. Memory holds one chunk per length, /tmp holds 8 bytes per id.
+    def __init__(self, chunk=SPILL_CHUNK):
+        self.chunk = chunk
+        self.buckets = {}
+        self.spills = {}
+        # Last id of each length, which the next one must be greater than
+        self.last = {}
+        self.ordered = True
+        self.count = 0
+
+    def add(self, user_id):
+        length = len(str(user_id))
+
+        if length in self.last and self.last[length] >= user_id:
+            self.ordered = False
+
+        self.last[length] = user_id
+        bucket = self.buckets.setdefault(length, array('Q'))
+        bucket.append(user_id)
+        self.count += 1
+
+        if len(bucket) >= self.chunk:
+            if length not in self.spills:
+                self.spills[length] = tempfile.TemporaryFile()
+
+            self.spills[length].write(little_endian(bucket))
+            self.buckets[length] = array('Q')
+
+    def write_to(self, output):
+        # Once, since the spill files are removed afterwards
+        try:
+            if not self.ordered:
+                # Only input out of index order gets here, and it is sorted in memory
+                chunks = self.read_chunks(sorted(self.buckets))
+                output.write(encode_ids(user_id for chunk in chunks for user_id in decode_ids(chunk)))
+                return
+
+            for chunk in self.read_chunks(sorted(self.buckets)):
+                output.write(chunk)
+        finally:
+            self.close()
+
+    def read_chunks(self, lengths):
+        # Little endian bytes of every id, length by length
+        for length in lengths:
+            if length in self.spills:
+                spill = self.spills[length]
+                spill.seek(0)
+                yield from iter(lambda: spill.read(self.chunk * 8), b'')
+
+            yield little_endian(self.buckets[length])
+
+    def close(self):
+        for spill in self.spills.values():
+            spill.close()
+
+        self.spills = {}
+
+
+class BannedIdSnapshot:
+    # The scraper republishes the snapshot every compaction (10 minutes), so a user listed from another container goes
+    # unseen by joins for at most one compaction plus refresh_interval. An older snapshot means the export has stopped,
+    # and joins then fall back to DynamoDB after max_age seconds.
+    def __init__(self, s3, bucket_name, key=SNAPSHOT_KEY, max_age=1800, refresh_interval=300, clock=time.time):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.clear()
+
+    def clear(self):
+        self.ids = None
+        self.etag = None
+        # sha256 of the ids, which the scraper keeps in the object's metadata
+        self.version = None
+        self.generated_at = None
+        self.checked_at = None
+        # {user_id: added_at} of users listed from this container, which a snapshot may not include for up to max_age
+        self.added = {}
+
+    def lookup(self, user_id):
+        # True/False when the snapshot can answer, None when it is missing or stale and the caller must fall back
+        self.refresh()
+
+        if self.ids is None or self.clock() - self.generated_at > self.max_age:
+            return None
+
+        user_id = int(user_id)
+
+        if user_id in self.added:
+            return None
+
+        index = bisect_left(self.ids, user_id)
+        return index < len(self.ids) and self.ids[index] == user_id
+
+    def add(self, user_id):
+        self.added[int(user_id)] = self.clock()
+
+    def refresh(self):
+        now = self.clock()
+
+        if self.checked_at is not None and now - self.checked_at < self.refresh_interval:
+            return
+
+        self.checked_at = now
+
+        params = {'Bucket': self.bucket_name, 'Key': self.key}
+        if self.etag is not None:
+            params['IfNoneMatch'] = self.etag
+
+        try:
+            response = self.s3.get_object(**params)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                print('Unable to load banned id snapshot: {}'.format(e))
+                return
+
+            # Republishing an unchanged list keeps the ETag but moves the modification time forward
+            last_modified = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('last-modified')
+            if last_modified is not None and self.generated_at is not None:
+                self.generated_at = max(self.generated_at, parsedate_to_datetime(last_modified).timestamp())
+            return
+
+        version = response.get('Metadata', {}).get('sha256')
+        self.etag = response.get('ETag')
+        self.generated_at = response['LastModified'].timestamp()
+
+        # Copying the snapshot onto itself to refresh its modification time can give it a new ETag, so an unchanged
+        # snapshot is recognized by its hash and not read again
+        if version is not None and version == self.version and self.ids is not None:
+            response['Body'].close()
+            return
+
+        self.ids = decode_ids(response['Body'].read())
+        self.version = version
+        # A new snapshot can still predate the export of recent additions
+        self.added = {user_id: added_at for user_id, added_at in self.added.items() if now - added_at <= self.max_age}
+
+        print('Loaded banned id snapshot with {} users'.format(len(self.ids)))
@@ -0,0 +1,75 @@
+import json
+import threading
+import time
+
+
+class Span:
+    __slots__ = ['spans', 'name', 'started_at']
+
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = self.spans.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.spans.record(self.name, (self.spans.clock() - self.started_at) * 1000)
+        return False
+
+
+class NoSpan:
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Spans:
+    # Wall time spent in each stage of an invocation, summed over calls and logged as one JSON line at the end.
+    # Stages overlap when they run on the I/O pool, so the totals can add up to more than the invocation took.
+    def __init__(self, enabled=True, clock=time.perf_counter):
+        self.enabled = enabled
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.begin()
+
+    def begin(self):
+        with self._lock:
+            self.totals = {}
+
+    def span(self, name):
+        # Disabled spans share one object that does nothing, so instrumented code costs a method call
+        return Span(self, name) if self.enabled else NO_SPAN
+
+    def record(self, name, milliseconds):
+        with self._lock:
+            total = self.totals.get(name)
+            self.totals[name] = (milliseconds, 1) if total is None else (total[0] + milliseconds, total[1] + 1)
+
+    def fields(self):
+        with self._lock:
+            totals = dict(self.totals)
+
+        return {
+            'stage_ms': {name: round(total[0], 1) for name, total in sorted(totals.items())},
+            'stage_calls': {name: total[1] for name, total in sorted(totals.items())}
+        }
+
+    def flush(self, **fields):
+        if not self.enabled:
+            return
+
+        print(json.dumps(dict(fields, **self.fields())))
+        self.begin()
+
+
+# For code that is not given spans to record into
+NO_SPANS = Spans(enabled=False)
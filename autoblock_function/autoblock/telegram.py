@@ -0,0 +1,122 @@
+from .spans import NO_SPANS
+from requests.adapters import HTTPAdapter
+import json
+import os
+import requests
+import threading
+import time
+
+API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '16'))
+
+# (connect, read) timeouts in seconds, well inside the 60 second Lambda timeout
+TIMEOUT = (3.05, 10)
+MAX_ATTEMPTS = 3
+BACKOFF = 0.25
+# Longer waits than this are not worth holding the invocation for, the response is returned as is
+MAX_RETRY_AFTER = 5
+
+# Kept for the life of the container so warm invocations reuse the TLS connection to api.telegram.org
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+
+
+class WebhookReply:
+    # Telegram accepts one Bot API call as the body of the webhook response, which saves an outbound request
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.method = None
+        self.payload = None
+        self._lock = threading.Lock()
+
+    def offer(self, method, payload):
+        with self._lock:
+            if not self.enabled or self.method is not None:
+                return False
+
+            self.method = method
+            self.payload = payload
+            return True
+
+    def response(self):
+        if self.method is None:
+            return {'statusCode': 200, 'body': '{}'}
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps(dict(self.payload, method=self.method))
+        }
+
+
+# Replaced by the handler at the start of every invocation
+webhook_reply = WebhookReply()
+# Set by the handler to time Bot API calls as part of the invocation
+spans = NO_SPANS
+
+
+def method_url(bot_key, method):
+    return '{}/bot{}/{}'.format(API_URL, bot_key, method)
+
+
+def retry_delay(response, attempt):
+    if response is not None and response.status_code == 429:
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', BACKOFF * 2 ** attempt))
+
+    return BACKOFF * 2 ** attempt
+
+
+def call(bot_key, method, payload, timeout=TIMEOUT):
+    # Returns the final response without raising, so callers can act on specific error codes
+    for attempt in range(MAX_ATTEMPTS):
+        last_attempt = attempt == MAX_ATTEMPTS - 1
+
+        try:
+            with spans.span('telegram.{}'.format(method)):
+                response = session.post(method_url(bot_key, method), data=payload, timeout=timeout)
+        except requests.ConnectionError:
+            if last_attempt:
+                raise
+
+            time.sleep(retry_delay(None, attempt))
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+
+        delay = retry_delay(response, attempt)
+
+        if last_attempt or delay > MAX_RETRY_AFTER:
+            return response
+
+        print('Telegram {} returned {}, retrying in {}s'.format(method, response.status_code, delay))
+        time.sleep(delay)
+
+
+def send(bot_key, method, payload, timeout=TIMEOUT):
+    response = call(bot_key, method, payload, timeout)
+    response.raise_for_status()
+    return response
+
+
+def reply(bot_key, method, payload):
+    # The first reply of an invocation may be deferred into the webhook response, in which case None is returned
+    if webhook_reply.offer(method, payload):
+        return None
+
+    return send(bot_key, method, payload)
+
+
+def download(bot_key, file_id):
+    # Streamed, so a large document is read as it arrives rather than held in memory first
+    file_path = send(bot_key, 'getFile', {'file_id': file_id}).json()['result']['file_path']
+
+    response = session.get('{}/file/bot{}/{}'.format(API_URL, bot_key, file_path), stream=True, timeout=TIMEOUT)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    # Otherwise urllib3 reports the body closed as soon as it is read to the end, which io wrappers treat as an error
+    response.raw.auto_close = False
+    return response
@@ -0,0 +1,129 @@
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from .spans import NO_SPANS
+import threading
+import time
+
+
+# What claim() found for an update
+CLAIMED = 'claimed'
+HANDLED = 'handled'
+# Another container holds a live lease on the update, Telegram should be asked to deliver it again later
+IN_PROGRESS = 'in_progress'
+
+
+class UpdateDeduplicator:
+    # Telegram redelivers an update when the webhook answers slowly or with an error. The recent window catches the
+    # redeliveries that reach the container that handled the update. With persist on, a conditional put records the
+    # update as in progress under a lease, and complete() marks it done once handled. A redelivery that finds a live
+    # lease is not dropped, since the first container may still fail, and one that finds an expired lease takes the
+    # update over. The item expires once Telegram has given up.
+    def __init__(self, table_name, dynamodb, persist=False, window=2048, ttl=86400, lease=90, clock=time.time,
+                 spans=NO_SPANS):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+        self.persist = persist
+        self.window = window
+        self.ttl = ttl
+        self.lease = lease
+        self.clock = clock
+        self.spans = spans
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.recent = OrderedDict()
+            self.duplicates = 0
+
+    def claim(self, bot_id, update_id):
+        # CLAIMED for an update this container should handle, HANDLED for one to drop, or IN_PROGRESS
+        key = (str(bot_id), int(update_id))
+
+        with self._lock:
+            if key in self.recent:
+                self.duplicates += 1
+                return HANDLED
+
+            self.recent[key] = True
+            if len(self.recent) > self.window:
+                self.recent.popitem(last=False)
+
+        claim = self.store(*key) if self.persist else CLAIMED
+
+        if claim != CLAIMED:
+            with self._lock:
+                self.duplicates += 1
+
+                # The retry of an update still in progress elsewhere may come back to this container
+                if claim == IN_PROGRESS:
+                    self.recent.pop(key, None)
+
+        return claim
+
+    def complete(self, bot_id, update_id):
+        if not self.persist:
+            return
+
+        try:
+            with self.spans.span('dynamodb.update_item'):
+                self.dynamodb.update_item(
+                    TableName=self.table_name,
+                    Key=self.key(bot_id, update_id),
+                    UpdateExpression='SET #status = :done REMOVE lease_until',
+                    ExpressionAttributeNames={'#status': 'status'},
+                    ExpressionAttributeValues={':done': {'S': 'done'}}
+                )
+        except ClientError as e:
+            # The lease runs out instead, and a later redelivery is handled again
+            print('Unable to complete update {} for bot {}: {}'.format(update_id, bot_id, e))
+
+    def release(self, bot_id, update_id):
+        # For updates that failed, so that Telegram's retry is handled instead of dropped
+        key = (str(bot_id), int(update_id))
+
+        with self._lock:
+            self.recent.pop(key, None)
+
+        if self.persist:
+            try:
+                with self.spans.span('dynamodb.delete_item'):
+                    self.dynamodb.delete_item(TableName=self.table_name, Key=self.key(*key))
+            except ClientError as e:
+                print('Unable to release update {} for bot {}: {}'.format(update_id, bot_id, e))
+
+    def key(self, bot_id, update_id):
+        return {
+            'pk': {'S': 'update_{}_{}'.format(bot_id, update_id)},
+            'sk': {'S': 'update'}
+        }
+
+    def store(self, bot_id, update_id):
+        now = int(self.clock())
+
+        try:
+            with self.spans.span('dynamodb.put_item'):
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item=dict(
+                        self.key(bot_id, update_id),
+                        status={'S': 'in_progress'},
+                        lease_until={'N': str(now + self.lease)},
+                        expires_at={'N': str(now + self.ttl)}
+                    ),
+                    ConditionExpression='attribute_not_exists(pk) OR (#status = :in_progress AND lease_until < :now)',
+                    ExpressionAttributeNames={'#status': 'status'},
+                    ExpressionAttributeValues={':in_progress': {'S': 'in_progress'}, ':now': {'N': str(now)}},
+                    ReturnValuesOnConditionCheckFailure='ALL_OLD'
+                )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                item = e.response.get('Item')
+                if item is None or item.get('status', {}).get('S') == 'in_progress':
+                    return IN_PROGRESS
+                return HANDLED
+
+            # Handling an update twice is better than dropping it because the table could not be reached
+            print('Unable to record update {} for bot {}: {}'.format(update_id, bot_id, e))
+
+        return CLAIMED
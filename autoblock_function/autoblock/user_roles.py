@@ -0,0 +1,78 @@
+from .cache import MISSING
+from .roles import batch_get_items, query_user_roles, role_key
+from .spans import NO_SPANS
+import threading
+
+
+class UserRoles:
+    # Role items read during one invocation, shared by every handler and route. A chat that applies several roles reads
+    # them all in one round trip: a Query on the partition for a single user, or one BatchGetItem for several.
+    def __init__(self, table_name, dynamodb, spans=NO_SPANS):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+        self.spans = spans
+        self._lock = threading.Lock()
+        self.begin()
+
+    def begin(self):
+        with self._lock:
+            # {user_id: {role_name: item or None}}, and the users whose every role has been read
+            self.items = {}
+            self.complete = set()
+
+    def known(self, user_id, role_name):
+        # The item, None when the user does not have the role, or MISSING when it has not been read
+        user_id = int(user_id)
+
+        with self._lock:
+            roles = self.items.get(user_id, {})
+            if role_name in roles:
+                return roles[role_name]
+            return None if user_id in self.complete else MISSING
+
+    def remember(self, user_id, role_name, item):
+        with self._lock:
+            self.items.setdefault(int(user_id), {})[role_name] = item
+
+    def forget(self, user_id):
+        with self._lock:
+            self.items.pop(int(user_id), None)
+            self.complete.discard(int(user_id))
+
+    def roles_of(self, user_id):
+        # {role_name: item} for every role the user has
+        user_id = int(user_id)
+
+        with self._lock:
+            if user_id in self.complete:
+                return {name: item for name, item in self.items[user_id].items() if item is not None}
+
+        with self.spans.span('dynamodb.query'):
+            roles = query_user_roles(self.dynamodb, self.table_name, user_id)
+
+        with self._lock:
+            self.items[user_id] = dict(roles)
+            self.complete.add(user_id)
+
+        return roles
+
+    def load(self, user_ids_by_role):
+        # {role_name: [user_id]} of the roles to read, anything already known is skipped
+        pairs = [
+            (int(user_id), role_name) for role_name, user_ids in user_ids_by_role.items() for user_id in user_ids
+            if self.known(user_id, role_name) is MISSING
+        ]
+        users = set(user_id for user_id, _ in pairs)
+
+        if len(users) == 1:
+            self.roles_of(users.pop())
+        elif users:
+            keys = [role_key(user_id, role_name) for user_id, role_name in dict.fromkeys(pairs)]
+
+            with self.spans.span('dynamodb.batch_get_item'):
+                items = batch_get_items(self.dynamodb, self.table_name, keys)
+
+            found = {(int(item['pk']['S'].split('_')[-1]), item['sk']['S'][len('role_'):]): item for item in items}
+
+            for pair in dict.fromkeys(pairs):
+                self.remember(*pair, found.get(pair))
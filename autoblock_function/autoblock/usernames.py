@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+def normalize(username):
+    # Telegram usernames are case insensitive, and mentions carry a leading @ that join events do not
+    return username.lstrip('@').lower()
+
+
+class UsernameResolver:
+    def __init__(self, table_name, dynamodb, ttl=86400, memory_ttl=3600, max_size=4096, clock=time.time):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+        self.ttl = ttl
+        self.memory_ttl = memory_ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self.hits = 0
+            self.misses = 0
+
+    def lookup(self, username):
+        name = normalize(username)
+
+        with self._lock:
+            entry = self.entries.get(name)
+
+            if entry is not None and entry[0] > self.clock():
+                self.hits += 1
+                return entry[1]
+
+        user_id = self.load(name)
+
+        with self._lock:
+            if user_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if user_id is not None:
+            self.remember(name, user_id, persist=False)
+
+        return user_id
+
+    def remember(self, username, user_id, persist=True):
+        name = normalize(username)
+
+        with self._lock:
+            if len(self.entries) >= self.max_size and name not in self.entries:
+                # Cheaper than LRU bookkeeping for a cache that only needs to stay bounded
+                self.entries.pop(next(iter(self.entries)))
+
+            self.entries[name] = (self.clock() + self.memory_ttl, int(user_id))
+
+        if persist:
+            self.store(name, user_id)
+
+    def load(self, name):
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={
+                'pk': {'S': 'username_{}'.format(name)},
+                'sk': {'S': 'username'}
+            }
+        )
+
+        item = response.get('Item')
+
+        # DynamoDB deletes expired items lazily, so expiry is checked here as well
+        if item is None or int(item['expires_at']['N']) <= self.clock():
+            return None
+
+        return int(item['user_id']['N'])
+
+    def store(self, name, user_id):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                'pk': {'S': 'username_{}'.format(name)},
+                'sk': {'S': 'username'},
+                'user_id': {'N': str(user_id)},
+                'expires_at': {'N': str(int(self.clock() + self.ttl))}
+            }
+        )
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -1,9 +1,7 @@
-class Handler:
-    def __init__(self, table_name, role_name, dynamodb):
-        self.table_name = table_name
-        self.role_name = role_name
-        self.dynamodb = dynamodb
+from .roles import RoleHandler
 
+
+class Handler(RoleHandler):
     @property
     def welcome_message(self):
         return 'This bot implements room permissions for @FurryPartyOfArtAndLabor.'
@@ -11,37 +9,12 @@ class Handler:
     def get_blocklist_url(self):
         return None
 
-    def is_user_banned(self, user_id):
-        return not self.has_role(user_id)
-
-    def has_role(self, user_id):
-        response = self.dynamodb.get_item(
-            TableName=self.table_name,
-            Key={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)}
-            }
-        )
-
-        return 'Allowed' if 'Item' in response else False
+    def get_blocklist_version(self):
+        return None
 
-    def add_role_to(self, user_id, username, reason):
-        self.dynamodb.put_item(
-            TableName=self.table_name,
-            Item={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)},
-                'role_users_pk': {'S': 'role_{}'.format(self.role_name)},
-                'role_users_sk': {'S': 'user_{}'.format(user_id)},
-                'username': {'S': username}
-            }
-        )
+    def bans(self, role):
+        # Only users on the list may stay
+        return not role
 
-    def remove_role_from(self, user_id):
-        self.dynamodb.delete_item(
-            TableName=self.table_name,
-            Key={
-                'pk': {'S': 'user_{}'.format(user_id)},
-                'sk': {'S': 'role_{}'.format(self.role_name)}
-            }
-        )
+    def role_from_item(self, item):
+        return 'Allowed' if item is not None else False
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Measures how long a fresh interpreter takes to get a ready autoblock.app.lambda_handler, and fails when that time
+# regresses against the recorded baseline or when join-path cold starts start importing admin-only dependencies.
+#
+#   python benchmarks/cold_start.py                    # compare against benchmarks/cold_start_baseline.json
+#   python benchmarks/cold_start.py --update-baseline  # record a new baseline on this machine
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, 'autoblock_function')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'cold_start_baseline.json')
+
+# Modules a join event never needs; they must not be imported by the module initialization
+DEFERRED_MODULES = ['telethon', 'boto3']
+
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+from autoblock import app
+handler = app.lambda_handler
+print((time.perf_counter() - start) * 1000)
+print(",".join(sorted(name for name in sys.modules if "." not in name)))
+'''
+
+
+def run_once():
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-west-2'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE],
+        cwd=FUNCTION_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    lines = result.stdout.splitlines()
+
+    return float(lines[0]), set(lines[1].split(',')), parse_importtime(result.stderr)
+
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package", with the package indented by nesting depth
+    cumulative = {}
+
+    for line in stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        cumulative[fields[2].strip()] = int(fields[1]) / 1000
+
+    return cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    timings = []
+    modules = set()
+    imports = {}
+
+    for _ in range(args.runs):
+        elapsed, loaded, imports = run_once()
+        timings.append(elapsed)
+        modules |= loaded
+
+    results = {
+        'median_ms': round(statistics.median(timings), 1),
+        'min_ms': round(min(timings), 1),
+        'max_ms': round(max(timings), 1),
+        'slowest_imports_ms': dict(sorted(imports.items(), key=lambda item: -item[1])[:10])
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.update_baseline:
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump({'median_ms': results['median_ms']}, baseline_file, indent=2)
+            baseline_file.write('\n')
+        return 0
+
+    failed = False
+
+    for module in DEFERRED_MODULES:
+        if module in modules:
+            print('FAIL: {} is imported during module initialization'.format(module))
+            failed = True
+
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)['median_ms']
+
+        limit = baseline * (1 + args.tolerance)
+        if results['median_ms'] > limit:
+            print('FAIL: median {}ms exceeds baseline {}ms by more than {:.0%}'.format(
+                results['median_ms'], baseline, args.tolerance
+            ))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Runs the blocklist export against a synthetic role index of increasing size, with S3 parts discarded as they are
+# uploaded, and reports peak traced memory and the most /tmp the export held at once. Each size is exported twice, the
+# second time against the manifest of the first, the way an unchanged list is exported again.
+#
+#   python benchmarks/export_memory.py --rows 10000 100000 1000000
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'autoblock_function'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from autoblock import blocklist_scraper  # noqa: E402
+from autoblock.export import EXPORTERS, MANIFEST_KEY  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+
+PAGE_SIZE = 1000
+FIRST_ID = 100000000
+ID_STEP = 7
+
+
+class SyntheticIndex:
+    # Stands in for the dynamodb client. Every id has nine digits, so a key range is the ids under its leading digits,
+    # and pages are generated on demand like real query results.
+    def __init__(self, rows):
+        self.rows = rows
+
+    def query(self, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+        upper = ExpressionAttributeValues[':upper']['S'][len('user_'):-1] or '9' * blocklist_scraper.READ_KEY_DIGITS
+        scale = 10 ** (9 - len(upper))
+        first = max(0, -(-(int(upper) * scale - FIRST_ID) // ID_STEP))
+        last = min(self.rows, -(-((int(upper) + 1) * scale - FIRST_ID) // ID_STEP))
+        start = ExclusiveStartKey['index'] + 1 if ExclusiveStartKey else first
+        end = min(start + PAGE_SIZE, last)
+
+        response = {'Items': [{
+            'pk': {'S': 'user_{}'.format(FIRST_ID + user_id * ID_STEP)},
+            'sk': {'S': 'role_blacklist'},
+            'username': {'S': '@synthetic_user_{}'.format(user_id)},
+            'reason': {'S': 'synthetic reason {}'.format(user_id % 97)}
+        } for user_id in range(start, end)]}
+
+        if end < last:
+            response['LastEvaluatedKey'] = {'index': end - 1}
+
+        return response
+
+
+class DiscardingS3:
+    # Keeps only the manifest, so the next export compares its artifacts with the ones just written
+    def __init__(self):
+        self.bytes_uploaded = 0
+        self.manifest = None
+
+    def put_object(self, Key, Body, **kwargs):
+        self.bytes_uploaded += len(Body)
+
+        if Key == MANIFEST_KEY:
+            self.manifest = Body
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'synthetic'}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self.bytes_uploaded += len(Body)
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+    def copy_object(self, **kwargs):
+        pass
+
+    def get_object(self, Key, **kwargs):
+        # No base snapshot, so every run is a plain rescan
+        if Key != MANIFEST_KEY or self.manifest is None:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+        return {'Body': io.BytesIO(self.manifest)}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **kwargs):
+        yield {}
+
+
+class TmpUsage:
+    # Wraps tempfile.TemporaryFile, which is what the export spills to. Spill files only grow until they are closed,
+    # so the most held at once is the size of the open ones when the first of them closes.
+    def __init__(self):
+        self.files = []
+        self.peak = 0
+
+    def install(self):
+        create = tempfile.TemporaryFile
+
+        def tracked(*args, **kwargs):
+            file = TrackedFile(create(*args, **kwargs), self)
+            self.files.append(file)
+            return file
+
+        tempfile.TemporaryFile = tracked
+        return create
+
+    def closing(self, closed):
+        for file in self.files:
+            file.flush()
+
+        self.peak = max(self.peak, sum(os.fstat(file.fileno()).st_size for file in self.files))
+        self.files.remove(closed)
+
+
+class TrackedFile:
+    def __init__(self, file, usage):
+        self.file = file
+        self.usage = usage
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.usage.closing(self)
+            self.file.close()
+
+
+def measure(rows, formats, s3=None):
+    blocklist_scraper.dynamodb = SyntheticIndex(rows)
+    blocklist_scraper.s3 = s3 or DiscardingS3()
+    blocklist_scraper.s3.bytes_uploaded = 0
+    blocklist_scraper.READ_CAPACITY = 0
+    blocklist_scraper.EXPORT_FORMATS = formats
+
+    tmp = TmpUsage()
+    create = tmp.install()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        blocklist_scraper.lambda_handler({}, None)
+    finally:
+        tempfile.TemporaryFile = create
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'peak': peak / 1024 / 1024,
+        'tmp': tmp.peak / 1024 / 1024,
+        'seconds': elapsed,
+        'uploaded': blocklist_scraper.s3.bytes_uploaded / 1024 / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    columns = ['rows', 'zip MiB', 'all formats MiB', 'tmp MiB', 'seconds', 'uploaded MiB', 'again MiB', 'again tmp MiB',
+               'again sent MiB']
+    print(' '.join('{:>15}'.format(column) for column in columns))
+
+    for rows in args.rows:
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            zip_only = measure(rows, ['zip'])
+            s3 = DiscardingS3()
+            first = measure(rows, list(EXPORTERS), s3)
+            # Unchanged list: every artifact hashes the same as in the manifest and is not replaced. Parts of artifacts
+            # larger than a part are still sent before the upload is aborted, and count as sent.
+            again = measure(rows, list(EXPORTERS), s3)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        values = [zip_only['peak'], first['peak'], first['tmp'], first['seconds'], first['uploaded'], again['peak'],
+                  again['tmp'], again['uploaded']]
+        print('{:>15}'.format(rows) + ''.join(' {:>15.1f}'.format(value) for value in values))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# Generates a join storm of synthetic webhook updates over many chats and feeds it to autoblock.app.lambda_handler at a
+# target rate, using the stand-ins from replay_events.py. Each simulated container is a process of its own running one
+# invocation at a time, so caches and the raid detector are per container as they are on Lambda. Reports sustained
+# throughput, tail latency, outbound calls per join, and whether the bot's Bot API traffic would have run into
+# Telegram's rate limits.
+#
+#   python benchmarks/raid_simulator.py --joins 5000 --chats 50 --rate 200 --banned 0.3
+#   python benchmarks/raid_simulator.py --joins 5000 --snapshot --non-admin-chats 0.2 --output raid.json
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+import argparse
+import copy
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+import replay_events
+from replay_events import app, percentile
+
+BOT_ID = 88888888
+# Telegram's documented limits for bots: about 30 messages per second overall and 20 per minute in one group
+GLOBAL_LIMIT_PER_SECOND = 30
+CHAT_MESSAGES_PER_MINUTE = 20
+
+# Bot API requests as (time, method, chat_id)
+requests_made = []
+requests_lock = threading.Lock()
+
+
+class RaidDynamoDB(replay_events.FakeDynamoDB):
+    def __init__(self, latency, roles):
+        super().__init__(latency)
+        self.roles = roles
+
+    def item(self, key):
+        user_id = int(key['pk']['S'].split('_')[-1])
+
+        if key['sk']['S'][len('role_'):] in self.roles.get(user_id, ()):
+            return dict(key, username={'S': 'raider{}'.format(user_id)}, reason={'S': 'raid'})
+        return None
+
+
+class RaidS3(replay_events.FakeS3):
+    # Serves the ID snapshot of the banned users, so joins are checked the way they are in production
+    def __init__(self, latency, banned_ids):
+        super().__init__(latency)
+        self.body = app.snapshot.encode_ids(banned_ids)
+
+    def get_object(self, **kwargs):
+        self.wait('get_object')
+        return {'Body': io.BytesIO(self.body), 'ETag': '"raid"', 'LastModified': datetime.now(timezone.utc)}
+
+
+class RaidBotAPI(replay_events.FakeBotAPI):
+    # Kicks fail with the "not enough rights" error in chats where the bot is not an admin
+    non_admin_chats = set()
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        method = self.path.rsplit('/', 1)[-1]
+        chat_id = int(form['chat_id'][0]) if 'chat_id' in form else None
+
+        replay_events.record('telegram.{}'.format(method))
+        with requests_lock:
+            requests_made.append((time.perf_counter(), method, chat_id))
+
+        time.sleep(self.latency)
+
+        if method == 'kickChatMember' and chat_id in self.non_admin_chats:
+            self.send_response(400)
+            body = json.dumps({'ok': False, 'error_code': 400, 'description': 'Bad Request: not enough rights'})
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+            return
+
+        self.respond('application/json', json.dumps({'ok': True, 'result': True}).encode())
+
+
+def generate_updates(args, rng):
+    # Raids concentrate on a few chats, so chats are picked with Zipf-like weights
+    chats = [-1001000000000 - index for index in range(args.chats)]
+    weights = [1 / (rank + 1) for rank in range(args.chats)]
+    whitelist_chats = set(rng.sample(chats, round(args.chats * args.whitelist_chats)))
+    non_admin_chats = set(rng.sample(chats, round(args.chats * args.non_admin_chats)))
+
+    templates = {
+        path: json.load(open(os.path.join(replay_events.ROOT, 'events', name)))
+        for path, name in [('/blacklist', 'new_member.json'), ('/whitelist', 'new_member_whitelist.json')]
+    }
+
+    roles = defaultdict(set)
+    updates = []
+    joins = 0
+    next_user_id = 5000000000
+
+    while joins < args.joins:
+        chat_id = rng.choices(chats, weights)[0]
+        path = '/whitelist' if chat_id in whitelist_chats else '/blacklist'
+        members = []
+
+        if rng.random() < args.bot_joins:
+            members.append({'id': BOT_ID, 'is_bot': True, 'first_name': 'Autoblock', 'username': 'autoblock_bot'})
+        else:
+            count = rng.randint(2, args.max_batch) if rng.random() < args.batch_joins else 1
+
+            for _ in range(min(count, args.joins - joins)):
+                next_user_id += rng.randint(1, 1000)
+                members.append({
+                    'id': next_user_id, 'is_bot': False, 'first_name': 'Raider',
+                    'username': 'raider{}'.format(next_user_id)
+                })
+
+                if rng.random() < args.banned:
+                    roles[next_user_id].add('blacklist')
+                if path == '/whitelist' and rng.random() < args.whitelisted:
+                    roles[next_user_id].add('whitelist')
+
+        joins += len(members)
+
+        event = copy.deepcopy(templates[path])
+        body = json.loads(event['body'])
+        body['update_id'] = 900000000 + len(updates)
+        body['message']['message_id'] = len(updates) + 1
+        body['message']['chat'] = {'id': chat_id, 'title': 'raid {}'.format(chat_id), 'type': 'supergroup'}
+        body['message']['new_chat_participant'] = body['message']['new_chat_member'] = members[0]
+        body['message']['new_chat_members'] = members
+        event['body'] = json.dumps(body)
+
+        updates.append((event, len(members)))
+
+    return updates, roles, non_admin_chats
+
+
+def max_in_window(times, window):
+    # Most requests inside any window of the given length, over sorted times
+    most = 0
+    start = 0
+
+    for end in range(len(times)):
+        while times[end] - times[start] >= window:
+            start += 1
+        most = max(most, end - start + 1)
+
+    return most
+
+
+def rate_limit_report(started_at):
+    with requests_lock:
+        made = sorted(request for request in requests_made if request[0] >= started_at)
+
+    by_chat = defaultdict(list)
+    for at, method, chat_id in made:
+        if method == 'sendMessage' and chat_id is not None:
+            by_chat[chat_id].append(at)
+
+    chat_peaks = {chat_id: max_in_window(times, 60) for chat_id, times in by_chat.items()}
+    over = sorted(chat_id for chat_id, peak in chat_peaks.items() if peak > CHAT_MESSAGES_PER_MINUTE)
+
+    return {
+        'peak_requests_per_second': max_in_window([at for at, _, _ in made], 1),
+        'peak_chat_messages_per_minute': max(chat_peaks.values(), default=0),
+        'chats_over_message_limit': over
+    }
+
+
+def container(updates, roles, banned_ids, args, api_url, ready, jobs, results):
+    # One simulated Lambda container: its own process and module state, running one invocation at a time as Lambda does
+    aws_latency = args.aws_latency / 1000
+    replay_events.install_clients(
+        aws_latency, api_url,
+        dynamodb=RaidDynamoDB(aws_latency, roles),
+        s3=RaidS3(aws_latency, banned_ids) if args.snapshot else None
+    )
+    replay_events.reset_container()
+    replay_events.calls.clear()
+    sys.stdout = open(os.devnull, 'w')
+
+    latencies = []
+    delays = []
+    errors = []
+    ready.wait()
+
+    for index, scheduled_at in iter(jobs.get, None):
+        # Wall clock times, since the schedule is set by another process
+        started_at = time.time()
+
+        try:
+            app.lambda_handler(updates[index][0], None)
+        except Exception as e:
+            errors.append(repr(e))
+            continue
+
+        latencies.append((time.time() - started_at) * 1000)
+        delays.append((started_at - scheduled_at) * 1000)
+
+    app.io_executor.submit(lambda: None).result()
+    results.put((latencies, delays, errors, Counter(replay_events.calls)))
+
+
+def run(updates, roles, banned_ids, args, api_url):
+    # An update goes to whichever container is free, and waits in the queue while all of them are busy
+    ready = multiprocessing.Barrier(args.concurrency + 1)
+    jobs = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    containers = [
+        multiprocessing.Process(
+            target=container, args=(updates, roles, banned_ids, args, api_url, ready, jobs, results), daemon=True
+        )
+        for _ in range(args.concurrency)
+    ]
+    for process in containers:
+        process.start()
+
+    ready.wait()
+    start = time.time()
+    started_at = time.perf_counter()
+
+    for index in range(len(updates)):
+        scheduled_at = start + index / args.rate
+        time.sleep(max(0, scheduled_at - time.time()))
+        jobs.put((index, scheduled_at))
+
+    for _ in containers:
+        jobs.put(None)
+
+    latencies = []
+    delays = []
+    errors = []
+    calls = Counter()
+
+    for _ in containers:
+        container_latencies, container_delays, container_errors, container_calls = results.get()
+        latencies.extend(container_latencies)
+        delays.extend(container_delays)
+        errors.extend(container_errors)
+        calls.update(container_calls)
+
+    elapsed = time.time() - start
+
+    for process in containers:
+        process.join()
+
+    return started_at, elapsed, latencies, delays, errors, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--joins', type=int, default=2000, help='users joining in total')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=100, help='webhook updates per second')
+    parser.add_argument('--concurrency', type=int, default=16, help='containers, each a process running one invocation')
+    parser.add_argument('--banned', type=float, default=0.2, help='share of joining users on the blacklist')
+    parser.add_argument('--whitelist-chats', type=float, default=0.2, help='share of chats using the whitelist bot')
+    parser.add_argument('--whitelisted', type=float, default=0.8, help='share of whitelist chat joiners allowed in')
+    parser.add_argument('--bot-joins', type=float, default=0.01, help='share of updates adding the bot to a chat')
+    parser.add_argument('--batch-joins', type=float, default=0.1, help='share of updates with several new members')
+    parser.add_argument('--max-batch', type=int, default=5)
+    parser.add_argument('--non-admin-chats', type=float, default=0.1, help='share of chats where kicks fail')
+    parser.add_argument('--snapshot', action='store_true', help='serve the banned ID snapshot from S3')
+    parser.add_argument('--aws-latency', type=float, default=15, help='milliseconds per AWS call')
+    parser.add_argument('--telegram-latency', type=float, default=40, help='milliseconds per Bot API call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    updates, roles, non_admin_chats = generate_updates(args, random.Random(args.seed))
+    banned_ids = [user_id for user_id, names in roles.items() if 'blacklist' in names]
+
+    # The Bot API stays in this process, so that the requests of every container count towards the same limits
+    RaidBotAPI.non_admin_chats = non_admin_chats
+    server = replay_events.install_fakes(args.aws_latency / 1000, args.telegram_latency / 1000, bot_api=RaidBotAPI)
+    api_url = replay_events.telegram.API_URL
+    replay_events.calls.clear()
+
+    joins = sum(count for _, count in updates)
+    print('{} updates with {} joins over {} chats, {} banned users, at {}/s'.format(
+        len(updates), joins, args.chats, len(banned_ids), args.rate
+    ))
+
+    started_at, elapsed, latencies, delays, errors, calls = run(updates, roles, banned_ids, args, api_url)
+
+    server.shutdown()
+    calls.update(replay_events.calls)
+    services = Counter()
+    for name, count in calls.items():
+        services[name.split('.')[0]] += count
+
+    results = {
+        'settings': vars(args),
+        'updates': len(updates),
+        'joins': joins,
+        'errors': len(errors),
+        'updates_per_second': round(len(updates) / elapsed, 1),
+        'joins_per_second': round(joins / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 1),
+            'p95': round(percentile(latencies, 0.95), 1),
+            'p99': round(percentile(latencies, 0.99), 1)
+        },
+        # How long updates waited for a free invocation, which grows without bound once the rate cannot be sustained
+        'queue_delay_ms': {
+            'p50': round(percentile(delays, 0.50), 1),
+            'p99': round(percentile(delays, 0.99), 1)
+        },
+        'calls_per_join': {service: round(count / joins, 3) for service, count in sorted(services.items())},
+        'calls': dict(sorted(calls.items())),
+        'rate_limits': rate_limit_report(started_at)
+    }
+
+    print(json.dumps({key: value for key, value in results.items() if key not in ['settings', 'calls']}, indent=2))
+
+    if results['updates_per_second'] < args.rate * 0.95:
+        print('WARNING: sustained {} updates/s, below the target of {}/s'.format(
+            results['updates_per_second'], args.rate
+        ))
+
+    limits = results['rate_limits']
+    if limits['peak_requests_per_second'] > GLOBAL_LIMIT_PER_SECOND:
+        print('WARNING: {} Bot API requests in one second, over the limit of about {}/s'.format(
+            limits['peak_requests_per_second'], GLOBAL_LIMIT_PER_SECOND
+        ))
+    if limits['chats_over_message_limit']:
+        print('WARNING: {} chats were sent more than {} messages in a minute'.format(
+            len(limits['chats_over_message_limit']), CHAT_MESSAGES_PER_MINUTE
+        ))
+    if errors:
+        print('{} invocations failed, first: {}'.format(len(errors), errors[0]))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+            output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
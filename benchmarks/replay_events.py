@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# Replays the fixtures in events/ through autoblock.app.lambda_handler and reports p50/p95/p99 latency and outbound
+# calls per event type, cold (fresh container state) and warm. The Bot API is a local HTTP server, so requests goes
+# through real connection handling, and AWS clients are in-process stand-ins. Both add a fixed latency to every call.
+#
+#   python benchmarks/replay_events.py --aws-latency 15 --telegram-latency 40 --output replay.json
+#   python benchmarks/replay_events.py --baseline replay.json  # compare with an earlier run, fails on regressions
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'autoblock_function'))
+
+from autoblock import app, telegram  # noqa: E402
+
+ADMIN_ID = 99999999
+BANNED_ID = 999999402
+BOT_KEY = '88888888:TEST'
+IMPORT_CSV = b'id,username\n1,one\n2,two\n'
+
+# Outbound calls of the current invocation, "telegram.sendMessage" or "dynamodb.get_item"
+calls = Counter()
+calls_lock = threading.Lock()
+
+
+def record(name):
+    with calls_lock:
+        calls[name] += 1
+
+
+class FakeAWS:
+    service = 'cloudwatch'
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def wait(self, operation):
+        record('{}.{}'.format(self.service, operation))
+        time.sleep(self.latency)
+
+    def put_metric_data(self, **kwargs):
+        self.wait('put_metric_data')
+
+
+class FakeSSM(FakeAWS):
+    service = 'ssm'
+
+    def get_parameters_by_path(self, **kwargs):
+        self.wait('get_parameters_by_path')
+        return {'Parameters': [
+            {'Name': '/autoblock_bot/api_id', 'Value': '1', 'Type': 'String', 'Version': 1},
+            {'Name': '/autoblock_bot/api_hash', 'Value': 'hash', 'Type': 'String', 'Version': 1},
+            {'Name': '/autoblock_bot/root_users', 'Value': str(ADMIN_ID), 'Type': 'StringList', 'Version': 1}
+        ]}
+
+
+class FakeDynamoDB(FakeAWS):
+    service = 'dynamodb'
+
+    def item(self, key):
+        if key['pk']['S'] == 'user_{}'.format(BANNED_ID) or key['pk']['S'] == 'user_{}'.format(ADMIN_ID):
+            return dict(key, reason={'S': 'benchmark'})
+        return None
+
+    def get_item(self, TableName, Key):
+        self.wait('get_item')
+        item = self.item(Key)
+        return {'Item': item} if item else {}
+
+    def batch_get_item(self, RequestItems):
+        self.wait('batch_get_item')
+        return {'Responses': {
+            table: [item for item in map(self.item, request['Keys']) if item] for table, request in RequestItems.items()
+        }}
+
+    def query(self, ExpressionAttributeValues, **kwargs):
+        # The roles of one user, for chats set up in CHAT_ROLES
+        self.wait('query')
+        pk = ExpressionAttributeValues[':pk']
+        keys = [{'pk': pk, 'sk': {'S': 'role_{}'.format(name)}} for name in ['blacklist', 'whitelist']]
+        return {'Items': [item for item in map(self.item, keys) if item]}
+
+    def put_item(self, **kwargs):
+        self.wait('put_item')
+
+    def delete_item(self, **kwargs):
+        self.wait('delete_item')
+
+    def batch_write_item(self, RequestItems):
+        self.wait('batch_write_item')
+        return {}
+
+
+class FakeS3(FakeAWS):
+    service = 's3'
+
+    def get_object(self, **kwargs):
+        self.wait('get_object')
+        raise app.snapshot.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+    def put_object(self, **kwargs):
+        self.wait('put_object')
+        return {'ETag': '"benchmark"'}
+
+    def head_object(self, **kwargs):
+        self.wait('head_object')
+        return {'ETag': '"benchmark"'}
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return 'https://example.com/autoblock_blacklist.zip'
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    # /bot<key>/<method> answers every method with a success, /file/bot<key>/<path> serves the CSV import document
+    latency = 0
+    results = {
+        'sendDocument': {'document': {'file_id': 'benchmark'}},
+        'getFile': {'file_path': 'documents/benchmark.csv'}
+    }
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        record('telegram.{}'.format(method))
+        time.sleep(self.latency)
+
+        self.respond('application/json', json.dumps({'ok': True, 'result': self.results.get(method, True)}).encode())
+
+    def do_GET(self):
+        record('telegram.file')
+        time.sleep(self.latency)
+        self.respond('text/csv', IMPORT_CSV)
+
+    def respond(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTelethonClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self, bot_token=None):
+        pass
+
+    def get_entity(self, username):
+        return mock.Mock(id=ADMIN_ID)
+
+    def __call__(self, request):
+        # An empty participant list, for the audit event
+        return mock.Mock(users=[], count=0)
+
+
+def install_fakes(aws_latency, telegram_latency, dynamodb=None, s3=None, bot_api=FakeBotAPI):
+    # dynamodb, s3 and bot_api replace the default stand-ins, for benchmarks that need other data behind them
+    bot_api.latency = telegram_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), bot_api)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    install_clients(aws_latency, 'http://127.0.0.1:{}'.format(server.server_address[1]), dynamodb, s3)
+    return server
+
+
+def install_clients(aws_latency, api_url, dynamodb=None, s3=None):
+    # The stand-ins of one container, sending Bot API requests to a server that may run in another process
+    fakes = [FakeSSM(aws_latency), dynamodb or FakeDynamoDB(aws_latency), s3 or FakeS3(aws_latency)]
+    for fake in fakes + [FakeAWS(aws_latency)]:
+        getattr(app, fake.service).client = fake
+
+    telegram.API_URL = api_url
+    app.TelegramClient = FakeTelethonClient
+
+
+def reset_container():
+    # What a fresh container would have: no config, no caches, no Telethon clients
+    app.config_store.clear()
+    app.clients = {}
+    app.role_cache.clear()
+    app.banned_snapshot.clear()
+    app.username_resolver.clear()
+    app.raid_detector.clear()
+    app.update_deduplicator.clear()
+    app.document_cache.clear()
+    app.invocation_roles.begin()
+    app.handlers['/blacklist'].list_version_checked_at = None
+
+
+def load_events():
+    events = {}
+
+    for path in sorted(glob.glob(os.path.join(ROOT, 'events', '*.json'))):
+        with open(path) as event_file:
+            events[os.path.splitext(os.path.basename(path))[0]] = json.load(event_file)
+
+    return events
+
+
+def percentile(values, fraction):
+    # Nearest rank, so every reported value is one that was measured
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def summarize(timings, call_counts):
+    return {
+        'p50_ms': round(percentile(timings, 0.50), 1),
+        'p95_ms': round(percentile(timings, 0.95), 1),
+        'p99_ms': round(percentile(timings, 0.99), 1),
+        # Per invocation
+        'calls': {name: round(count / len(timings), 2) for name, count in sorted(call_counts.items())}
+    }
+
+
+def replay(event, iterations, cold):
+    timings = []
+    call_counts = Counter()
+
+    for _ in range(iterations):
+        if cold:
+            reset_container()
+
+        # Every replay is the same update, which the warm container would otherwise drop as a redelivery
+        app.update_deduplicator.clear()
+        calls.clear()
+        start = time.perf_counter()
+        app.lambda_handler(event, None)
+        timings.append((time.perf_counter() - start) * 1000)
+
+        # Config refreshes and other background work finish before the calls are counted
+        app.io_executor.submit(lambda: None).result()
+        call_counts.update(calls)
+
+    return summarize(timings, call_counts)
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Regressions in p50 and p95, and any event that now makes more outbound calls than before
+    failed = False
+
+    for name, result in results['events'].items():
+        previous = baseline['events'].get(name)
+        if previous is None:
+            continue
+
+        for mode in ['cold', 'warm']:
+            for key in ['p50_ms', 'p95_ms']:
+                before, after = previous[mode][key], result[mode][key]
+
+                # Differences of a millisecond or two are noise at any tolerance
+                if after > before * (1 + tolerance) and after - before > 2:
+                    print('REGRESSION: {} {} {} {}ms -> {}ms'.format(name, mode, key, before, after))
+                    failed = True
+
+            before, after = sum(previous[mode]['calls'].values()), sum(result[mode]['calls'].values())
+            if after > before:
+                print('REGRESSION: {} {} outbound calls {} -> {}'.format(name, mode, before, after))
+                failed = True
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--aws-latency', type=float, default=15, help='milliseconds per AWS call')
+    parser.add_argument('--telegram-latency', type=float, default=40, help='milliseconds per Bot API call')
+    parser.add_argument('--events', nargs='*', help='event names to replay, all of events/ by default')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline')
+    args = parser.parse_args()
+
+    server = install_fakes(args.aws_latency / 1000, args.telegram_latency / 1000)
+    results = {
+        'commit': current_commit(),
+        'settings': {
+            'iterations': args.iterations,
+            'aws_latency_ms': args.aws_latency,
+            'telegram_latency_ms': args.telegram_latency
+        },
+        'events': {}
+    }
+
+    print('{:<28} {:>28}  {:>28}'.format('', 'cold p50 / p95 / p99 ms  calls', 'warm p50 / p95 / p99 ms  calls'))
+
+    with open(os.devnull, 'w') as devnull:
+        for name, event in load_events().items():
+            if args.events and name not in args.events:
+                continue
+
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                result = {mode: replay(event, args.iterations, cold=mode == 'cold') for mode in ['cold', 'warm']}
+            finally:
+                sys.stdout = stdout
+
+            results['events'][name] = result
+            print('{:<28} {}  {}'.format(name, *[
+                '{:>7.1f} {:>7.1f} {:>7.1f} {:>5.1f}'.format(
+                    result[mode]['p50_ms'], result[mode]['p95_ms'], result[mode]['p99_ms'],
+                    sum(result[mode]['calls'].values())
+                ) for mode in ['cold', 'warm']
+            ]))
+
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+            output.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            return 1 if compare(results, json.load(baseline_file), args.tolerance) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
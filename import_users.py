@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Adds every user in a CSV file to the blacklist or whitelist, skipping users that are already on it. Accepts
+# id,username,reason rows with or without a header, and scrape_room.py output together with --reason.
+#
+#   ./import_users.py partner_list.csv --table Roles
+#   ./import_users.py room_members.csv --role whitelist
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autoblock_function'))
+
+from autoblock import blacklist, importer, whitelist  # noqa: E402
+import boto3  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--role', choices=['blacklist', 'whitelist'], default='blacklist')
+    parser.add_argument('--table', default=os.environ.get('ROLE_TABLE_NAME', 'Roles'))
+    parser.add_argument('--reason', help='reason for rows that do not give one')
+    args = parser.parse_args()
+
+    dynamodb = boto3.client('dynamodb')
+    if args.role == 'blacklist':
+        handler = blacklist.Handler(args.table, None, 'blacklist', dynamodb, None)
+    else:
+        handler = whitelist.Handler(args.table, 'whitelist', dynamodb)
+
+    start = time.perf_counter()
+    result = importer.ImportResult()
+
+    with open(args.path, encoding='utf-8-sig', newline='') as lines:
+        entries = importer.read_entries(lines, result, args.reason, handler.requires_reason)
+        importer.import_entries(handler, entries, result)
+
+    print('{} ({:.1f}s)'.format(result.summary(), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
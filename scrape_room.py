@@ -1,24 +1,83 @@
 #!/usr/bin/env python3
-from telethon import TelegramClient, sync
+# Writes the members of one or more rooms to <room>_members.csv. Rooms are scraped concurrently under a shared request
+# rate, and each one keeps a checkpoint, so an interrupted run picks up where it stopped when started again.
+#
+#   ./scrape_room.py @room_one @room_two --rate 3
+import argparse
+import asyncio
+import os
+import sys
 
-api_id = input("Enter api id: ")
-api_hash = input("Enter api hash: ")
-client = TelegramClient('scrape_room', api_id, api_hash)
-client.start()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autoblock_function'))
 
-while True:
-    room_name = input("Enter room name: ")
-    room = client.get_entity(room_name)
+from autoblock import participants  # noqa: E402
+from telethon import TelegramClient, errors  # noqa: E402
+from telethon.tl.functions.channels import GetParticipantsRequest  # noqa: E402
+from telethon.tl.types import Channel, ChannelParticipantsSearch  # noqa: E402
 
-    with open("{}_members.csv".format(room_name.strip("@")), "wb") as output:
-        output.write("id,username,first_name,last_name\n".encode("utf-8"))
 
-        for i, member in enumerate(client.iter_participants(room)):
-            username = member.username if member.username is not None else ""
-            first_name = member.first_name if member.first_name is not None else ""
-            last_name = member.last_name if member.last_name is not None else ""
-            output.write("{},{},\"{}\",\"{}\"\n".format(member.id, username, first_name, last_name).encode("utf-8"))
-            if i % 100 == 0:
-                print(".", end="")
+def page_fetcher(client, room, limiter):
+    async def fetch_channel_page(offset, limit):
+        while True:
+            try:
+                result = await client(GetParticipantsRequest(room, ChannelParticipantsSearch(''), offset, limit, 0))
+                return result.users, result.count
+            except errors.FloodWaitError as e:
+                print('Flood wait of {}s while scraping {}'.format(e.seconds, room.id))
+                limiter.pause(e.seconds)
+                await limiter.wait()
 
-        print()
+    async def fetch_chat_page(offset, limit):
+        # Basic groups have no paging, all of their members come back in one request
+        if offset > 0:
+            return [], None
+
+        members = await client.get_participants(room)
+        return members, len(members)
+
+    return fetch_channel_page if isinstance(room, Channel) else fetch_chat_page
+
+
+async def scrape_room(client, room_name, args, limiter, progress, rooms_running):
+    async with rooms_running:
+        name = room_name.strip('@')
+        room = await client.get_entity(room_name)
+
+        output_path = os.path.join(args.output_dir, '{}_members.{}'.format(name, args.format))
+        checkpoint = participants.Checkpoint(os.path.join(args.output_dir, '{}_members.checkpoint'.format(name)))
+
+        rows = await participants.scrape(
+            name, page_fetcher(client, room, limiter), output_path, checkpoint, limiter, progress, args.format
+        )
+        print('Finished {}: {} members in {}'.format(room_name, rows, output_path))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rooms', nargs='*', help='rooms to scrape, asked for when none are given')
+    parser.add_argument('--api-id', default=os.environ.get('TELEGRAM_API_ID'))
+    parser.add_argument('--api-hash', default=os.environ.get('TELEGRAM_API_HASH'))
+    parser.add_argument('--format', choices=sorted(participants.OUTPUTS), default='csv')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--concurrency', type=int, default=4, help='rooms scraped at once')
+    parser.add_argument('--rate', type=float, default=2, help='participant requests per second, across all rooms')
+    args = parser.parse_args()
+
+    api_id = args.api_id or input("Enter api id: ")
+    api_hash = args.api_hash or input("Enter api hash: ")
+    rooms = args.rooms or [room.strip() for room in input("Enter room names: ").split(',') if room.strip()]
+
+    limiter = participants.RateLimiter(args.rate)
+    progress = participants.Progress()
+    rooms_running = asyncio.Semaphore(args.concurrency)
+
+    async with TelegramClient('scrape_room', api_id, api_hash) as client:
+        await asyncio.gather(*[
+            scrape_room(client, room_name, args, limiter, progress, rooms_running) for room_name in rooms
+        ])
+
+    progress.report()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
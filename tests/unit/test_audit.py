@@ -0,0 +1,69 @@
+from autoblock_function.autoblock import audit
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+def pages_of(user_ids, page_size):
+    members = [(user_id, 'user{}'.format(user_id)) for user_id in user_ids]
+    return [(members[start:start + page_size], len(members)) for start in range(0, len(members), page_size)]
+
+
+def test_audit_checks_each_page_in_one_batch():
+    batches = []
+
+    def are_users_banned(user_ids):
+        batches.append(user_ids)
+        return {user_id: 'spam' if user_id % 3 == 0 else False for user_id in user_ids}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = audit.audit(iter(pages_of(range(1, 11), 4)), are_users_banned, executor)
+
+    assert batches == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    assert result.banned == [(3, 'user3', 'spam'), (6, 'user6', 'spam'), (9, 'user9', 'spam')]
+    assert (result.checked, result.total, result.next_offset, result.complete) == (10, 10, 10, True)
+
+
+def test_next_page_is_fetched_while_the_previous_one_is_checked():
+    fetched = []
+    checking = threading.Event()
+    release = threading.Event()
+
+    def pages():
+        for page in pages_of(range(1, 5), 2):
+            fetched.append(page[0][0][0])
+            yield page
+
+            # The first page's check is still running when the second page is requested
+            if len(fetched) == 1:
+                assert checking.wait(1)
+                release.set()
+
+    def are_users_banned(user_ids):
+        checking.set()
+        release.wait(1)
+        return {user_id: False for user_id in user_ids}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = audit.audit(pages(), are_users_banned, executor)
+
+    assert fetched == [1, 3]
+    assert result.checked == 4
+
+
+def test_audit_stops_at_the_deadline_with_an_offset_to_continue_from():
+    now = [0]
+
+    def pages():
+        for page in pages_of(range(1, 11), 2):
+            now[0] += 1
+            yield page
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = audit.audit(
+            pages(), lambda user_ids: dict.fromkeys(user_ids, False), executor, deadline=3, offset=40,
+            clock=lambda: now[0]
+        )
+
+    assert not result.complete
+    assert result.checked == 6
+    assert result.next_offset == 46
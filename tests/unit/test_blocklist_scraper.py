@@ -0,0 +1,119 @@
+from autoblock_function.autoblock import blocklist_scraper
+from autoblock_function.autoblock.export import MANIFEST_KEY
+from autoblock_function.autoblock.index_reader import CapacityLimiter, IndexReader, key_ranges
+from autoblock_function.autoblock.snapshot import SNAPSHOT_KEY, decode_ids
+from tests.unit.test_export import FakeS3
+import io
+import json
+import zipfile
+
+
+def role_item(user_id, username, reason):
+    return {
+        'pk': {'S': 'user_{}'.format(user_id)},
+        'sk': {'S': 'role_blacklist'},
+        'role_users_pk': {'S': 'role_blacklist'},
+        'role_users_sk': {'S': 'user_{}'.format(user_id)},
+        'username': {'S': username},
+        'reason': {'S': reason}
+    }
+
+
+class FakeIndex:
+    # Answers role_users range queries two items at a time
+    def __init__(self, items, page_size=2):
+        self.items = sorted(items, key=lambda item: item['role_users_sk']['S'])
+        self.page_size = page_size
+        self.queries = 0
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+        self.queries += 1
+        values = {name: value['S'] for name, value in ExpressionAttributeValues.items()}
+        matching = [
+            item for item in self.items
+            if item['role_users_pk']['S'] == values[':role']
+            and values[':lower'] <= item['role_users_sk']['S'] <= values[':upper']
+        ]
+
+        start = 0
+        if ExclusiveStartKey is not None:
+            start = matching.index(ExclusiveStartKey) + 1
+
+        response = {'Items': matching[start:start + self.page_size], 'ConsumedCapacity': {'CapacityUnits': 0.5}}
+        if start + self.page_size < len(matching):
+            response['LastEvaluatedKey'] = matching[start + self.page_size - 1]
+
+        return response
+
+
+def test_scraper_writes_list_and_snapshot(mocker):
+    s3 = FakeS3()
+    mocker.patch.object(blocklist_scraper, 's3', s3)
+    mocker.patch.object(blocklist_scraper, 'dynamodb', FakeIndex([
+        role_item(100, '@first', 'spam'), role_item(20, '@second', 'raid'), role_item(300, '@third', 'alt')
+    ]))
+
+    blocklist_scraper.lambda_handler({}, None)
+
+    archive = zipfile.ZipFile(io.BytesIO(s3.objects[blocklist_scraper.BLACKLIST_KEY]))
+    assert archive.read('usernames.txt').decode('utf-8') == \
+        '@first (100) spam\n@second (20) raid\n@third (300) alt\n'
+    assert list(decode_ids(s3.objects[SNAPSHOT_KEY])) == [20, 100, 300]
+
+
+def test_key_ranges_partition_user_keys():
+    ranges = key_ranges(digits=2)
+    assert len(ranges) == 90
+
+    for user_id in [1, 9, 10, 19, 2, 20, 99, 100, 999999402, 7000000000]:
+        key = 'user_{}'.format(user_id)
+        assert len([lower for lower, upper in ranges if lower <= key <= upper]) == 1
+
+    assert [lower for lower, _ in ranges] == sorted(lower for lower, _ in ranges)
+
+
+def test_parallel_read_matches_sequential_order():
+    user_ids = [1, 7, 15, 150, 1500, 19, 2, 25, 5000000000, 5999999999, 6123456789, 999999402, 98, 99]
+    index = FakeIndex([role_item(user_id, '@u{}'.format(user_id), 'r') for user_id in user_ids])
+    reader = IndexReader(index, 'Roles', 'role_users', concurrency=4, digits=2, buffered_pages=1)
+
+    read = [item['role_users_sk']['S'] for item in reader.read('role_blacklist')]
+
+    assert read == sorted('user_{}'.format(user_id) for user_id in user_ids)
+    assert reader.consumed == 0.5 * index.queries
+
+
+def test_capacity_limiter_waits_out_debt(mocker):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = CapacityLimiter(100, clock=lambda: now[0], sleep=sleep)
+    limiter.wait()
+    limiter.consume(250)
+    limiter.wait()
+
+    assert sleeps == [1.5]
+
+
+def test_unchanged_list_is_not_republished(mocker):
+    s3 = FakeS3()
+    mocker.patch.object(blocklist_scraper, 's3', s3)
+    mocker.patch.object(blocklist_scraper, 'dynamodb', FakeIndex([role_item(1, '@one', 'spam')]))
+
+    blocklist_scraper.lambda_handler({}, None)
+    manifest = json.loads(s3.objects[MANIFEST_KEY])
+    assert manifest['count'] == 1
+    assert sorted(artifact['format'] for artifact in manifest['artifacts']) == \
+        ['base.jsonl.gz', 'csv.gz', 'ids', 'ndjson.gz', 'zip']
+
+    s3.written = []
+    blocklist_scraper.lambda_handler({}, None)
+
+    assert s3.written == []
+    # The snapshot still gets a new modification time, tagged with its hash since the copy may change its ETag
+    ids_sha256 = [artifact['sha256'] for artifact in manifest['artifacts'] if artifact['format'] == 'ids']
+    assert s3.copies[-1] == (SNAPSHOT_KEY, {'sha256': ids_sha256[0]})
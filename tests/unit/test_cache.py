@@ -0,0 +1,54 @@
+from autoblock_function.autoblock.cache import MISSING, RoleCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hit_and_miss():
+    cache = RoleCache(max_size=10, ttl=60)
+
+    assert cache.get('blacklist', 1) is MISSING
+    cache.put('blacklist', 1, False)
+
+    assert cache.get('blacklist', 1) is False
+    assert cache.get('whitelist', 1) is MISSING
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 2, 'evictions': 0}
+
+
+def test_cache_expires_entries():
+    clock = FakeClock()
+    cache = RoleCache(max_size=10, ttl=60, clock=clock)
+    cache.put('blacklist', 1, 'spam')
+
+    clock.now = 59
+    assert cache.get('blacklist', 1) == 'spam'
+
+    clock.now = 60
+    assert cache.get('blacklist', 1) is MISSING
+    assert cache.stats()['size'] == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = RoleCache(max_size=2, ttl=60)
+    cache.put('blacklist', 1, 'a')
+    cache.put('blacklist', 2, 'b')
+    cache.get('blacklist', 1)
+    cache.put('blacklist', 3, 'c')
+
+    assert cache.get('blacklist', 2) is MISSING
+    assert cache.get('blacklist', 1) == 'a'
+    assert cache.get('blacklist', 3) == 'c'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_cache_invalidate():
+    cache = RoleCache()
+    cache.put('blacklist', '1', 'a')
+    cache.invalidate('blacklist', 1)
+
+    assert cache.get('blacklist', 1) is MISSING
@@ -0,0 +1,15 @@
+import subprocess
+import sys
+
+
+def test_module_initialization_defers_admin_dependencies():
+    # Join events must not pay for Telethon or boto3 client construction on a cold start
+    result = subprocess.run(
+        [sys.executable, '-c', 'import sys; from autoblock import app; print(sorted(sys.modules))'],
+        cwd='autoblock_function', capture_output=True, text=True, check=True
+    )
+
+    assert "'telethon'" not in result.stdout
+    assert "'boto3'" not in result.stdout
+    assert "'autoblock.audit'" not in result.stdout
+    assert "'autoblock.participants'" not in result.stdout
@@ -0,0 +1,116 @@
+from autoblock_function.autoblock import configuration, spans
+import pytest
+
+
+def parameter(name, value, version=1, parameter_type='String'):
+    return {'Name': '/autoblock_bot/{}'.format(name), 'Value': value, 'Type': parameter_type, 'Version': version}
+
+
+class FakeSSM:
+    def __init__(self, parameters, page_size=2):
+        self.parameters = parameters
+        self.page_size = page_size
+        self.calls = []
+
+    def get_parameters_by_path(self, Path, NextToken=None):
+        self.calls.append(NextToken)
+        start = int(NextToken or 0)
+        response = {'Parameters': self.parameters[start:start + self.page_size]}
+
+        if start + self.page_size < len(self.parameters):
+            response['NextToken'] = str(start + self.page_size)
+
+        return response
+
+
+class QueuedExecutor:
+    def __init__(self):
+        self.queued = []
+
+    def submit(self, function):
+        self.queued.append(function)
+
+    def run(self):
+        while self.queued:
+            self.queued.pop(0)()
+
+
+def config_parameters(root_users='1,2', version=1):
+    return [
+        parameter('api_id', 'API_ID'),
+        parameter('api_hash', 'API_HASH'),
+        parameter('bot_key', '88888888:TEST'),
+        parameter('root_users', root_users, version, 'StringList')
+    ]
+
+
+def test_config_is_read_across_pages(capsys):
+    ssm = FakeSSM(config_parameters())
+    store = configuration.ConfigStore(ssm, '/autoblock_bot', ['api_id', 'api_hash', 'root_users'])
+
+    config = store.get()
+
+    assert ssm.calls == [None, '2']
+    assert config['api_hash'] == 'API_HASH'
+    assert config.admins == frozenset({1, 2})
+    # Secrets are never logged
+    assert 'API_HASH' not in capsys.readouterr().out
+
+
+def test_missing_parameter_fails_the_first_load():
+    store = configuration.ConfigStore(FakeSSM(config_parameters()[:2]), '/autoblock_bot', ['root_users'])
+
+    with pytest.raises(Exception):
+        store.get()
+
+    assert store.current is None
+
+
+def test_stale_config_is_refreshed_in_the_background():
+    now = [0]
+    ssm = FakeSSM(config_parameters())
+    executor = QueuedExecutor()
+    store = configuration.ConfigStore(ssm, '/autoblock_bot', ['root_users'], 60, executor, clock=lambda: now[0])
+    first = store.get()
+
+    # An unchanged config keeps its object, and the refresh is only queued once
+    now[0] = 61
+    assert store.get() is first
+    assert store.get() is first
+    assert len(executor.queued) == 1
+    executor.run()
+    assert store.current is first
+    assert len(ssm.calls) == 4
+
+    ssm.parameters = config_parameters('1,2,3', version=2)
+    now[0] = 122
+    assert 3 not in store.get().admins
+    executor.run()
+    assert store.get().admins == frozenset({1, 2, 3})
+
+    # A refresh that fails keeps serving the last good config
+    ssm.parameters = []
+    now[0] = 183
+    store.get()
+    executor.run()
+    assert store.get().admins == frozenset({1, 2, 3})
+
+
+def test_background_refresh_is_not_timed_as_part_of_an_invocation():
+    now = [0]
+    executor = QueuedExecutor()
+    stages = spans.Spans()
+    store = configuration.ConfigStore(
+        FakeSSM(config_parameters()), '/autoblock_bot', ['root_users'], 60, executor, clock=lambda: now[0],
+        spans=stages
+    )
+
+    store.get()
+    assert stages.fields()['stage_calls'] == {'ssm.get_parameters_by_path': 2}
+
+    # The refresh runs while a later invocation is being timed
+    now[0] = 61
+    store.get()
+    stages.begin()
+    executor.run()
+    assert stages.fields()['stage_calls'] == {}
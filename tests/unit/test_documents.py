@@ -0,0 +1,33 @@
+from autoblock_function.autoblock.documents import DocumentCache
+
+
+def test_lookup_matches_version(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.get_item.return_value = {'Item': {'version': {'S': '"v1"'}, 'file_id': {'S': 'FILE'}}}
+    documents = DocumentCache('Roles', dynamodb)
+
+    assert documents.lookup('1', 'blocklist', '"v1"') == 'FILE'
+    assert documents.lookup('1', 'blocklist', '"v1"') == 'FILE'
+    assert dynamodb.get_item.call_count == 1
+
+    # A new version is checked against the table once more, in case another container already sent it
+    assert documents.lookup('1', 'blocklist', '"v2"') is None
+    assert dynamodb.get_item.call_count == 2
+    assert documents.stats() == {'size': 1, 'hits': 2, 'misses': 1}
+
+
+def test_file_ids_are_per_bot(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.get_item.return_value = {}
+    documents = DocumentCache('Roles', dynamodb)
+
+    documents.remember('1', 'blocklist', '"v1"', 'FILE')
+
+    assert documents.lookup('1', 'blocklist', '"v1"') == 'FILE'
+    assert documents.lookup('2', 'blocklist', '"v1"') is None
+
+    documents.invalidate('1', 'blocklist')
+    assert documents.lookup('1', 'blocklist', '"v1"') is None
+    dynamodb.delete_item.assert_called_once_with(
+        TableName='Roles', Key={'pk': {'S': 'document_blocklist'}, 'sk': {'S': 'bot_1'}}
+    )
@@ -0,0 +1,189 @@
+from autoblock_function.autoblock.export import EXPORTERS, MultipartUploadWriter, ZipExporter, export_all
+from autoblock_function.autoblock.snapshot import IdCollector, decode_ids
+from botocore.exceptions import ClientError
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import pytest
+import zipfile
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.parts = []
+        self.uploads = {}
+        self.written = []
+        self.aborted = False
+        self.copies = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        self.written.append(Key)
+
+    def create_multipart_upload(self, Key, **kwargs):
+        self.uploads[Key] = []
+        return {'UploadId': Key}
+
+    def upload_part(self, UploadId, PartNumber, Body, **kwargs):
+        self.parts.append(Body)
+        self.uploads[UploadId].append(bytes(Body))
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Key, UploadId, MultipartUpload, **kwargs):
+        parts = self.uploads.pop(UploadId)
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == list(range(1, len(parts) + 1))
+        self.objects[Key] = b''.join(parts)
+        self.written.append(Key)
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[Key]
+
+    def copy_object(self, Bucket, Key, CopySource, Metadata=None, **kwargs):
+        self.objects[Key] = self.objects[CopySource['Key']]
+        self.copies.append((Key, Metadata))
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [{'Key': key} for key in self.objects if key.startswith(Prefix)]}
+
+
+def export_zip(entries, s3, part_size=16 * 1024):
+    with MultipartUploadWriter(s3, 'bucket', 'list.zip', part_size=part_size) as output:
+        export_all(entries, [ZipExporter(output)])
+
+
+def test_zip_is_streamed_in_parts():
+    s3 = FakeS3()
+    export_zip(((i, 'user{}'.format(i), 'reason') for i in range(20000)), s3)
+
+    assert len(s3.parts) > 1
+    with zipfile.ZipFile(io.BytesIO(s3.objects['list.zip'])) as archive:
+        text = archive.read('usernames.txt').decode('utf-8')
+
+    assert text.splitlines()[0] == 'user0 (0) reason'
+    assert len(text.splitlines()) == 20000
+
+
+def test_small_output_uses_single_put():
+    s3 = FakeS3()
+    export_zip([(1, 'a', 'b')], s3, part_size=1024 * 1024)
+
+    assert s3.parts == []
+    assert zipfile.ZipFile(io.BytesIO(s3.objects['list.zip'])).read('usernames.txt') == b'a (1) b\n'
+
+
+def test_failed_export_aborts_upload():
+    s3 = FakeS3()
+
+    def entries():
+        # Random data, so the compressed output spans several parts
+        yield 1, os.urandom(50000).hex(), 'reason'
+        raise RuntimeError('query failed')
+
+    with pytest.raises(RuntimeError):
+        export_zip(entries(), s3, part_size=1024)
+
+    assert s3.aborted
+    assert 'list.zip' not in s3.objects
+
+
+def test_unchanged_output_is_not_uploaded_again():
+    entries = [(i, '@user{}'.format(i), os.urandom(16).hex()) for i in range(5000)]
+    s3 = FakeS3()
+
+    with MultipartUploadWriter(s3, 'bucket', 'list.zip', part_size=1024) as first:
+        export_all(entries, [ZipExporter(first)])
+    uploaded = s3.objects['list.zip']
+    del s3.objects['list.zip']
+
+    with MultipartUploadWriter(s3, 'bucket', 'list.zip', part_size=1024,
+                               previous_sha256=first.sha256.hexdigest()) as second:
+        export_all(entries, [ZipExporter(second)])
+
+    # The parts were streamed as usual, and the upload is dropped once the hash matches
+    assert second.skipped
+    assert s3.aborted
+    assert 'list.zip' not in s3.objects
+    assert second.sha256.hexdigest() == first.sha256.hexdigest() == hashlib.sha256(uploaded).hexdigest()
+
+
+def test_unchanged_small_output_is_not_sent():
+    s3 = FakeS3()
+
+    with MultipartUploadWriter(s3, 'bucket', 'list.ids', previous_sha256=hashlib.sha256(b'ids').hexdigest()) as writer:
+        writer.write(b'ids')
+
+    assert writer.skipped
+    assert s3.parts == [] and s3.written == [] and not s3.aborted
+
+
+def test_formats_written_in_one_pass():
+    entries = [(20, '@second', 'raid, again'), (3, '@third', None)]
+    outputs = {format_name: io.BytesIO() for format_name in ['ids', 'csv.gz', 'ndjson.gz', 'base.jsonl.gz']}
+
+    assert export_all(iter(entries), [EXPORTERS[name](output) for name, output in outputs.items()]) == 2
+
+    assert list(decode_ids(outputs['ids'].getvalue())) == [3, 20]
+    assert list(csv.reader(io.StringIO(gzip.decompress(outputs['csv.gz'].getvalue()).decode('utf-8')))) == [
+        ['user_id', 'username', 'reason'], ['20', '@second', 'raid, again'], ['3', '@third', '']
+    ]
+    assert [json.loads(line) for line in gzip.decompress(outputs['ndjson.gz'].getvalue()).splitlines()] == [
+        {'user_id': 20, 'username': '@second', 'reason': 'raid, again'},
+        {'user_id': 3, 'username': '@third', 'reason': None}
+    ]
+    assert gzip.decompress(outputs['base.jsonl.gz'].getvalue()) == b'[20, "@second", "raid, again"]\n[3, "@third", null]\n'
+
+
+def collected_ids(user_ids, chunk=2):
+    collector = IdCollector(chunk)
+    for user_id in user_ids:
+        collector.add(user_id)
+
+    output = io.BytesIO()
+    collector.write_to(output)
+    return collector, list(decode_ids(output.getvalue()))
+
+
+def test_id_collector_orders_index_pages_without_sorting():
+    # role_users_sk order: "user_10" < "user_2" < "user_30"
+    collector, user_ids = collected_ids([10, 2, 30, 5000], chunk=100)
+
+    assert collector.ordered
+    assert user_ids == [2, 10, 30, 5000]
+
+    collector, user_ids = collected_ids([10, 2, 30, 5000, 1], chunk=100)
+    assert not collector.ordered
+    assert user_ids == [1, 2, 10, 30, 5000]
+
+
+def test_id_collector_spills_each_length_in_order(mocker):
+    spills = []
+    create = tempfile.TemporaryFile
+    mocker.patch.object(tempfile, 'TemporaryFile', side_effect=lambda: spills.append(create()) or spills[-1])
+    index_order = sorted(range(1, 200), key=str)
+
+    collector, user_ids = collected_ids(index_order, chunk=8)
+
+    assert user_ids == list(range(1, 200))
+    # One spill file for each length with more than a chunk of ids, removed once written out
+    assert len(spills) == 3
+    assert all(spill.closed for spill in spills)
+
+    # Out of order ids that have been spilled are still sorted
+    collector, user_ids = collected_ids(index_order + [5, 3], chunk=8)
+    assert user_ids == list(range(1, 200))
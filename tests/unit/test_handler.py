@@ -1,5 +1,7 @@
-from autoblock_function.autoblock import app
-import requests, pytest, json, io
+from autoblock_function.autoblock import app, snapshot, telegram
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+import pytest, json, io
 
 
 TEST_USER_ID = 99999999
@@ -7,6 +9,13 @@ BOT_USER_ID = 88888888
 BOT_KEY = '88888888:TEST'
 
 
+def as_new_update(event, offset=1):
+    # The same message in a later update, since a repeated update_id is dropped as a redelivery
+    body = json.loads(event['body'])
+    body['update_id'] += offset
+    return dict(event, body=json.dumps(body))
+
+
 @pytest.fixture()
 def message_event():
     return json.load(open('events/message.json'))
@@ -17,6 +26,11 @@ def new_member_event():
     return json.load(open('events/new_member.json'))
 
 
+@pytest.fixture()
+def new_members_event():
+    return json.load(open('events/new_members.json'))
+
+
 @pytest.fixture()
 def new_member_whitelist_event():
     return json.load(open('events/new_member_whitelist.json'))
@@ -67,6 +81,21 @@ def start_command_event():
     return json.load(open('events/start_command.json'))
 
 
+@pytest.fixture()
+def getlist_command_event():
+    return json.load(open('events/getlist_command.json'))
+
+
+@pytest.fixture()
+def audit_command_event():
+    return json.load(open('events/audit_command.json'))
+
+
+@pytest.fixture()
+def import_document_event():
+    return json.load(open('events/import_document.json'))
+
+
 @pytest.fixture()
 def bot_new_chat_event():
     return json.load(open('events/bot_new_chat.json'))
@@ -133,14 +162,30 @@ def non_added_user_response():
 def mock_setup(ssm_configuration, mocker):
     mocker.patch('autoblock_function.autoblock.app.ssm.get_parameters_by_path')
     mocker.patch('autoblock_function.autoblock.app.dynamodb.get_item')
+    mocker.patch('autoblock_function.autoblock.app.dynamodb.batch_get_item')
+    mocker.patch('autoblock_function.autoblock.app.dynamodb.query')
     mocker.patch('autoblock_function.autoblock.app.dynamodb.put_item')
     mocker.patch('autoblock_function.autoblock.app.dynamodb.delete_item')
+    mocker.patch('autoblock_function.autoblock.app.dynamodb.update_item')
     mocker.patch('autoblock_function.autoblock.app.cloudwatch.put_metric_data')
-    mocker.patch('requests.post')
+    mocker.patch('autoblock_function.autoblock.app.s3.get_object')
+    mocker.patch('autoblock_function.autoblock.telegram.session.post')
     mocker.patch('autoblock_function.autoblock.app.TelegramClient')
 
     app.ssm.get_parameters_by_path.return_value = ssm_configuration
+    telegram.session.post.return_value.status_code = 200
     app.clients = {}
+    app.config_store.clear()
+    app.role_cache.clear()
+    app.username_resolver.clear()
+    app.raid_detector.clear()
+    app.update_deduplicator.clear()
+    mocker.patch.object(app.username_resolver, 'load', return_value=None)
+    mocker.patch.object(app.username_resolver, 'store')
+    app.banned_snapshot.clear()
+    app.document_cache.clear()
+    app.handlers['/blacklist'].list_version_checked_at = None
+    app.s3.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
 
 
 @pytest.fixture()
@@ -159,7 +204,7 @@ def test_bad_ssm_config(message_event, mock_bad_setup):
     with pytest.raises(Exception):
         app.lambda_handler(message_event, "")
 
-    assert app.config is None
+    assert app.config_store.current is None
 
 
 def test_message_event(message_event, mock_setup):
@@ -168,7 +213,7 @@ def test_message_event(message_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    assert requests.post.call_count == 0
+    assert telegram.session.post.call_count == 0
 
 
 def test_start_command_event(start_command_event, mock_setup):
@@ -177,7 +222,7 @@ def test_start_command_event(start_command_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
@@ -185,8 +230,59 @@ def test_start_command_event(start_command_event, mock_setup):
                     ' room owners secure their rooms from raids and alt-right recruiters. Simply add to your room and'
                     ' the bot will autoblock any Nazifur on its list of users from your room before any trouble can'
                     ' start.'
-        }
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def published_list(sha256):
+    manifest = {'artifacts': [{'format': 'zip', 'key': 'autoblock_blacklist.zip', 'sha256': sha256}]}
+    return lambda **kwargs: {'Body': io.BytesIO(json.dumps(manifest).encode('utf-8'))}
+
+
+def test_getlist_reuses_uploaded_document(getlist_command_event, mock_setup, mocker):
+    app.s3.get_object.side_effect = published_list('v1')
+    mocker.patch.object(app.s3, 'generate_presigned_url', return_value='https://example.com/list.zip')
+    app.dynamodb.get_item.return_value = {}
+    telegram.session.post.return_value.ok = True
+    telegram.session.post.return_value.json.return_value = {'ok': True, 'result': {'document': {'file_id': 'FILE'}}}
+    url = 'https://api.telegram.org/bot{}/sendDocument'.format(BOT_KEY)
+
+    app.lambda_handler(getlist_command_event, "")
+
+    telegram.session.post.assert_called_once_with(
+        url, data={'chat_id': 99999999, 'reply_to_message_id': 14, 'document': 'https://example.com/list.zip'},
+        timeout=telegram.TIMEOUT
     )
+    app.dynamodb.put_item.assert_called_once_with(TableName='Roles', Item={
+        'pk': {'S': 'document_blocklist'},
+        'sk': {'S': 'bot_88888888'},
+        'version': {'S': 'v1'},
+        'file_id': {'S': 'FILE'}
+    })
+
+    telegram.session.post.reset_mock()
+    app.lambda_handler(as_new_update(getlist_command_event), "")
+
+    telegram.session.post.assert_called_once_with(
+        url, data={'chat_id': 99999999, 'reply_to_message_id': 14, 'document': 'FILE'}, timeout=telegram.TIMEOUT
+    )
+    assert app.s3.generate_presigned_url.call_count == 1
+    assert app.s3.get_object.call_count == 1
+
+
+def test_getlist_resends_new_list_version(getlist_command_event, mock_setup, mocker):
+    app.s3.get_object.side_effect = published_list('v2')
+    mocker.patch.object(app.s3, 'generate_presigned_url', return_value='https://example.com/list.zip')
+    app.dynamodb.get_item.return_value = {
+        'Item': {'version': {'S': 'v1'}, 'file_id': {'S': 'OLD'}}
+    }
+    telegram.session.post.return_value.json.return_value = {'ok': True, 'result': {'document': {'file_id': 'NEW'}}}
+
+    app.lambda_handler(getlist_command_event, "")
+
+    assert telegram.session.post.call_args.kwargs['data']['document'] == 'https://example.com/list.zip'
+    assert app.document_cache.lookup('88888888', 'blocklist', 'v2') == 'NEW'
 
 
 def test_bot_new_chat_event(bot_new_chat_event, mock_setup):
@@ -195,12 +291,13 @@ def test_bot_new_chat_event(bot_new_chat_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': -1009999992388,
             'text': 'In order for this bot to be operational in this chat, it must be made an admin.'
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -212,7 +309,7 @@ def test_non_banned_user(new_member_event, non_added_user_response, mock_setup):
     
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 1
-    assert requests.post.call_count == 0
+    assert telegram.session.post.call_count == 0
 
 
 def test_whitelisted_user(new_member_whitelist_event, added_user_whitelist_response, mock_setup):
@@ -229,7 +326,7 @@ def test_whitelisted_user(new_member_whitelist_event, added_user_whitelist_respo
             'sk': {'S': 'role_whitelist'}
         }
     )
-    assert requests.post.call_count == 0
+    assert telegram.session.post.call_count == 0
 
 
 def test_blacklisted_user(new_member_event, added_user_response, mock_setup):
@@ -246,12 +343,13 @@ def test_blacklisted_user(new_member_event, added_user_response, mock_setup):
             'sk': {'S': 'role_blacklist'}
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
         data={
             'chat_id': -1009999992388,
             'user_id': 999999402
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -269,12 +367,13 @@ def test_non_whitelisted_user(new_member_whitelist_event, non_added_user_respons
             'sk': {'S': 'role_whitelist'}
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
         data={
             'chat_id': -1009999992388,
             'user_id': 999999402
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -284,13 +383,14 @@ def test_unknown_command(unknown_command_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': 'Unknown command'
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -312,13 +412,14 @@ def test_command(
         Key={'pk': {'S': 'user_{}'.format(TEST_USER_ID)}, 'sk': {'S': 'role_blacklist'}}
     )
     app.clients[BOT_KEY].get_entity.assert_called_once_with('@test_user')
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': f'@test_user ({TEST_USER_ID}) is banned: test account'
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -328,7 +429,7 @@ def test_public_command(public_command_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    assert requests.post.call_count == 0
+    assert telegram.session.post.call_count == 0
 
 
 def test_command_from_non_admin(remove_non_admin_command_event, mock_setup):
@@ -338,7 +439,7 @@ def test_command_from_non_admin(remove_non_admin_command_event, mock_setup):
 
     assert ret['statusCode'] == 200
     assert app.dynamodb.get_item.call_count == 0
-    assert requests.post.call_count == 0
+    assert telegram.session.post.call_count == 0
 
 
 def test_add_command(
@@ -370,13 +471,14 @@ def test_add_command(
             'reason': {'S': 'test ban'}
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': f'@test_user ({TEST_USER_ID}) has been added: test ban'
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -408,13 +510,14 @@ def test_add_whitelist_command(
             'username': {'S': '@test_user'},
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': '@test_user ({}) has been added: member'.format(TEST_USER_ID)
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -437,13 +540,14 @@ def test_add_command_added_user(
     )
     app.clients[BOT_KEY].get_entity.assert_called_once_with('@test_user')
     assert app.dynamodb.put_item.call_count == 0
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': '@test_user ({}) is already added: test account'.format(TEST_USER_ID)
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -472,13 +576,14 @@ def test_remove_command(
             'sk': {'S': 'role_blacklist'}
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': '@test_user ({}) has been removed'.format(TEST_USER_ID)
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -507,13 +612,14 @@ def test_remove_whitelist_command(
             'sk': {'S': 'role_whitelist'}
         }
     )
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': '@test_user ({}) has been removed'.format(TEST_USER_ID)
-        }
+        },
+        timeout=telegram.TIMEOUT
     )
 
 
@@ -536,11 +642,613 @@ def test_remove_command_non_added_user(
     )
     app.clients[BOT_KEY].get_entity.assert_called_once_with('@test_user')
     assert app.dynamodb.delete_item.call_count == 0
-    requests.post.assert_called_once_with(
+    telegram.session.post.assert_called_once_with(
         'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
         data={
             'chat_id': 99999999,
             'reply_to_message_id': 13,
             'text': '@test_user ({}) is not added'.format(TEST_USER_ID)
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_repeated_join_uses_role_cache(new_member_event, added_user_response, mock_setup, capsys):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+
+    app.lambda_handler(new_member_event, "")
+    app.lambda_handler(as_new_update(new_member_event), "")
+
+    assert app.dynamodb.get_item.call_count == 1
+    assert telegram.session.post.call_count == 2
+    assert app.role_cache.stats()['hits'] == 1
+
+    # Each invocation reports its own cache lookups
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert [document.get('RoleCacheMiss') for document in documents] == [1, None]
+    assert [document.get('RoleCacheHit') for document in documents] == [None, 1]
+
+
+def test_non_banned_user_is_negatively_cached(new_member_event, non_added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = non_added_user_response
+
+    app.lambda_handler(new_member_event, "")
+    app.lambda_handler(new_member_event, "")
+
+    assert app.dynamodb.get_item.call_count == 1
+    assert telegram.session.post.call_count == 0
+
+
+def test_add_command_invalidates_role_cache(
+    add_command_event,
+    new_member_event,
+    non_added_user_response,
+    added_user_response,
+    telegram_test_user_entity,
+    mock_setup
+):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = non_added_user_response
+    app.TelegramClient.return_value = telegram_test_user_entity
+
+    app.lambda_handler(add_command_event, "")
+    app.dynamodb.get_item.return_value = added_user_response
+
+    assert app.handlers['/blacklist'].has_role(TEST_USER_ID) == 'test account'
+    assert app.dynamodb.get_item.call_count == 2
+
+
+def test_snapshot_answers_non_banned_user(new_member_event, mock_setup):
+    # pylint: disable=no-member
+    app.s3.get_object.side_effect = None
+    app.s3.get_object.return_value = {
+        'Body': io.BytesIO(snapshot.encode_ids([5, 999999403])),
+        'ETag': '"etag"',
+        'LastModified': datetime.now(timezone.utc)
+    }
+
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret['statusCode'] == 200
+    assert app.dynamodb.get_item.call_count == 0
+    assert telegram.session.post.call_count == 0
+
+
+def test_snapshot_hit_is_confirmed(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+    app.s3.get_object.side_effect = None
+    app.s3.get_object.return_value = {
+        'Body': io.BytesIO(snapshot.encode_ids([999999402])),
+        'ETag': '"etag"',
+        'LastModified': datetime.now(timezone.utc)
+    }
+
+    app.lambda_handler(new_member_event, "")
+
+    assert app.dynamodb.get_item.call_count == 1
+    assert telegram.session.post.call_count == 1
+
+
+def test_stale_snapshot_falls_back(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+    app.s3.get_object.side_effect = None
+    app.s3.get_object.return_value = {
+        'Body': io.BytesIO(snapshot.encode_ids([])),
+        'ETag': '"etag"',
+        'LastModified': datetime(2020, 1, 1, tzinfo=timezone.utc)
+    }
+
+    app.lambda_handler(new_member_event, "")
+
+    assert app.dynamodb.get_item.call_count == 1
+    assert telegram.session.post.call_count == 1
+
+
+def test_multiple_new_members_use_one_batch_read(new_members_event, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.batch_get_item.return_value = {
+        'Responses': {
+            'Roles': [{'pk': {'S': 'user_999999404'}, 'sk': {'S': 'role_blacklist'}, 'reason': {'S': 'spam'}}]
+        },
+        'UnprocessedKeys': {}
+    }
+
+    ret = app.lambda_handler(new_members_event, "")
+
+    assert ret['statusCode'] == 200
+    assert app.dynamodb.get_item.call_count == 0
+    app.dynamodb.batch_get_item.assert_called_once_with(RequestItems={
+        'Roles': {
+            'Keys': [
+                {'pk': {'S': 'user_{}'.format(user_id)}, 'sk': {'S': 'role_blacklist'}}
+                for user_id in [999999402, 999999403, 999999404]
+            ]
         }
+    })
+    telegram.session.post.assert_called_once_with(
+        'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
+        data={
+            'chat_id': -1009999992388,
+            'user_id': 999999404
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_multiple_new_members_retry_unprocessed_keys(new_members_event, mocker, mock_setup):
+    # pylint: disable=no-member
+    mocker.patch('autoblock_function.autoblock.roles.time.sleep')
+    unprocessed = {'Roles': {'Keys': [{'pk': {'S': 'user_999999403'}, 'sk': {'S': 'role_blacklist'}}]}}
+    app.dynamodb.batch_get_item.side_effect = [
+        {'Responses': {'Roles': [{'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}}]},
+         'UnprocessedKeys': unprocessed},
+        {'Responses': {'Roles': [{'pk': {'S': 'user_999999403'}, 'sk': {'S': 'role_blacklist'}}]},
+         'UnprocessedKeys': {}}
+    ]
+
+    app.lambda_handler(new_members_event, "")
+
+    assert app.dynamodb.batch_get_item.call_count == 2
+    app.dynamodb.batch_get_item.assert_called_with(RequestItems=unprocessed)
+    assert sorted(call.kwargs['data']['user_id'] for call in telegram.session.post.call_args_list) == [999999402, 999999403]
+
+
+def test_metrics_are_flushed_once_as_emf(new_members_event, mock_setup, capsys):
+    # pylint: disable=no-member
+    app.dynamodb.batch_get_item.return_value = {
+        'Responses': {'Roles': [
+            {'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}},
+            {'pk': {'S': 'user_999999403'}, 'sk': {'S': 'role_blacklist'}}
+        ]}
+    }
+
+    app.lambda_handler(new_members_event, "")
+
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert app.cloudwatch.put_metric_data.call_count == 0
+    assert len(documents) == 1
+    assert documents[0]['UserRemoved'] == 2
+    assert documents[0]['BotId'] == str(BOT_USER_ID)
+    assert documents[0]['Path'] == '/blacklist'
+    assert documents[0]['ChatType'] == 'supergroup'
+    assert documents[0]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [[], ['BotId', 'ChatType', 'Path']]
+
+
+def test_stage_timings_are_logged_once(new_members_event, mock_setup, capsys):
+    # pylint: disable=no-member
+    app.dynamodb.batch_get_item.return_value = {
+        'Responses': {'Roles': [{'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}}]}
+    }
+
+    app.lambda_handler(new_members_event, "")
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"path"')]
+    assert len(lines) == 1
+    assert lines[0]['stage_calls'] == {
+        'dynamodb.batch_get_item': 1,
+        'metrics.flush': 1,
+        'snapshot.lookup': 1,
+        'ssm.get_parameters_by_path': 1,
+        'telegram.kickChatMember': 1
+    }
+    assert set(lines[0]['stage_ms']) == set(lines[0]['stage_calls'])
+
+
+def test_resolved_usernames_skip_telethon(is_banned_command_event, added_user_response, mocker, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+    app.TelegramClient.return_value = mocker.Mock(spec=['start', 'get_entity'])
+    app.TelegramClient.return_value.get_entity.return_value = mocker.Mock(id=TEST_USER_ID)
+
+    app.lambda_handler(is_banned_command_event, "")
+    app.lambda_handler(as_new_update(is_banned_command_event), "")
+
+    assert app.TelegramClient.call_count == 1
+    app.clients[BOT_KEY].get_entity.assert_called_once_with('@test_user')
+    app.username_resolver.store.assert_called_once_with('test_user', TEST_USER_ID)
+    assert telegram.session.post.call_count == 2
+
+
+def test_stored_username_avoids_starting_telethon(is_banned_command_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+    app.username_resolver.load.return_value = TEST_USER_ID
+
+    app.lambda_handler(is_banned_command_event, "")
+
+    assert app.TelegramClient.call_count == 0
+    app.username_resolver.load.assert_called_once_with('test_user')
+    assert telegram.session.post.call_args.kwargs['data']['text'] == \
+        f'@test_user ({TEST_USER_ID}) is banned: test account'
+
+
+def test_join_events_seed_username_cache(new_member_event, non_added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = non_added_user_response
+
+    app.lambda_handler(new_member_event, "")
+
+    assert app.username_resolver.lookup('@TestUser') == 999999402
+    assert app.username_resolver.store.call_count == 0
+
+
+def test_inline_reply_is_returned_in_webhook_response(unknown_command_event, mocker, mock_setup):
+    # pylint: disable=no-member
+    mocker.patch.object(app, 'INLINE_WEBHOOK_RESPONSES', True)
+
+    ret = app.lambda_handler(unknown_command_event, "")
+
+    assert ret['statusCode'] == 200
+    assert ret['headers'] == {'Content-Type': 'application/json'}
+    assert json.loads(ret['body']) == {
+        'method': 'sendMessage',
+        'chat_id': 99999999,
+        'reply_to_message_id': 13,
+        'text': 'Unknown command'
+    }
+    assert telegram.session.post.call_count == 0
+
+
+def test_inline_kick_sends_other_kicks_out_of_band(new_members_event, mocker, mock_setup):
+    # pylint: disable=no-member
+    mocker.patch.object(app, 'INLINE_WEBHOOK_RESPONSES', True)
+    app.dynamodb.batch_get_item.return_value = {
+        'Responses': {'Roles': [
+            {'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}},
+            {'pk': {'S': 'user_999999403'}, 'sk': {'S': 'role_blacklist'}}
+        ]}
+    }
+
+    ret = app.lambda_handler(new_members_event, "")
+
+    inline = json.loads(ret['body'])
+    assert inline['method'] == 'kickChatMember'
+    telegram.session.post.assert_called_once_with(
+        'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
+        data={
+            'chat_id': -1009999992388,
+            'user_id': ({999999402, 999999403} - {inline['user_id']}).pop()
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_inline_responses_are_off_by_default(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret == {'statusCode': 200, 'body': '{}'}
+    assert telegram.session.post.call_count == 1
+
+
+def test_kick_without_admin_rights_sends_notice(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+    telegram.session.post.return_value.status_code = 400
+
+    app.lambda_handler(new_member_event, "")
+
+    telegram.session.post.assert_called_with(
+        'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
+        data={
+            'chat_id': -1009999992388,
+            'reply_to_message_id': 32,
+            'text': 'Unable to remove @testuser because this bot is not an admin'
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_failed_kicks_are_merged_into_one_notice(new_members_event, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.batch_get_item.return_value = {
+        'Responses': {'Roles': [
+            {'pk': {'S': 'user_{}'.format(user_id)}, 'sk': {'S': 'role_blacklist'}}
+            for user_id in [999999402, 999999403, 999999404]
+        ]}
+    }
+    telegram.session.post.return_value.status_code = 400
+
+    app.lambda_handler(new_members_event, "")
+
+    notices = [call for call in telegram.session.post.call_args_list if call.args[0].endswith('/sendMessage')]
+    assert len(notices) == 1
+    assert notices[0].kwargs['data']['text'] == \
+        'Unable to remove @testuser, @otheruser, @no_username because this bot is not an admin'
+
+
+def test_raid_mode_holds_back_repeated_notices(new_member_event, added_user_response, mocker, mock_setup):
+    # pylint: disable=no-member
+    mocker.patch.object(app.raid_detector, 'threshold', 2)
+    app.dynamodb.get_item.return_value = added_user_response
+    telegram.session.post.return_value.status_code = 400
+
+    for offset in range(4):
+        app.lambda_handler(as_new_update(new_member_event, offset), "")
+
+    notices = [call for call in telegram.session.post.call_args_list if call.args[0].endswith('/sendMessage')]
+    kicks = [call for call in telegram.session.post.call_args_list if call.args[0].endswith('/kickChatMember')]
+    assert len(kicks) == 4
+    # The first join is below the threshold, the second starts the raid and reports, the rest are held back
+    assert len(notices) == 2
+
+
+def test_banned_admin_is_not_kicked(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    body = json.loads(new_member_event['body'])
+    body['message']['new_chat_members'] = [{'id': TEST_USER_ID, 'is_bot': False, 'first_name': 'Admin'}]
+    new_member_event['body'] = json.dumps(body)
+    app.dynamodb.get_item.return_value = added_user_response
+
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret['statusCode'] == 200
+    assert app.ssm.get_parameters_by_path.call_count == 1
+    assert telegram.session.post.call_count == 0
+
+
+def test_bad_ssm_config_fails_join_events(new_member_event, non_added_user_response, mock_bad_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = non_added_user_response
+
+    with pytest.raises(Exception):
+        app.lambda_handler(new_member_event, "")
+
+    assert app.config_store.current is None
+
+
+def test_audit_command_kicks_listed_members(audit_command_event, mock_setup, mocker):
+    from telethon.tl.types import PeerChannel
+
+    client = mocker.Mock(spec=['start', 'get_entity'])
+    client.get_entity.return_value = PeerChannel(9999992388)
+    app.TelegramClient.return_value = client
+    pages = [([(999999402, 'spammer'), (TEST_USER_ID, 'test_user')], 3), ([(999999403, None)], 3)]
+    mocker.patch('autoblock_function.autoblock.audit.participant_pages', return_value=iter(pages))
+    mocker.patch.object(
+        app.handlers['/blacklist'], 'are_users_banned',
+        side_effect=lambda user_ids: {user_id: 'spam' if user_id != 999999403 else False for user_id in user_ids}
+    )
+
+    ret = app.lambda_handler(audit_command_event, "")
+
+    assert ret['statusCode'] == 200
+    client.get_entity.assert_called_once_with('@test_room')
+    # The bot's own admins are never removed
+    telegram.session.post.assert_any_call(
+        'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
+        data={'chat_id': -1009999992388, 'user_id': 999999402},
+        timeout=telegram.TIMEOUT
+    )
+    assert telegram.session.post.call_count == 2
+    telegram.session.post.assert_called_with(
+        'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
+        data={
+            'chat_id': 99999999,
+            'reply_to_message_id': 15,
+            'text': 'Checked 3 of 3 members of @test_room: 1 on the list.\n@spammer (999999402): spam\nRemoved 1.'
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_audit_applies_the_roles_of_a_routed_chat(audit_command_event, mock_setup, mocker):
+    from telethon.tl.types import PeerChannel
+
+    client = mocker.Mock(spec=['start', 'get_entity'])
+    client.get_entity.return_value = PeerChannel(9999992388)
+    app.TelegramClient.return_value = client
+    pages = [([(999999402, 'member'), (999999403, None)], 2)]
+    mocker.patch('autoblock_function.autoblock.audit.participant_pages', return_value=iter(pages))
+    mocker.patch.object(app, 'chat_routes', app.routes.parse_routes(
+        {'/blacklist': {'-1009999992388': ['blacklist', 'whitelist']}}, app.handlers, app.invocation_roles
+    ))
+    mocker.patch.object(app.invocation_roles, 'load')
+    mocker.patch.object(app.handlers['/blacklist'], 'uncached', return_value=[])
+    mocker.patch.object(app.handlers['/whitelist'], 'uncached', return_value=[])
+    mocker.patch.object(
+        app.handlers['/blacklist'], 'are_users_banned', side_effect=lambda user_ids: dict.fromkeys(user_ids, False)
     )
+    # Only 999999402 is on the whitelist
+    mocker.patch.object(
+        app.handlers['/whitelist'], 'are_users_banned',
+        side_effect=lambda user_ids: {user_id: user_id != 999999402 for user_id in user_ids}
+    )
+
+    app.lambda_handler(audit_command_event, "")
+
+    # Removed the same way as when joining: the chat's whitelist applies along with the blacklist
+    telegram.session.post.assert_any_call(
+        'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
+        data={'chat_id': -1009999992388, 'user_id': 999999403},
+        timeout=telegram.TIMEOUT
+    )
+    assert telegram.session.post.call_args.kwargs['data']['text'] == \
+        'Checked 2 of 2 members of @test_room: 1 on the list.\n@no_username (999999403)\nRemoved 1.'
+
+
+def test_import_document_adds_new_users(import_document_event, mock_setup, mocker):
+    mocker.patch('autoblock_function.autoblock.telegram.session.get')
+    mocker.patch('autoblock_function.autoblock.app.dynamodb.batch_write_item', return_value={})
+    telegram.session.post.return_value.json.return_value = {'result': {'file_path': 'documents/file_1.csv'}}
+    download = telegram.session.get.return_value
+    download.__enter__.return_value = download
+    download.raw = io.BufferedReader(io.BytesIO('\ufeffid,username\n999999402,@testuser\n999999403,\n'.encode('utf-8')))
+    app.dynamodb.batch_get_item.return_value = {'Responses': {'Roles': [
+        {'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}, 'reason': {'S': 'test account'}}
+    ]}}
+
+    ret = app.lambda_handler(import_document_event, "")
+
+    assert ret['statusCode'] == 200
+    telegram.session.get.assert_called_once_with(
+        'https://api.telegram.org/file/bot{}/documents/file_1.csv'.format(BOT_KEY), stream=True,
+        timeout=telegram.TIMEOUT
+    )
+    app.dynamodb.batch_write_item.assert_called_once_with(RequestItems={'Roles': [{'PutRequest': {'Item': {
+        'pk': {'S': 'user_999999403'},
+        'sk': {'S': 'role_blacklist'},
+        'role_users_pk': {'S': 'role_blacklist'},
+        'role_users_sk': {'S': 'user_999999403'},
+        'username': {'S': ''},
+        'reason': {'S': 'partner list'}
+    }}}]})
+    telegram.session.post.assert_called_with(
+        'https://api.telegram.org/bot{}/sendMessage'.format(BOT_KEY),
+        data={
+            'chat_id': 99999999,
+            'reply_to_message_id': 16,
+            'text': 'Read 2 rows: 1 added, 1 already listed, 0 duplicates, 0 invalid.'
+        },
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_redelivered_update_is_dropped(new_member_event, added_user_response, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = added_user_response
+
+    app.lambda_handler(new_member_event, "")
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret['statusCode'] == 200
+    assert app.dynamodb.get_item.call_count == 1
+    assert telegram.session.post.call_count == 1
+    assert app.update_deduplicator.duplicates == 1
+
+
+def test_failed_update_is_handled_again(new_member_event, mock_setup):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.side_effect = [ClientError({'Error': {'Code': 'InternalServerError'}}, 'GetItem'), {}]
+
+    with pytest.raises(ClientError):
+        app.lambda_handler(new_member_event, "")
+    app.lambda_handler(new_member_event, "")
+
+    assert app.dynamodb.get_item.call_count == 2
+    assert app.update_deduplicator.duplicates == 0
+
+
+def test_update_in_progress_elsewhere_is_retried_later(new_member_event, mock_setup, mocker):
+    # pylint: disable=no-member
+    mocker.patch.object(app.update_deduplicator, 'persist', True)
+    error = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+    error.response['Item'] = {'status': {'S': 'in_progress'}}
+    app.dynamodb.put_item.side_effect = error
+
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret['statusCode'] == 503
+    app.dynamodb.get_item.assert_not_called()
+
+    # Once the other container is done or its lease has run out, the retry is handled and marked done
+    app.dynamodb.put_item.side_effect = None
+    ret = app.lambda_handler(new_member_event, "")
+
+    assert ret['statusCode'] == 200
+    app.dynamodb.get_item.assert_called_once()
+    assert app.dynamodb.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':done': {'S': 'done'}}
+
+
+def test_update_is_released_when_the_config_load_fails(message_event, new_member_event, ssm_configuration,
+                                                       mock_bad_setup, mocker):
+    # pylint: disable=no-member
+    mocker.patch.object(app.update_deduplicator, 'persist', True)
+    # A group message does not need the config itself, but the update still fails with it
+    body = json.loads(message_event['body'])
+    body['message']['chat'] = json.loads(new_member_event['body'])['message']['chat']
+    event = dict(message_event, body=json.dumps(body))
+
+    with pytest.raises(Exception):
+        app.lambda_handler(event, "")
+
+    app.dynamodb.delete_item.assert_called_once()
+    assert app.dynamodb.update_item.call_count == 0
+
+    # The retry is handled once the parameters load
+    app.ssm.get_parameters_by_path.return_value = ssm_configuration
+    ret = app.lambda_handler(event, "")
+
+    assert ret['statusCode'] == 200
+    assert app.dynamodb.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':done': {'S': 'done'}}
+
+
+def test_routed_chat_checks_every_role_with_one_query(new_member_whitelist_event, mock_setup, mocker):
+    # pylint: disable=no-member
+    mocker.patch.object(app, 'chat_routes', app.routes.parse_routes(
+        {'/whitelist': {'-1009999992388': ['whitelist', 'blacklist']}}, app.handlers, app.invocation_roles
+    ))
+    app.dynamodb.query.return_value = {'Items': [
+        {'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_whitelist'}},
+        {'pk': {'S': 'user_999999402'}, 'sk': {'S': 'role_blacklist'}, 'reason': {'S': 'test account'}}
+    ]}
+
+    app.lambda_handler(new_member_whitelist_event, "")
+
+    assert app.dynamodb.query.call_count == 1
+    assert app.dynamodb.get_item.call_count == 0
+    telegram.session.post.assert_called_once_with(
+        'https://api.telegram.org/bot{}/kickChatMember'.format(BOT_KEY),
+        data={'chat_id': -1009999992388, 'user_id': 999999402},
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_isbanned_reads_the_table_past_the_snapshot(is_banned_command_event, added_user_response, mocker, mock_setup):
+    # pylint: disable=no-member
+    mocker.patch.object(app.banned_snapshot, 'lookup', return_value=False)
+    app.dynamodb.get_item.return_value = added_user_response
+    app.username_resolver.load.return_value = TEST_USER_ID
+
+    app.lambda_handler(is_banned_command_event, "")
+
+    assert app.dynamodb.get_item.call_count == 1
+    assert 'is banned: test account' in telegram.session.post.call_args.kwargs['data']['text']
+
+
+def test_add_command_resolves_stored_username_again(
+    add_command_event, non_added_user_response, telegram_test_user_entity, mock_setup
+):
+    # pylint: disable=no-member
+    app.dynamodb.get_item.return_value = non_added_user_response
+    app.TelegramClient.return_value = telegram_test_user_entity
+    # The name belonged to another account when it was stored
+    app.username_resolver.load.return_value = 12345
+
+    app.lambda_handler(add_command_event, "")
+
+    app.clients[BOT_KEY].get_entity.assert_called_once_with('@test_user')
+    assert app.dynamodb.put_item.call_args.kwargs['Item']['pk'] == {'S': 'user_{}'.format(TEST_USER_ID)}
+    app.username_resolver.store.assert_called_with('test_user', TEST_USER_ID)
+
+
+def test_held_failures_are_reported_after_the_raid(new_member_event, message_event, added_user_response, mocker,
+                                                   mock_setup):
+    # pylint: disable=no-member
+    now = [0]
+    mocker.patch.object(app.raid_detector, 'threshold', 2)
+    mocker.patch.object(app.raid_detector, 'clock', lambda: now[0])
+    app.dynamodb.get_item.return_value = added_user_response
+    telegram.session.post.return_value.status_code = 400
+
+    for offset in range(3):
+        app.lambda_handler(as_new_update(new_member_event, offset), "")
+
+    # The raid ends and the chat goes on talking: the third failure, held back, is reported
+    now[0] = app.raid_detector.notice_interval + app.raid_detector.window
+    body = json.loads(message_event['body'])
+    body['message']['chat'] = json.loads(new_member_event['body'])['message']['chat']
+    app.lambda_handler(dict(message_event, body=json.dumps(body)), "")
+
+    notices = [call for call in telegram.session.post.call_args_list if call.args[0].endswith('/sendMessage')]
+    assert len(notices) == 3
+    assert 'testuser' in notices[-1].kwargs['data']['text']
+    # The held notice is not a reply to the unrelated message that flushed it
+    assert 'reply_to_message_id' not in notices[-1].kwargs['data']
+    assert 'reply_to_message_id' in notices[0].kwargs['data']
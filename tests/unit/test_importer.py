@@ -0,0 +1,88 @@
+from autoblock_function.autoblock import blacklist, importer, roles, whitelist
+import io
+
+
+class FakeTable:
+    def __init__(self, existing=(), throttled_writes=0):
+        self.items = {user_id: None for user_id in existing}
+        self.throttled_writes = throttled_writes
+        self.get_requests = 0
+        self.write_requests = 0
+
+    def get_item(self, TableName, Key):
+        self.get_requests += 1
+        user_id = int(Key['pk']['S'].split('_')[-1])
+        return {'Item': dict(Key)} if user_id in self.items else {}
+
+    def batch_get_item(self, RequestItems):
+        self.get_requests += 1
+        (table_name, request), = RequestItems.items()
+        keys = [key for key in request['Keys'] if int(key['pk']['S'].split('_')[-1]) in self.items]
+        return {'Responses': {table_name: keys}}
+
+    def batch_write_item(self, RequestItems):
+        self.write_requests += 1
+        (table_name, writes), = RequestItems.items()
+        assert len(writes) <= roles.BATCH_WRITE_LIMIT
+
+        # The first few requests only get half of their writes through
+        if self.throttled_writes and len(writes) > 1:
+            self.throttled_writes -= 1
+            writes, unprocessed = writes[:len(writes) // 2], writes[len(writes) // 2:]
+        else:
+            unprocessed = []
+
+        for write in writes:
+            item = write['PutRequest']['Item']
+            self.items[int(item['pk']['S'].split('_')[-1])] = item
+
+        return {'UnprocessedItems': {table_name: unprocessed} if unprocessed else {}}
+
+
+def read(text, default_reason=None, requires_reason=True):
+    result = importer.ImportResult()
+    return list(importer.read_entries(io.StringIO(text), result, default_reason, requires_reason)), result
+
+
+def test_rows_are_read_with_or_without_a_header():
+    entries, result = read('1,@one,spam\n2,two,"raid, again"\n\nnot_an_id,x,y\n3,,\n')
+
+    assert entries == [(1, '@one', 'spam'), (2, '@two', 'raid, again')]
+    assert (result.rows, result.invalid) == (4, 2)
+
+    # scrape_room.py output has no reason column, the default reason applies to every row
+    entries, result = read('id,username,first_name,last_name\n5,five,Five,\n6,,Six,\n', 'listed by partner')
+
+    assert entries == [(5, '@five', 'listed by partner'), (6, '', 'listed by partner')]
+    assert (result.rows, result.invalid) == (2, 0)
+
+    assert read('7\n', requires_reason=False)[0] == [(7, '', None)]
+
+
+def test_import_skips_existing_users_and_retries_unprocessed_writes(mocker):
+    mocker.patch.object(roles.time, 'sleep')
+    table = FakeTable(existing=[2, 4], throttled_writes=2)
+    handler = blacklist.Handler('Roles', 'output-bucket', 'blacklist', table, None)
+    rows = ''.join('{},user{},spam\n'.format(user_id, user_id) for user_id in [1, 2, 3, 4, 3] + list(range(10, 70)))
+
+    result = importer.ImportResult()
+    importer.import_entries(handler, importer.read_entries(io.StringIO(rows), result), result, batch_size=30)
+
+    assert (result.rows, result.added, result.existing, result.duplicates, result.invalid) == (65, 62, 2, 1, 0)
+    assert result.summary() == 'Read 65 rows: 62 added, 2 already listed, 1 duplicates, 0 invalid.'
+    assert table.items[3] == handler.role_item(3, '@user3', 'spam')
+    assert table.items[2] is None
+    # One read per batch of 30
+    assert table.get_requests == 3
+
+
+def test_whitelist_import_needs_no_reason():
+    table = FakeTable()
+    handler = whitelist.Handler('Roles', 'whitelist', table)
+
+    result = importer.ImportResult()
+    entries = importer.read_entries(io.StringIO('id\n1\n2\n'), result, requires_reason=handler.requires_reason)
+    importer.import_entries(handler, entries, result)
+
+    assert result.added == 2
+    assert 'reason' not in table.items[1]
@@ -0,0 +1,115 @@
+from autoblock_function.autoblock import blocklist_scraper, incremental
+from autoblock_function.autoblock.snapshot import SNAPSHOT_KEY, decode_ids
+from tests.unit.test_blocklist_scraper import FakeIndex, role_item
+from tests.unit.test_export import FakeS3
+import io
+import zipfile
+
+
+def stream_record(event_name, sequence_number, user_id, username=None, reason=None, role='blacklist'):
+    record = {
+        'eventName': event_name,
+        'dynamodb': {
+            'Keys': {'pk': {'S': 'user_{}'.format(user_id)}, 'sk': {'S': 'role_{}'.format(role)}},
+            'SequenceNumber': str(sequence_number)
+        }
+    }
+
+    if event_name != 'REMOVE':
+        record['dynamodb']['NewImage'] = dict(role_item(user_id, username, reason), sk={'S': 'role_{}'.format(role)})
+
+    return record
+
+
+def exported_lines(s3):
+    archive = zipfile.ZipFile(io.BytesIO(s3.objects[blocklist_scraper.BLACKLIST_KEY]))
+    return archive.read('usernames.txt').decode('utf-8').splitlines()
+
+
+def setup_scraper(mocker, items):
+    s3 = FakeS3()
+    mocker.patch.object(blocklist_scraper, 's3', s3)
+    mocker.patch.object(blocklist_scraper, 'dynamodb', FakeIndex(items))
+    return s3
+
+
+def test_changes_from_records_keeps_blacklist_changes():
+    changes = incremental.changes_from_records([
+        stream_record('INSERT', 101, 5, '@five', 'spam'),
+        stream_record('INSERT', 102, 6, '@six', None, role='whitelist'),
+        stream_record('REMOVE', 103, 7)
+    ], 'blacklist')
+
+    assert changes == [
+        {'seq': '101', 'user_id': 5, 'username': '@five', 'reason': 'spam', 'op': 'add'},
+        {'seq': '103', 'user_id': 7, 'op': 'remove'}
+    ]
+    assert incremental.delta_key(changes) == 'autoblock_blacklist.delta/{:0>40}-{:0>40}.jsonl'.format(101, 103)
+
+
+def test_merge_keeps_index_order():
+    base = [(100, '@a', 'x'), (20, '@b', 'y'), (300, '@c', 'z')]
+    changes = {20: None, 100: (100, '@a', 'updated'), 25: (25, '@d', 'new'), 4: (4, '@e', 'new')}
+
+    assert list(incremental.merge(base, changes)) == [
+        (100, '@a', 'updated'), (25, '@d', 'new'), (300, '@c', 'z'), (4, '@e', 'new')
+    ]
+
+
+def test_drift_counts_differences():
+    drift = incremental.Drift([(1, '@a', 'x'), (2, '@b', 'y'), (3, '@c', 'z')])
+
+    assert list(drift.check([(1, '@a', 'x'), (3, '@c', 'changed'), (4, '@d', 'w')])) == \
+        [(1, '@a', 'x'), (3, '@c', 'changed'), (4, '@d', 'w')]
+    assert (drift.missing, drift.unexpected, drift.changed) == (1, 1, 1)
+
+
+def test_compaction_applies_stream_changes(mocker):
+    s3 = setup_scraper(mocker, [role_item(100, '@first', 'spam'), role_item(20, '@second', 'raid')])
+    blocklist_scraper.lambda_handler({}, None)
+
+    blocklist_scraper.stream_handler({'Records': [
+        stream_record('INSERT', 201, 3, '@third', 'alt'),
+        stream_record('REMOVE', 202, 100)
+    ]}, None)
+    blocklist_scraper.stream_handler({'Records': [stream_record('INSERT', 203, 100, '@first', 'back again')]}, None)
+    queries = blocklist_scraper.dynamodb.queries
+    blocklist_scraper.lambda_handler({'mode': 'compact'}, None)
+
+    assert exported_lines(s3) == ['@first (100) back again', '@second (20) raid', '@third (3) alt']
+    assert list(decode_ids(s3.objects[SNAPSHOT_KEY])) == [3, 20, 100]
+    assert incremental.list_deltas(s3, 'bucket') == []
+    # Compaction reads S3 only
+    assert blocklist_scraper.dynamodb.queries == queries
+
+
+def test_compaction_without_base_rescans(mocker):
+    s3 = setup_scraper(mocker, [role_item(1, '@one', 'spam')])
+
+    blocklist_scraper.lambda_handler({'mode': 'compact'}, None)
+
+    assert exported_lines(s3) == ['@one (1) spam']
+    assert incremental.BASE_KEY in s3.objects
+
+
+def test_compaction_without_changes_touches_only_an_exported_snapshot(mocker):
+    s3 = setup_scraper(mocker, [role_item(1, '@one', 'spam')])
+    mocker.patch.object(blocklist_scraper, 'EXPORT_FORMATS', ['zip'])
+    blocklist_scraper.lambda_handler({}, None)
+
+    blocklist_scraper.lambda_handler({'mode': 'compact'}, None)
+
+    assert s3.copies == []
+
+
+def test_rescan_reports_drift(mocker):
+    s3 = setup_scraper(mocker, [role_item(1, '@one', 'spam')])
+    blocklist_scraper.lambda_handler({}, None)
+    mocker.patch.object(blocklist_scraper, 'export_metrics')
+
+    # A change the stream never delivered
+    blocklist_scraper.dynamodb.items.append(role_item(2, '@two', 'raid'))
+    blocklist_scraper.lambda_handler({}, None)
+
+    blocklist_scraper.export_metrics.count.assert_called_once_with('BlocklistExportDrift', 1)
+    assert exported_lines(s3) == ['@one (1) spam', '@two (2) raid']
@@ -0,0 +1,41 @@
+from autoblock_function.autoblock.metrics import Metrics
+import json
+
+
+def test_emf_document_contains_counts_and_timings(capsys):
+    metrics = Metrics('AutoblockBot')
+    metrics.begin(BotId=1, Path='/blacklist', ChatType=None)
+    metrics.count('UserRemoved')
+    metrics.count('UserRemoved')
+    metrics.timing('HandlerDuration', 12.5)
+    metrics.timing('HandlerDuration', 7.5)
+    metrics.flush()
+
+    document = json.loads(capsys.readouterr().out)
+    assert document['UserRemoved'] == 2.0
+    assert document['HandlerDuration'] == [12.5, 7.5]
+    assert document['BotId'] == '1'
+    assert 'ChatType' not in document
+    assert document['_aws']['CloudWatchMetrics'][0]['Metrics'] == [
+        {'Name': 'UserRemoved', 'Unit': 'Count'},
+        {'Name': 'HandlerDuration', 'Unit': 'Milliseconds'}
+    ]
+
+
+def test_api_mode_sends_one_batched_call(mocker):
+    cloudwatch = mocker.Mock()
+    metrics = Metrics('AutoblockBot', 'api', cloudwatch)
+    metrics.begin(Path='/whitelist')
+    metrics.count('StartCommand')
+    metrics.count('UnknownCommand')
+    metrics.flush()
+    metrics.flush()
+
+    cloudwatch.put_metric_data.assert_called_once_with(Namespace='AutoblockBot', MetricData=[
+        {'MetricName': 'StartCommand', 'Values': [1.0], 'Unit': 'Count'},
+        {'MetricName': 'StartCommand', 'Values': [1.0], 'Unit': 'Count',
+         'Dimensions': [{'Name': 'Path', 'Value': '/whitelist'}]},
+        {'MetricName': 'UnknownCommand', 'Values': [1.0], 'Unit': 'Count'},
+        {'MetricName': 'UnknownCommand', 'Values': [1.0], 'Unit': 'Count',
+         'Dimensions': [{'Name': 'Path', 'Value': '/whitelist'}]}
+    ])
@@ -0,0 +1,108 @@
+from autoblock_function.autoblock import participants
+from types import SimpleNamespace
+import asyncio
+import csv
+import json
+import pytest
+
+
+def member(user_id, username=None, first_name=None, last_name=None):
+    return SimpleNamespace(id=user_id, username=username, first_name=first_name, last_name=last_name)
+
+
+class FakeRoom:
+    def __init__(self, members, fail_at=None):
+        self.members = members
+        self.fail_at = fail_at
+        self.offsets = []
+
+    async def fetch_page(self, offset, limit):
+        if offset == self.fail_at:
+            raise ConnectionError('interrupted')
+
+        self.offsets.append(offset)
+        return self.members[offset:offset + limit], len(self.members)
+
+
+class NoWait:
+    async def wait(self):
+        pass
+
+
+def run_scrape(room, tmp_path, output_format='csv'):
+    output_path = str(tmp_path / 'room_members.{}'.format(output_format))
+    checkpoint = participants.Checkpoint(str(tmp_path / 'room_members.checkpoint'))
+    progress = participants.Progress(output=lambda line: None)
+
+    rows = asyncio.run(participants.scrape(
+        'room', room.fetch_page, output_path, checkpoint, NoWait(), progress, output_format, page_size=2
+    ))
+    return rows, output_path
+
+
+def test_csv_fields_are_escaped(tmp_path):
+    room = FakeRoom([member(1, 'one', 'Comma, "Quoted"', 'Line\nBreak'), member(2, None, 'Two', None)])
+
+    rows, output_path = run_scrape(room, tmp_path)
+
+    with open(output_path, newline='', encoding='utf-8') as output:
+        assert list(csv.reader(output)) == [
+            ['id', 'username', 'first_name', 'last_name'],
+            ['1', 'one', 'Comma, "Quoted"', 'Line\nBreak'],
+            ['2', '', 'Two', '']
+        ]
+    assert rows == 2
+
+
+def test_interrupted_scrape_resumes_from_checkpoint(tmp_path):
+    members = [member(user_id, 'user{}'.format(user_id), 'Ünïcode') for user_id in range(1, 8)]
+
+    with pytest.raises(ConnectionError):
+        run_scrape(FakeRoom(members, fail_at=4), tmp_path)
+
+    room = FakeRoom(members)
+    rows, output_path = run_scrape(room, tmp_path)
+
+    assert room.offsets == [4, 6, 7]
+    assert rows == 7
+    with open(output_path, newline='', encoding='utf-8') as output:
+        assert [row[0] for row in csv.reader(output)] == ['id'] + [str(user_id) for user_id in range(1, 8)]
+
+    # A finished room is not requested again
+    finished = FakeRoom(members)
+    assert run_scrape(finished, tmp_path)[0] == 7
+    assert finished.offsets == []
+
+
+def test_shifted_pages_do_not_duplicate_members(tmp_path):
+    room = FakeRoom([member(1), member(2), member(2), member(3)])
+
+    rows, output_path = run_scrape(room, tmp_path, 'ndjson')
+
+    with open(output_path, encoding='utf-8') as output:
+        assert [json.loads(line)['id'] for line in output] == [1, 2, 3]
+    assert rows == 3
+
+
+def test_rate_limiter_spaces_requests(mocker):
+    now = [0.0]
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    mocker.patch.object(participants.asyncio, 'sleep', sleep)
+    limiter = participants.RateLimiter(2, clock=lambda: now[0])
+
+    async def requests(count):
+        for _ in range(count):
+            await limiter.wait()
+
+    asyncio.run(requests(3))
+    assert sleeps == [0.5, 0.5]
+
+    # A flood wait holds back every room sharing the limiter
+    limiter.pause(10)
+    asyncio.run(requests(1))
+    assert sleeps == [0.5, 0.5, 10]
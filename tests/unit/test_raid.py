@@ -0,0 +1,115 @@
+from autoblock_function.autoblock.raid import RaidDetector, SharedJoinWindow
+from botocore.exceptions import ClientError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_join_burst_starts_and_ends_raid_mode():
+    clock = FakeClock()
+    detector = RaidDetector(threshold=3, window=10, clock=clock)
+
+    assert detector.record_joins(1, 1) == (False, False)
+    assert detector.record_joins(1, 2) == (True, True)
+    assert detector.record_joins(1, 1) == (True, False)
+    # Other chats are tracked separately
+    assert detector.record_joins(2, 1) == (False, False)
+
+    clock.now = 10
+    assert detector.record_joins(1, 1) == (False, False)
+
+
+class FakeTable:
+    # Enough of update_item for the shared join window
+    def __init__(self):
+        self.items = {}
+        self.fail = False
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ReturnValues):
+        if self.fail:
+            raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'UpdateItem')
+
+        item = self.items.setdefault(Key['pk']['S'], {})
+        current = ExpressionAttributeNames['#current']
+        count = int(item.get(current, {'N': '0'})['N']) + int(ExpressionAttributeValues[':count']['N'])
+        item[current] = {'N': str(count)}
+        item['expires_at'] = ExpressionAttributeValues[':expires_at']
+        item.pop(ExpressionAttributeNames['#stale'], None)
+        return {'Attributes': dict(item)}
+
+
+def test_joins_on_other_containers_count_towards_a_raid():
+    clock = FakeClock()
+    table = FakeTable()
+    containers = [
+        RaidDetector(threshold=4, window=10, clock=clock, shared=SharedJoinWindow('Roles', table, 10, clock))
+        for _ in range(2)
+    ]
+
+    assert containers[0].record_joins(1, 2) == (False, False)
+    assert containers[1].record_joins(1, 2) == (True, True)
+
+    # Half of the previous slot still falls inside the window
+    clock.now = 15
+    assert containers[0].record_joins(1, 1) == (False, False)
+    assert containers[0].record_joins(1, 1) == (True, True)
+
+    # Slots older than the previous one are removed
+    clock.now = 25
+    containers[1].record_joins(1, 1)
+    assert sorted(table.items['raid_1']) == ['expires_at', 'joins_1', 'joins_2']
+
+
+def test_container_counts_its_own_joins_without_the_table():
+    clock = FakeClock()
+    table = FakeTable()
+    table.fail = True
+    detector = RaidDetector(threshold=3, window=10, clock=clock, shared=SharedJoinWindow('Roles', table, 10, clock))
+
+    assert detector.record_joins(1, 2) == (False, False)
+    assert detector.record_joins(1, 1) == (True, True)
+
+
+def test_failures_are_reported_once_per_interval():
+    clock = FakeClock()
+    detector = RaidDetector(notice_interval=30, clock=clock)
+
+    assert detector.add_failures(1, ['a']) == (['a'], 0)
+    assert detector.add_failures(1, ['b']) == ([], 0)
+    assert detector.add_failures(1, ['c']) == ([], 0)
+
+    clock.now = 30
+    assert detector.add_failures(1, ['d']) == (['b', 'c', 'd'], 0)
+
+
+def test_tracked_chats_are_bounded():
+    detector = RaidDetector(max_chats=2)
+
+    for chat_id in range(5):
+        detector.record_joins(chat_id, 1)
+
+    assert list(detector.chats) == [3, 4]
+
+
+def test_held_failures_are_flushed_after_the_raid():
+    clock = FakeClock()
+    detector = RaidDetector(notice_interval=30, max_pending=2, clock=clock)
+
+    assert detector.add_failures(1, ['a']) == (['a'], 0)
+    assert detector.add_failures(1, ['b', 'c', 'd']) == ([], 0)
+
+    # The raid is over and later joins kick cleanly, the held failures still go out once the interval has passed
+    assert detector.add_failures(1, [], hold=False) == ([], 0)
+    clock.now = 30
+    assert detector.add_failures(1, [], hold=False) == (['b', 'c'], 1)
+    assert detector.add_failures(1, [], hold=False) == ([], 0)
+
+    # Nothing is tracked for chats that never had failures
+    assert detector.add_failures(2, []) == ([], 0)
+    assert 2 not in detector.chats
@@ -0,0 +1,55 @@
+from autoblock_function.autoblock.sessions import SessionStore
+from botocore.exceptions import ClientError
+import io
+
+
+def test_restore_writes_session_file(tmp_path, mocker):
+    s3 = mocker.Mock()
+    s3.get_object.return_value = {'Body': io.BytesIO(b'sqlite'), 'ETag': '"a"'}
+    store = SessionStore(s3, 'bucket')
+    path = str(tmp_path / 'autoblock_bot_1')
+
+    assert store.restore('1', path)
+    assert open(path + '.session', 'rb').read() == b'sqlite'
+    s3.get_object.assert_called_once_with(Bucket='bucket', Key='telethon_sessions/1.session')
+
+    # Unchanged sessions are not uploaded again
+    assert not store.save('1', path)
+    assert s3.put_object.call_count == 0
+
+
+def test_save_only_replaces_the_restored_copy(tmp_path, mocker):
+    s3 = mocker.Mock()
+    s3.get_object.return_value = {'Body': io.BytesIO(b'sqlite'), 'ETag': '"a"'}
+    s3.put_object.return_value = {'ETag': '"b"'}
+    store = SessionStore(s3, 'bucket')
+    path = str(tmp_path / 'autoblock_bot_1')
+
+    store.restore('1', path)
+    open(path + '.session', 'wb').write(b'sqlite with new auth key')
+
+    assert store.save('1', path)
+    s3.put_object.assert_called_once_with(
+        Bucket='bucket', Key='telethon_sessions/1.session', Body=b'sqlite with new auth key', IfMatch='"a"'
+    )
+
+
+def test_save_new_session_loses_race_quietly(tmp_path, mocker):
+    s3 = mocker.Mock()
+    s3.put_object.side_effect = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+    store = SessionStore(s3, 'bucket')
+    path = str(tmp_path / 'autoblock_bot_1')
+    open(path + '.session', 'wb').write(b'sqlite')
+
+    assert not store.save('1', path)
+    assert s3.put_object.call_args.kwargs['IfNoneMatch'] == '*'
+
+
+def test_failed_save_does_not_raise(tmp_path, mocker):
+    s3 = mocker.Mock()
+    s3.put_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+    store = SessionStore(s3, 'bucket')
+    path = str(tmp_path / 'autoblock_bot_1')
+    open(path + '.session', 'wb').write(b'sqlite')
+
+    assert not store.save('1', path)
@@ -0,0 +1,98 @@
+from autoblock_function.autoblock.snapshot import BannedIdSnapshot, decode_ids, encode_ids
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+from email.utils import formatdate
+import io
+
+
+def test_encode_sorts_and_deduplicates():
+    data = encode_ids([30, 10, 2 ** 63, 10])
+
+    assert len(data) == 24
+    assert list(decode_ids(data)) == [10, 30, 2 ** 63]
+
+
+def test_lookup_and_local_additions(mocker):
+    s3 = mocker.Mock()
+    s3.get_object.return_value = {
+        'Body': io.BytesIO(encode_ids([1, 3])),
+        'ETag': '"a"',
+        'LastModified': datetime.now(timezone.utc)
+    }
+    banned = BannedIdSnapshot(s3, 'bucket')
+
+    assert banned.lookup(3) is True
+    assert banned.lookup(2) is False
+
+    banned.add(2)
+    assert banned.lookup(2) is None
+
+    # Loaded once, then only rechecked after the refresh interval
+    assert s3.get_object.call_count == 1
+
+
+def test_unchanged_republish_keeps_snapshot_fresh(mocker):
+    clock = mocker.Mock(return_value=1000000000.0)
+    s3 = mocker.Mock()
+    s3.get_object.return_value = {
+        'Body': io.BytesIO(encode_ids([1])),
+        'ETag': '"a"',
+        'LastModified': datetime.fromtimestamp(1000000000, timezone.utc)
+    }
+    banned = BannedIdSnapshot(s3, 'bucket', max_age=3600, clock=clock)
+    assert banned.lookup(2) is False
+
+    clock.return_value += 7200
+    s3.get_object.side_effect = ClientError({
+        'Error': {'Code': '304'},
+        'ResponseMetadata': {'HTTPHeaders': {'last-modified': formatdate(1000007000, usegmt=True)}}
+    }, 'GetObject')
+
+    assert banned.lookup(2) is False
+    assert s3.get_object.call_args.kwargs['IfNoneMatch'] == '"a"'
+
+
+def test_stale_snapshot_and_recent_additions_fall_back(mocker):
+    clock = mocker.Mock(return_value=1000000000.0)
+    s3 = mocker.Mock()
+    s3.get_object.side_effect = lambda **kwargs: {
+        'Body': io.BytesIO(encode_ids([1])),
+        'ETag': '"a"',
+        'LastModified': datetime.fromtimestamp(clock.return_value, timezone.utc)
+    }
+    banned = BannedIdSnapshot(s3, 'bucket', max_age=1800, refresh_interval=300, clock=clock)
+
+    banned.add(2)
+    assert banned.lookup(2) is None
+
+    # A newer snapshot may not have the addition yet, so it stays with the table until max_age has passed
+    clock.return_value += 600
+    assert banned.lookup(2) is None
+    clock.return_value += 1800
+    assert banned.lookup(2) is False
+
+    # The export stopped: nothing is answered from a snapshot older than max_age
+    s3.get_object.side_effect = ClientError({'Error': {'Code': '304'}}, 'GetObject')
+    clock.return_value += 1801
+    assert banned.lookup(2) is None
+
+
+def test_touched_snapshot_is_not_read_again(mocker):
+    clock = mocker.Mock(return_value=1000000000.0)
+    body = mocker.Mock()
+    body.read.return_value = encode_ids([1])
+    s3 = mocker.Mock()
+    s3.get_object.side_effect = lambda **kwargs: {
+        'Body': body,
+        'ETag': '"{}"'.format(clock.return_value),
+        'Metadata': {'sha256': 'ids'},
+        'LastModified': datetime.fromtimestamp(clock.return_value, timezone.utc)
+    }
+    banned = BannedIdSnapshot(s3, 'bucket', max_age=1800, refresh_interval=300, clock=clock)
+    assert banned.lookup(1) is True
+
+    # The touch gave the object a new ETag and modification time, the hash is the same
+    clock.return_value += 2000
+    assert banned.lookup(1) is True
+    assert body.read.call_count == 1
+    assert banned.generated_at == clock.return_value
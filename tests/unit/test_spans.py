@@ -0,0 +1,47 @@
+from autoblock_function.autoblock import profiling, spans
+import json
+import os
+import time
+
+
+def test_spans_sum_time_per_stage(capsys):
+    now = [0.0]
+    stages = spans.Spans(clock=lambda: now[0])
+
+    for elapsed in [0.010, 0.030]:
+        with stages.span('dynamodb.get_item'):
+            now[0] += elapsed
+
+    stages.flush(path='/blacklist')
+
+    assert json.loads(capsys.readouterr().out) == {
+        'path': '/blacklist', 'stage_ms': {'dynamodb.get_item': 40.0}, 'stage_calls': {'dynamodb.get_item': 2}
+    }
+    assert stages.fields()['stage_ms'] == {}
+
+
+def test_disabled_spans_record_nothing(capsys):
+    stages = spans.Spans(enabled=False)
+
+    with stages.span('dynamodb.get_item'):
+        pass
+
+    assert stages.span('telegram.sendMessage') is spans.NO_SPAN
+    stages.flush()
+    assert stages.totals == {}
+    assert capsys.readouterr().out == ''
+
+
+def test_profilers_dump_their_results(tmp_path):
+    assert profiling.start('off', str(tmp_path)) is None
+
+    for mode, extension in [('cprofile', '.pstats'), ('sample', '.folded')]:
+        profiler = profiling.start(mode, str(tmp_path), 'test')
+        sum(index * index for index in range(200000))
+
+        while mode == 'sample' and not profiler.stacks:
+            time.sleep(0.001)
+
+        profiler.stop()
+
+        assert os.path.getsize(os.path.join(str(tmp_path), 'profile_test' + extension)) > 0
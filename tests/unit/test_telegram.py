@@ -0,0 +1,60 @@
+from autoblock_function.autoblock import telegram
+import pytest
+import requests
+
+
+@pytest.fixture()
+def mock_session(mocker):
+    mocker.patch('autoblock_function.autoblock.telegram.session.post')
+    mocker.patch('autoblock_function.autoblock.telegram.time.sleep')
+
+
+def response(mocker, status_code, body=None):
+    return mocker.Mock(status_code=status_code, headers={}, json=mocker.Mock(return_value=body or {}))
+
+
+def test_call_retries_after_rate_limit(mocker, mock_session):
+    # pylint: disable=no-member
+    telegram.session.post.side_effect = [
+        response(mocker, 429, {'ok': False, 'parameters': {'retry_after': 2}}),
+        response(mocker, 200)
+    ]
+
+    result = telegram.call('1:KEY', 'sendMessage', {'chat_id': 1, 'text': 'hi'})
+
+    assert result.status_code == 200
+    telegram.time.sleep.assert_called_once_with(2.0)
+    telegram.session.post.assert_called_with(
+        'https://api.telegram.org/bot1:KEY/sendMessage',
+        data={'chat_id': 1, 'text': 'hi'},
+        timeout=telegram.TIMEOUT
+    )
+
+
+def test_call_does_not_wait_for_long_retry_after(mocker, mock_session):
+    # pylint: disable=no-member
+    telegram.session.post.return_value = response(mocker, 429, {'parameters': {'retry_after': 60}})
+
+    result = telegram.call('1:KEY', 'kickChatMember', {})
+
+    assert result.status_code == 429
+    assert telegram.session.post.call_count == 1
+    assert telegram.time.sleep.call_count == 0
+
+
+def test_call_does_not_retry_client_errors(mocker, mock_session):
+    # pylint: disable=no-member
+    telegram.session.post.return_value = response(mocker, 400)
+
+    assert telegram.call('1:KEY', 'kickChatMember', {}).status_code == 400
+    assert telegram.session.post.call_count == 1
+
+
+def test_call_gives_up_on_connection_errors(mock_session):
+    # pylint: disable=no-member
+    telegram.session.post.side_effect = requests.ConnectionError()
+
+    with pytest.raises(requests.ConnectionError):
+        telegram.call('1:KEY', 'sendMessage', {})
+
+    assert telegram.session.post.call_count == telegram.MAX_ATTEMPTS
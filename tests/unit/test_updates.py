@@ -0,0 +1,86 @@
+from botocore.exceptions import ClientError
+
+from autoblock_function.autoblock.updates import CLAIMED, HANDLED, IN_PROGRESS, UpdateDeduplicator
+
+
+def claimed_elsewhere(status):
+    error = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+    error.response['Item'] = {'pk': {'S': 'update_1_100'}, 'sk': {'S': 'update'}, 'status': {'S': status}}
+    return error
+
+
+def test_redelivered_updates_are_dropped(mocker):
+    dynamodb = mocker.Mock()
+    deduplicator = UpdateDeduplicator('Roles', dynamodb, window=2)
+
+    assert deduplicator.claim('1', 100) == CLAIMED
+    assert deduplicator.claim('1', 100) == HANDLED
+    assert deduplicator.claim('2', 100) == CLAIMED
+
+    # The oldest update falls out of the window
+    assert deduplicator.claim('1', 101) == CLAIMED
+    assert deduplicator.claim('1', 100) == CLAIMED
+
+    assert deduplicator.duplicates == 1
+    dynamodb.put_item.assert_not_called()
+
+
+def test_persisted_claims_use_a_conditional_put(mocker):
+    dynamodb = mocker.Mock()
+    deduplicator = UpdateDeduplicator('Roles', dynamodb, persist=True, ttl=60, lease=10, clock=lambda: 1000)
+
+    assert deduplicator.claim('1', 100) == CLAIMED
+    dynamodb.put_item.assert_called_once_with(
+        TableName='Roles',
+        Item={
+            'pk': {'S': 'update_1_100'}, 'sk': {'S': 'update'}, 'status': {'S': 'in_progress'},
+            'lease_until': {'N': '1010'}, 'expires_at': {'N': '1060'}
+        },
+        ConditionExpression='attribute_not_exists(pk) OR (#status = :in_progress AND lease_until < :now)',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':in_progress': {'S': 'in_progress'}, ':now': {'N': '1000'}},
+        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+    )
+
+    deduplicator.complete('1', 100)
+    dynamodb.update_item.assert_called_once_with(
+        TableName='Roles',
+        Key={'pk': {'S': 'update_1_100'}, 'sk': {'S': 'update'}},
+        UpdateExpression='SET #status = :done REMOVE lease_until',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':done': {'S': 'done'}}
+    )
+
+    # Handled by another container
+    dynamodb.put_item.side_effect = claimed_elsewhere('done')
+    assert deduplicator.claim('1', 101) == HANDLED
+
+    # Updates are handled when the table cannot be reached
+    dynamodb.put_item.side_effect = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutItem')
+    assert deduplicator.claim('1', 102) == CLAIMED
+
+
+def test_update_under_a_live_lease_is_deferred(mocker):
+    dynamodb = mocker.Mock()
+    deduplicator = UpdateDeduplicator('Roles', dynamodb, persist=True)
+
+    dynamodb.put_item.side_effect = claimed_elsewhere('in_progress')
+    assert deduplicator.claim('1', 100) == IN_PROGRESS
+
+    # Telegram's retry may come back to this container once the other one is done
+    dynamodb.put_item.side_effect = None
+    assert deduplicator.claim('1', 100) == CLAIMED
+    assert deduplicator.duplicates == 1
+
+
+def test_released_updates_can_be_claimed_again(mocker):
+    dynamodb = mocker.Mock()
+    deduplicator = UpdateDeduplicator('Roles', dynamodb, persist=True)
+
+    assert deduplicator.claim('1', 100) == CLAIMED
+    deduplicator.release('1', 100)
+
+    dynamodb.delete_item.assert_called_once_with(
+        TableName='Roles', Key={'pk': {'S': 'update_1_100'}, 'sk': {'S': 'update'}}
+    )
+    assert deduplicator.claim('1', 100) == CLAIMED
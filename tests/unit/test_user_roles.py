@@ -0,0 +1,95 @@
+from autoblock_function.autoblock import blacklist, whitelist
+from autoblock_function.autoblock.cache import MISSING, RoleCache
+from autoblock_function.autoblock.routes import load_chat_roles, parse_routes
+from autoblock_function.autoblock.user_roles import UserRoles
+
+
+def role(user_id, role_name, **attributes):
+    item = {'pk': {'S': 'user_{}'.format(user_id)}, 'sk': {'S': 'role_{}'.format(role_name)}}
+    item.update({name: {'S': value} for name, value in attributes.items()})
+    return item
+
+
+def test_roles_of_reads_every_role_with_one_query(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.query.side_effect = [
+        {'Items': [role(42, 'blacklist', reason='spam')], 'LastEvaluatedKey': {'pk': {'S': 'user_42'}}},
+        {'Items': [role(42, 'whitelist')]}
+    ]
+    user_roles = UserRoles('Roles', dynamodb)
+
+    assert set(user_roles.roles_of(42)) == {'blacklist', 'whitelist'}
+    assert user_roles.known(42, 'blacklist')['reason'] == {'S': 'spam'}
+    assert user_roles.known(42, 'moderator') is None
+    assert user_roles.known(43, 'blacklist') is MISSING
+
+    user_roles.roles_of(42)
+    assert dynamodb.query.call_count == 2
+    dynamodb.query.assert_called_with(
+        TableName='Roles',
+        KeyConditionExpression='pk = :pk AND begins_with(sk, :role)',
+        ExpressionAttributeValues={':pk': {'S': 'user_42'}, ':role': {'S': 'role_'}},
+        ExclusiveStartKey={'pk': {'S': 'user_42'}}
+    )
+
+    # Read again in the next invocation
+    user_roles.begin()
+    assert user_roles.known(42, 'blacklist') is MISSING
+
+
+def test_load_reads_several_users_and_roles_in_one_batch(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.batch_get_item.return_value = {'Responses': {'Roles': [role(1, 'whitelist'), role(2, 'blacklist')]}}
+    user_roles = UserRoles('Roles', dynamodb)
+    user_roles.remember(3, 'blacklist', None)
+
+    user_roles.load({'whitelist': [1, 2], 'blacklist': [1, 2, 3]})
+
+    dynamodb.batch_get_item.assert_called_once_with(RequestItems={'Roles': {'Keys': [
+        {'pk': {'S': 'user_1'}, 'sk': {'S': 'role_whitelist'}},
+        {'pk': {'S': 'user_2'}, 'sk': {'S': 'role_whitelist'}},
+        {'pk': {'S': 'user_1'}, 'sk': {'S': 'role_blacklist'}},
+        {'pk': {'S': 'user_2'}, 'sk': {'S': 'role_blacklist'}}
+    ]}})
+    assert user_roles.known(1, 'whitelist') is not None
+    assert user_roles.known(1, 'blacklist') is None
+    assert user_roles.known(2, 'blacklist') is not None
+
+    user_roles.load({'whitelist': [1, 2], 'blacklist': [1, 2, 3]})
+    assert dynamodb.batch_get_item.call_count == 1
+
+
+def test_route_applies_every_role_with_one_read(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.query.return_value = {'Items': [role(42, 'whitelist'), role(42, 'blacklist', reason='spam')]}
+    user_roles = UserRoles('Roles', dynamodb)
+    cache = RoleCache()
+    handlers = {
+        '/blacklist': blacklist.Handler('Roles', 'bucket', 'blacklist', dynamodb, None, cache, user_roles=user_roles),
+        '/whitelist': whitelist.Handler('Roles', 'whitelist', dynamodb, cache, user_roles=user_roles)
+    }
+    routes = parse_routes({'/whitelist': {'-100123': ['whitelist', 'blacklist']}}, handlers, user_roles)
+
+    # Only the whitelist bot applies both roles in the chat
+    assert list(routes) == [('/whitelist', -100123)]
+    assert routes[('/whitelist', -100123)].is_user_banned(42) == 'spam'
+    dynamodb.query.assert_called_once()
+    dynamodb.get_item.assert_not_called()
+
+    # Answered by the role cache in later invocations
+    user_roles.begin()
+    assert routes[('/whitelist', -100123)].is_user_banned(42) == 'spam'
+    dynamodb.query.assert_called_once()
+
+
+def test_invalid_chat_roles_are_skipped(mocker):
+    handlers = {'/blacklist': blacklist.Handler('Roles', 'bucket', 'blacklist', mocker.Mock(), None)}
+
+    assert load_chat_roles('{"-100123": ') == {}
+    assert load_chat_roles('[]') == {}
+    routes = parse_routes({
+        '-100123': ['blacklist'],
+        '/blacklist': {'-100123': ['moderator'], 'room': ['blacklist'], '-100456': 'blacklist', '-100789': ['blacklist']}
+    }, handlers, UserRoles('Roles', mocker.Mock()))
+
+    assert list(routes) == [('/blacklist', -100789)]
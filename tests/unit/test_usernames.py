@@ -0,0 +1,46 @@
+from autoblock_function.autoblock.usernames import UsernameResolver
+
+
+def test_lookup_reads_stored_mapping_once(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.get_item.return_value = {
+        'Item': {'user_id': {'N': '42'}, 'expires_at': {'N': '2000'}}
+    }
+    resolver = UsernameResolver('Roles', dynamodb, clock=lambda: 1000)
+
+    assert resolver.lookup('@Someone') == 42
+    assert resolver.lookup('someone') == 42
+
+    dynamodb.get_item.assert_called_once_with(
+        TableName='Roles',
+        Key={'pk': {'S': 'username_someone'}, 'sk': {'S': 'username'}}
+    )
+
+
+def test_lookup_ignores_expired_items(mocker):
+    dynamodb = mocker.Mock()
+    dynamodb.get_item.return_value = {
+        'Item': {'user_id': {'N': '42'}, 'expires_at': {'N': '1000'}}
+    }
+    resolver = UsernameResolver('Roles', dynamodb, clock=lambda: 1000)
+
+    assert resolver.lookup('someone') is None
+
+
+def test_remember_persists_with_ttl(mocker):
+    dynamodb = mocker.Mock()
+    resolver = UsernameResolver('Roles', dynamodb, ttl=60, clock=lambda: 1000)
+
+    resolver.remember('@Someone', 42)
+
+    dynamodb.put_item.assert_called_once_with(
+        TableName='Roles',
+        Item={
+            'pk': {'S': 'username_someone'},
+            'sk': {'S': 'username'},
+            'user_id': {'N': '42'},
+            'expires_at': {'N': '1060'}
+        }
+    )
+    assert resolver.lookup('someone') == 42
+    assert dynamodb.get_item.call_count == 0